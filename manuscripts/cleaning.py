@@ -1,8 +1,9 @@
 from django.db.models import Q
 from django.db import IntegrityError
 
-from otcore.hit.models import Hit
+from otcore.hit.models import Hit, deferred_display_names
 from otcore.hit.processing import merge_baskets
+from otcore.lex.lex_utils import lex_slugify_many
 
 
 def full_clean():
@@ -19,9 +20,7 @@ def remove_whitespace():
         Q(name__startswith=" ") |
         Q(name__endswith=" "))
 
-    for hit in hits:
-        name = hit.name.strip()
-        check_save(hit, name)
+    check_save_all([(hit, hit.name.strip()) for hit in hits])
 
 
 def replace_smart_quotes():
@@ -30,47 +29,51 @@ def replace_smart_quotes():
         Q(name__contains='’') |
         Q(name__contains='”'))
 
-    for hit in hits:
-        name = hit.name.replace('“', '"').replace('”', '"').replace('’', "'")
-        check_save(hit, name)
+    check_save_all([
+        (hit, hit.name.replace('“', '"').replace('”', '"').replace('’', "'"))
+        for hit in hits
+    ])
 
 
 def remove_trailing_commas():
     hits = Hit.objects.filter(name__endswith=',')
 
-    for hit in hits:
-        name = hit.name[:len(hit.name)-1]
-        check_save(hit, name)
+    check_save_all([(hit, hit.name[:len(hit.name)-1]) for hit in hits])
 
     hits = Hit.objects.filter(name__endswith=',"')
 
-    for hit in hits:
-        name = hit.name.replace(',"', '"')
-        check_save(hit, name)
+    check_save_all([(hit, hit.name.replace(',"', '"')) for hit in hits])
 
 
 def remove_unopened_parens():
     hits = Hit.objects.filter(name__endswith=')').exclude(name__contains='(')
 
-    for hit in hits:
-        name = hit.name[:len(hit.name)-1]
-        check_save(hit, name)
+    check_save_all([(hit, hit.name[:len(hit.name)-1]) for hit in hits])
 
 
 def remove_formatted_indent():
     hits = Hit.objects.filter(name__contains='—\t')
 
-    for hit in hits:
-        name = hit.name.replace('—\t', '')
-        check_save(hit, name)
+    check_save_all([(hit, hit.name.replace('—\t', '')) for hit in hits])
 
 
 def remove_trailing_double_dash():
     hits = Hit.objects.filter(name__endswith=' --')
-    
-    for hit in hits:
-        name = hit.name[:len(hit.name)-3]
-        check_save(hit, name)
+
+    check_save_all([(hit, hit.name[:len(hit.name)-3]) for hit in hits])
+
+
+def check_save_all(renames):
+    """
+    Runs `check_save` on a list of (hit, new_name) pairs.  The new names are slugified
+    in a single batch first, so that the individual saves reuse the memoized slugs, and display
+    names are recomputed once at the end
+    """
+    lex_slugify_many([new_name for _, new_name in renames])
+
+    with deferred_display_names():
+        for hit, new_name in renames:
+            check_save(hit, new_name)
 
 
 def check_save(hit, new_name):
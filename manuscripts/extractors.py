@@ -1,22 +1,16 @@
 import os
-import re
-import copy
 
 from lxml import etree
 from django.utils.html import strip_tags
-from django.db.utils import IntegrityError
-from django.conf import settings
 from html import unescape
 
 from otcore.occurrence.loaders import ByteLoader
-from otcore.occurrence.models import Content, Location, Occurrence
-from otcore.relation.models import RelatedBasket, RelationType
-from otcore.hit.models import Hit
-from otcore.hit.processing import merge_baskets
-from otx_epub.extractors import EpubExtractor
+from otx_epub.archive import EpubFolder
 from otx_xml.extractors import XMLExtractor
 
-from .models import IndexPattern, Index
+from .models import IndexPattern
+from .patterns import compile_index_pattern, PAGE_NUMBER_START
+from .staging import IndexStaging, write_index_staging, write_pages, write_indexes, location_map
 from initial.index_ids import index_ids
 from initial.pattern_mapping import pattern_mapping
 
@@ -32,6 +26,13 @@ namespaces = {
 EXCLUDED_PAGE_IDS = ('ump-taylor02-0004' )
 
 
+def get_pattern_name(epub):
+    """
+    Name of the IndexPattern of an epub, from its decompressed folder name
+    """
+    return pattern_mapping[os.path.basename(epub.contents)]
+
+
 class IndexExtractor(XMLExtractor):
     """
     IndexExtractor is meant to be run AFTER the EpubExtractor, and passed the Epub document.
@@ -41,55 +42,65 @@ class IndexExtractor(XMLExtractor):
     default_pattern_model = IndexPattern
     default_loader = ByteLoader
 
-    def __init__(self, epub, **kwargs):
+    def __init__(self, epub, pattern=None, files=None, **kwargs):
         self.document=epub
 
-        self.locations=epub.locations.all()
+        # the epub files are read from its decompressed folder, unless an EpubArchive is passed
+        self.files = files or EpubFolder(epub.contents)
 
-        pattern = pattern_mapping[os.path.basename(epub.contents)]
+        # an unsaved epub has no locations yet; this is the case when only staging
+        self.locations=epub.locations.all() if epub.pk else []
+
+        # localid -> location id of the locations written by `create_locations`
+        self.page_locations = None
+
+        pattern_name = get_pattern_name(epub)
 
         # overrides if you want to only do part of the extraction
         self.extract_hits = kwargs.get('extract_hits', True)
         self.extract_locations = kwargs.get('extract_locations', True)
 
-        # Set properties for use later
-        self.see_rtype = RelationType.objects.get(rtype='See')
-        self.seealso_rtype = RelationType.objects.get(rtype='See Also')
-        self.subentry_rtype = RelationType.objects.get(rtype='Subentry')
+        super(IndexExtractor, self).__init__(source=epub.manifest, pattern_name=pattern_name, pattern=pattern)
+
+        # xpaths, regexes and split strings of the pattern, compiled once
+        self.compiled = compile_index_pattern(self.pattern)
 
-        super(IndexExtractor, self).__init__(source=epub.manifest, pattern_name=pattern)
+    def import_document(self):
+        self.tree = etree.fromstring(self.files.read(self.source))
 
     def create_locations(self):
         """
-        Iterates through all the html files listed in the epub manifest,
-        extract locations and content
+        Extracts locations and content from all the html files listed in the epub manifest
+        """
+        self.page_locations = write_pages(self.document, self.stage_pages())
+
+        return self.document.locations.all()
+
+    def stage_pages(self):
+        """
+        Iterates through all the html files listed in the epub manifest, and splits them
+        into pages.  Returns a list of (page_number, full_path, page_text), in reading order
         """
 
         xpath_string = '//*[@media-type="application/xhtml+xml" and not(@id="' + str(EXCLUDED_PAGE_IDS) + '")]/@href'
         xml_files = self.tree.xpath(xpath_string)
 
-        sequence_number = 1
-        locations = []
+        pages = []
 
         for xml in xml_files:
             full_path = os.path.join(self.document.oebps_folder, xml)
 
             # for versions with repeat OEBPS dirs
-            if not os.path.isfile(full_path):
+            if not self.files.isfile(full_path):
                 full_path = os.path.join(os.path.dirname(self.document.oebps_folder), xml)
 
-            with open(full_path, 'r') as f:
-                xml_as_string = f.read()
-
-            pages = self.get_pages(xml_as_string)
+            xml_as_string = self.files.read_text(full_path)
 
-            for page in pages:
-                location = self.create_location(page, full_path, sequence_number)
-                
-                sequence_number +=1
-                locations.append(location)
+            for page in self.get_pages(xml_as_string):
+                page_number, page_text = self.split_page(page)
+                pages.append((page_number, full_path, page_text))
 
-        return locations
+        return pages
 
     def get_pages(self, xml_string):
         """
@@ -99,8 +110,9 @@ class IndexExtractor(XMLExtractor):
         """
         pages = []
         i = 0
-        while i < len(self.pattern.pagenumber_pre_strings) and not pages:
-            splitter = self.pattern.pagenumber_pre_strings[i]
+        pre_strings = self.compiled.pagenumber_pre_strings
+        while i < len(pre_strings) and not pages:
+            splitter = pre_strings[i]
 
             if splitter in xml_string:
                 pages = xml_string.split(splitter)[1:]
@@ -108,10 +120,10 @@ class IndexExtractor(XMLExtractor):
 
         return pages
 
-    def create_location(self, page, full_path, sequence_number):
+    def split_page(self, page):
         """
         Expects a string of text which starts with the page number.  Then removes the page number 
-        (and the rest of the tag that contains it) and uses that to create Content and Locations.
+        (and the rest of the tag that contains it), and returns the page number and page text
         """
         number_end = page.find('"')
         tag_end = page.find('>')
@@ -123,44 +135,39 @@ class IndexExtractor(XMLExtractor):
         if open_tag_location > -1:
             page_text = page_text[:open_tag_location]
 
-        content, created = Content.objects.get_or_create(
-            content_unique_indicator='{0}-page_{1}'.format(self.document.id, page_number),
-            defaults={
-                'text': page_text,
-                'content_descriptor': 'page {}'.format(page_number)
-            }
-        )
-
-        if not created:
-            content.text += page_text
-            content.save()
-
-        location, _ = Location.objects.get_or_create(
-            localid='page_{}'.format(page_number),
-            filepath='{0}'.format(full_path),
-            document=self.document,
-            defaults = {
-                'content': content,
-                'sequence_number': sequence_number
-            }
-        )
-
-        return location
+        return page_number, page_text
 
     def create_hits(self):
-        indexes = self.get_indexes()
+        """
+        Parses the indexes into staging, then writes all of the staged hits, relations and
+        occurrences at once
+        """
+        staging = self.stage_hits()
+        write_indexes(self.document, self.pattern, self.index_paths)
+
+        if self.page_locations is None:
+            self.page_locations = location_map(self.locations)
+
+        return write_index_staging(staging, self.page_locations)
+
+    def stage_hits(self):
+        """
+        Parses every index of the epub into an IndexStaging, without touching the topic map
+        """
+        self.staging = IndexStaging()
 
-        occurrences = []
-        for index in indexes:
-            local_occurrences = self.parse_index(index)
-            occurrences.append(local_occurrences)
+        for path in self.get_indexes():
+            self.parse_index(path)
 
-        return occurrences
+        return self.staging
 
     def get_indexes(self):
+        """
+        Returns the paths of the epub's index files
+        """
         manifest_index_ids = index_ids[os.path.basename(self.document.contents)].split(',')
 
-        indexes = []
+        self.index_paths = []
         for index_id in manifest_index_ids:
             if index_id:
                 xpath_argument = "//opf:item[contains(@id,'{}')]/@href".format(index_id)
@@ -168,74 +175,112 @@ class IndexExtractor(XMLExtractor):
                 full_path = os.path.join(self.document.oebps_folder, relative_path)
 
                 # for versions with repeat OEBPS dirs
-                if not os.path.isfile(full_path):
+                if not self.files.isfile(full_path):
                     full_path = os.path.join(os.path.dirname(self.document.oebps_folder), relative_path)
 
-                index = etree.parse(full_path).getroot()
-                indexes.append(index)
+                self.index_paths.append(full_path)
 
-                Index.objects.get_or_create(
-                    epub = self.document,
-                    indexpattern = self.pattern,
-                    relative_location = full_path.split(settings.MEDIA_ROOT)[1]
-                )
+        return self.index_paths
 
-        return indexes
+    def parse_index(self, path):
+        self.pg_regex = self.compiled.pg_regex
 
-    def parse_index(self, index):
-        main_entries = index.xpath('//html:{}'.format(self.pattern.xpath_entry), namespaces=namespaces)
+        for entry, subentries in self.iter_entries(path):
+            self.process_entry(entry, subentries)
 
-        self.pg_regex = re.compile(self.pattern.separator_between_entry_and_occurrences + '["”]? [0-9vxin–—-]+$')
+    def iter_entries(self, path):
+        """
+        Streams the main entries of an index file, in document order.  Yields each main entry
+        with its separate line subentries (see `get_separate_line_subentries`), then clears
+        them from the tree, so that the index is never held in memory as a whole.
+        """
+        is_entry = self.compiled.is_entry
+        subentry_classes = self.compiled.subentry_classes
+
+        # [entry, subentries, every sibling read with the entry, whether the last one was skipped]
+        group = None
+
+        with self.files.open(path) as index:
+            for _, elem in etree.iterparse(index, events=('end',)):
+                if group is not None:
+                    entry, subentries, elements, skipped = group
+                    parent = entry.getparent()
+
+                    if elem.getparent() is parent:
+                        elem_class = elem.get('class')
+
+                        # Skip non entries
+                        if elem_class is None and not skipped:
+                            elements.append(elem)
+                            group[3] = True
+                            continue
+
+                        if elem_class is not None and elem_class in subentry_classes:
+                            subentries.append(elem)
+                            elements.append(elem)
+                            group[3] = False
+                            continue
 
-        occurrences = [] 
-       
-        for entry in main_entries:
-            local_occurrences = self.process_entry(entry)
-            occurrences += local_occurrences
+                    if elem.getparent() is parent or elem is parent or is_entry(elem):
+                        yield entry, subentries
+                        self.release_elements(elements)
+                        group = None
 
-        return occurrences
+                if is_entry(elem):
+                    group = [elem, [], [elem], False]
 
-    def process_entry(self, entry):
+            if group is not None:
+                yield group[0], group[1]
+
+    def release_elements(self, elements):
+        """
+        Clears processed elements, along with everything before them in their parent
+        """
+        for elem in elements:
+            elem.clear()
+
+        last = elements[-1]
+        parent = last.getparent()
+        while last.getprevious() is not None:
+            del parent[0]
+
+    def process_entry(self, entry, subentries=None):
         """
         Breaks an entry into its entries and subentries (if they exist)
         Then parses the entry into hits and occurrences using the appropriate pattern
+        `subentries` are the entry's separate line subentries, when they were already collected
         """
-        subentries = []
-        occurrences = []
         so_subentries = []
         if self.pattern.subentry_classes:
-            entry, subentries = self.get_separate_line_subentries(entry)
+            if subentries is None:
+                entry, subentries = self.get_separate_line_subentries(entry)
 
             # parsing second-order subentries
             if self.pattern.separator_between_subentries:
                 so_subentries = [self.get_inline_subentries(subentry) for subentry in subentries]
+        else:
+            subentries = []
 
         if self.pattern.separator_between_subentries:
             entry, inline_subentries = self.get_inline_subentries(entry)
             subentries = inline_subentries
         
         # process entry
-        hit, local_occurrences = self.parse_entry(entry, "", bool(subentries) or bool(so_subentries))
-        occurrences += local_occurrences
+        hit = self.parse_entry(entry, "", bool(subentries) or bool(so_subentries))
 
         # process subentries
         for subentry in subentries:
-            sub_hit, local_occurrences = self.parse_entry(subentry, hit, False)
-            occurrences += local_occurrences
+            self.parse_entry(subentry, hit, False)
 
         # process second-order subentries
         for sub_pair in so_subentries:
-            sub_hit, local_occurences = self.parse_entry(sub_pair[0], hit, bool(sub_pair[1]))
+            sub_hit = self.parse_entry(sub_pair[0], hit, bool(sub_pair[1]))
 
             for subentry in sub_pair[1]:
                 if self.pattern.separator_before_first_subentry in sub_pair[0].xpath('string()'):
-                    _, local_occurrences = self.parse_entry(subentry, sub_hit, False)
+                    self.parse_entry(subentry, sub_hit, False)
                 else:
-                    _, local_occurrences = self.parse_entry(subentry, hit, False)
-
-                occurrences += local_occurrences
-
-        return occurrences
+                    self.parse_entry(subentry, hit, False)
 
     def get_inline_subentries(self, entry):
         """
@@ -245,7 +290,7 @@ class IndexExtractor(XMLExtractor):
         separator = self.pattern.separator_between_subentries
         if separator and separator in entry.xpath('string()'):
             # replace xpath_seealso tags with their text equivalents
-            etree.strip_tags(entry, '{{http://www.w3.org/1999/xhtml}}{}'.format(self.pattern.xpath_seealso))
+            etree.strip_tags(entry, self.compiled.seealso_tag)
 
             elem_as_string = etree.tostring(entry, encoding="unicode")
 
@@ -262,12 +307,12 @@ class IndexExtractor(XMLExtractor):
 
             # Remove See Also strings
             see_also = ""
-            for splitter in self.pattern.see_also_split_strings:
+            for splitter in self.compiled.see_also_split_strings:
                 if splitter in stripped_elem_as_string:
                     stripped_elem_as_string, see_also = stripped_elem_as_string.split(splitter)
 
             see = ""
-            for see_splitter in self.pattern.see_split_strings:
+            for see_splitter in self.compiled.see_split_strings:
                 if see_splitter in stripped_elem_as_string:
                     stripped_elem_as_string, see = stripped_elem_as_string.split(see_splitter)
 
@@ -344,36 +389,34 @@ class IndexExtractor(XMLExtractor):
         next_entry = entry.getnext()
 
         # Skip non entries
-        if next_entry is not None and len(next_entry.xpath('@class')) == 0:
+        if next_entry is not None and next_entry.get('class') is None:
             next_entry = next_entry.getnext()
         
-        while next_entry is not None and next_entry.xpath('@class')[0] in self.pattern.subentry_classes:
+        while next_entry is not None and next_entry.get('class') in self.compiled.subentry_classes:
             subentries.append(next_entry)
             next_entry = next_entry.getnext()
 
             # skip non entries
-            if next_entry is not None and len(next_entry.xpath('@class')) == 0:
+            if next_entry is not None and next_entry.get('class') is None:
                 next_entry = next_entry.getnext()
 
         return entry, subentries
 
     def parse_entry(self, entry, main_hit, has_subentries):
         """
-        Creates an entries hit and occurrences from a given lxml node
+        Stages an entry's hit, relations and occurrences from a given lxml node.
+        `main_hit` is the name of the main entry, if the entry is a subentry.
+        Returns the name of the entry's hit
         """
-        old_entry = copy.deepcopy(entry)
         entry, pagenumbers = self.get_pagenumbers(entry)
 
         # Get the full entry text, minus pagenumbers
         # Will also include full See and See Also text
-        entry_text = entry.xpath('string()').strip()
+        entry_text = full_text = entry.xpath('string()').strip()
         
         # Gets and removes See Also text
         seealsos = []
-        patterns = list(self.pattern.see_also_split_strings) # copy to prevent altering original list
-        if self.pattern.inline_see_also_start:
-            patterns.append(self.pattern.inline_see_also_start)
-        for pattern in patterns:
+        for pattern in self.compiled.see_also_patterns:
             entry_text, seealso_set = self.split_on_pattern(
                 entry_text, 
                 pattern,
@@ -383,24 +426,25 @@ class IndexExtractor(XMLExtractor):
 
         # Gets and removes See text
         sees = []
-        patterns = list(self.pattern.see_split_strings) # copy to prevent altering original list 
-        if self.pattern.inline_see_start:
-            patterns.append(self.pattern.inline_see_start)
-        for pattern in patterns:
+        for pattern in self.compiled.see_patterns:
             entry_text, see_set = self.split_on_pattern(
                 entry_text, 
                 pattern,
                 self.pattern.separator_between_sees
             )
             sees += see_set
+
+        # Check for subentries in see text
+        if self.pattern.separator_see_subentry:
+            sees = [see.replace(self.pattern.separator_see_subentry, ' --') for see in sees]
     
         # remove lingering separator text
         entry_text = entry_text.strip()
 
         if not entry_text and not main_hit:
-            print(old_entry.xpath('string()'))
+            print(full_text, *pagenumbers)
             print("NO entry")
-            return entry_text, []
+            return entry_text
 
         subentry = ""
         if entry_text:
@@ -425,79 +469,38 @@ class IndexExtractor(XMLExtractor):
             )
 
             if main_hit:
-                entry_text = "{} -- {}".format(main_hit.name, entry_text)
+                entry_text = "{} -- {}".format(main_hit, entry_text)
 
-            # Get/Create hit
-            hit, _ = Hit.objects.get_or_create(name=entry_text)
-            hit.create_basket_if_needed()
+            hit = self.staging.add_hit(entry_text)
 
             # If the entry currently being parsed is a subentry,
             # create a relation to the main entry
             if main_hit:
-                RelatedBasket.objects.get_or_create(
-                    relationtype=self.subentry_rtype,
-                    source=main_hit.basket,
-                    destination=hit.basket
-                )
+                self.staging.add_relation('Subentry', main_hit, hit)
 
             if subentry:
-                subentry_hit, _ = Hit.objects.get_or_create(name="{} -- {}".format(entry_text, subentry))
-                subentry_hit.create_basket_if_needed()
-                RelatedBasket.objects.get_or_create(
-                    relationtype=self.subentry_rtype,
-                    source=hit.basket,
-                    destination=subentry_hit.basket
-                )
+                subentry_hit = self.staging.add_hit("{} -- {}".format(entry_text, subentry))
+                self.staging.add_relation('Subentry', hit, subentry_hit)
         else:
             # If a subentry is only a See/See Also, there won't be any given entry text
             # In those situations, treat the main_hit as the found hit
             hit = main_hit
 
-        # Get/Create all see hits, make synonym of entry
+        # Stage all see hits, make synonym of entry
         for see in sees:
-            # Check for subentry
-            if self.pattern.separator_see_subentry and self.pattern.separator_see_subentry in see:
-                see = see.replace(self.pattern.separator_see_subentry, ' --')
-            see_hit, _ = Hit.objects.get_or_create(name=see)
-            see_hit.create_basket_if_needed()
-            try:
-                RelatedBasket.objects.create(
-                   source=hit.basket,
-                    destination=see_hit.basket,
-                    relationtype=self.see_rtype
-                )
-            except IntegrityError:
-                pass
+            self.staging.add_relation('See', hit, self.staging.add_hit(see))
 
-        # Get/create all see also hits, make relation to entry basket
+        # Stage all see also hits, make relation to entry
         for seealso in seealsos:
             if seealso:
-                seealso_hit, _ = Hit.objects.get_or_create(name=seealso)
-                seealso_hit.create_basket_if_needed()
-                try:
-                    RelatedBasket.objects.create(
-                       source=hit.basket,
-                        destination=seealso_hit.basket,
-                        relationtype=self.seealso_rtype
-                    )
-                except IntegrityError:
-                    pass
-
-        # Create occurrences
-        entry_occurrences = []
-        basket_to_attach = hit.basket if not subentry else subentry_hit.basket
+                self.staging.add_relation('See Also', hit, self.staging.add_hit(seealso))
+
+        # Stage occurrences
+        hit_to_attach = hit if not subentry else subentry_hit
         for pg in pagenumbers:
-            try:
-                location = next(l for l in self.locations if l.localid == 'page_{}'.format(pg))
-            except StopIteration:
-                print("No location found at: {}".format(pg))
-            else:
-                occurrence, _ = Occurrence.objects.get_or_create(
-                    location=location, basket=basket_to_attach
-                )
-                entry_occurrences.append(occurrence)
+            self.staging.add_occurrence(hit_to_attach, pg)
 
-        return hit, entry_occurrences
+        return hit
 
     def split_on_pattern(self, text, pattern, indicator):
         """
@@ -519,21 +522,14 @@ class IndexExtractor(XMLExtractor):
         Extracts and cleans the pagenumbers from a given entry.
         Then removes the pagenumber text from the entry, for easier Hit extractions
         """
-        page_number_elements = entry.xpath(
-            './/html:{}'.format(self.pattern.xpath_occurrence_link), 
-            namespaces=namespaces
-        )
+        page_number_elements = self.compiled.occurrence_links(entry)
 
         pagenumbers = []
         for pg in page_number_elements:
-            if pg.text and re.match('[0-9vxi]', pg.text):
-                num = pg.text
-               
+            if pg.text and PAGE_NUMBER_START.match(pg.text):
                 # Strip non-numeric characters.  If it's a range or note, 
                 # only take the first number
-                num = re.split('[^0-9vxi]', num, 1)[0] 
-
-                pagenumbers.append(num)
+                pagenumbers.append(self.compiled.clean_pagenumber(pg.text))
 
             pg.getparent().remove(pg)
 
@@ -553,7 +549,7 @@ class IndexExtractor(XMLExtractor):
             numbers = results.group(0)
             has_quotes = '"' in numbers or '”' in numbers
             stripped_numbers = numbers.split(' ')[1]
-            num = re.split('[^0-9vxi]', stripped_numbers, 1)[0] 
+            num = self.compiled.clean_pagenumber(stripped_numbers)
             
             pagenumbers.append(num)
             entry_text = entry_text.split(numbers, 1)[0]
@@ -0,0 +1,232 @@
+"""
+Pipelined ingestion of a batch of epubs.
+
+Decompressing and parsing an epub and its indexes doesn't touch the database, so `stage_epub`
+runs in a pool of forked worker processes and returns an EpubStaging of plain values.  The
+parent process is the only writer: it writes each staged epub in a single transaction, in
+the order of the sources, while the workers parse the next books.
+"""
+import multiprocessing
+import os
+from collections import OrderedDict
+from functools import partial
+
+from otcore.common.utils import close_connections_before_fork
+from otcore.hit.models import Basket, deferred_display_names
+from otcore.lex.engine import get_slug_engine
+from otcore.relation.changeset import timed
+from otcore.relation.models import DirtyBasket
+from otx_epub.extractors import EpubExtractor
+from otx_epub.loaders import EpubFileLoader
+from otx_epub.models import Epub
+from initial.pattern_mapping import pattern_mapping
+
+from .extractors import IndexExtractor, get_pattern_name
+from .models import IndexPattern, Index
+from .staging import write_pages, write_indexes, write_index_staging, resolve_hits, \
+        write_relations, sync_pages, sync_occurrences, reslug_document_hits
+
+
+OS_FILES = ['.DS_Store',]
+
+
+class EpubStaging:
+    """
+    Everything parsed out of an epub: its Epub fields, its pages as
+    (page_number, full_path, page_text), the paths of its indexes and their IndexStaging.
+    `timings` holds the duration of each stage, in seconds.
+    """
+    def __init__(self, source, fields, pattern, pages, index_paths, index, timings):
+        self.source = source
+        self.fields = fields
+        self.pattern = pattern
+        self.pages = pages
+        self.index_paths = index_paths
+        self.index = index
+        self.timings = timings
+
+    @property
+    def title(self):
+        return self.fields['title']
+
+
+def epub_sources(folder):
+    """
+    Returns the paths of all the epubs in a folder and its subfolders, sorted
+    """
+    sources = []
+    for root, subdirs, files in os.walk(folder):
+        sources += [os.path.join(root, f) for f in files if f not in OS_FILES]
+
+    return sorted(sources)
+
+
+def stage_epub(source, patterns, loader=None):
+    """
+    Decompresses and parses an epub and its indexes, without touching the database.
+    `patterns` is a dict of IndexPattern name -> IndexPattern.  Pass an EpubArchiveLoader as
+    the loader to read the epub straight from its zip file.
+    """
+    timings = OrderedDict()
+
+    with timed(timings, 'load'):
+        epub_extractor = EpubExtractor(source, loader=loader)
+        epub_extractor.import_document()
+        fields = epub_extractor.document_fields()
+
+    try:
+        epub = Epub(**fields)
+        extractor = IndexExtractor(epub, pattern=patterns[get_pattern_name(epub)], files=epub_extractor.files)
+
+        with timed(timings, 'pages'):
+            extractor.import_document()
+            pages = extractor.stage_pages()
+
+        with timed(timings, 'index'):
+            index = extractor.stage_hits()
+    finally:
+        epub_extractor.files.close()
+
+    return EpubStaging(source, fields, extractor.pattern, pages, extractor.index_paths, index, timings)
+
+
+def write_epub_staging(staging):
+    """
+    Writes a staged epub in a single transaction: the Epub, its Locations and Contents, and
+    the hits, relations and occurrences of its indexes.  If the epub already exists and was
+    extracted with other stop words or recognizers, its existing hits of the staged names are
+    reslugged first.  Returns the Epub
+    """
+    fields = dict(staging.fields)
+
+    with timed(staging.timings, 'write'), deferred_display_names():
+        epub, created = Epub.objects.get_or_create(
+            author=fields.pop('author'), title=fields.pop('title'), publisher=fields.pop('publisher'),
+            defaults=fields
+        )
+
+        if not created and epub.lex_version != get_slug_engine().fingerprint:
+            reslug_document_hits(staging.index.names, epub)
+
+        locations = write_pages(epub, staging.pages)
+        write_indexes(epub, staging.pattern, staging.index_paths)
+        write_index_staging(staging.index, locations)
+
+        record_versions(epub, staging)
+
+    return epub
+
+
+def update_epub_staging(staging):
+    """
+    Writes a re-staged epub as a delta against what was extracted from it before, in a single
+    transaction.  Locations, Contents and occurrences are synced with the staging, missing
+    hits and relations are created, and baskets that were only found in the removed occurrences
+    are deleted.  Baskets with new names are queued for automatic relation processing.
+    Falls back to `write_epub_staging` for an epub that wasn't extracted yet.
+
+    If the stop words or recognizers changed since the epub was extracted, the slugs of its
+    existing hits are recomputed first (see `reslug_document_hits`).
+    """
+    epub = Epub.objects.filter(source=staging.source).first()
+    if epub is None:
+        return write_epub_staging(staging)
+
+    with timed(staging.timings, 'write'), deferred_display_names():
+        fields = {key: value for key, value in staging.fields.items() if key != 'source'}
+        Epub.objects.filter(id=epub.id).update(**fields)
+
+        locations, stale = sync_pages(epub, staging.pages)
+
+        Index.objects.filter(epub=epub).delete()
+        write_indexes(epub, staging.pattern, staging.index_paths)
+
+        changed = set()
+
+        # existing hits keep their slug in resolve_hits, so they're recomputed first
+        if epub.lex_version != get_slug_engine().fingerprint:
+            changed |= reslug_document_hits(staging.index.names, epub)
+
+        baskets = resolve_hits(staging.index.names, changed=changed)
+        write_relations(staging.index.relations, baskets)
+        stale |= sync_occurrences(staging.index.occurrences, baskets, locations, epub)
+
+        # as when deleting a Document, baskets left without any occurrence are deleted
+        Basket.objects.filter(id__in=stale - set(baskets.values()), occurs__isnull=True).delete()
+
+        DirtyBasket.objects.mark(*changed)
+        record_versions(epub, staging)
+
+    return epub
+
+
+def record_versions(epub, staging):
+    """
+    Stores the content hash, pattern version and lex version the epub was extracted with
+    """
+    epub.content_hash = staging.fields['content_hash']
+    epub.pattern_name = staging.pattern.name
+    epub.pattern_version = staging.pattern.version
+    epub.lex_version = get_slug_engine().fingerprint
+
+    Epub.objects.filter(id=epub.id).update(
+        content_hash=epub.content_hash, pattern_name=epub.pattern_name,
+        pattern_version=epub.pattern_version, lex_version=epub.lex_version
+    )
+
+
+def changed_sources(sources):
+    """
+    Returns the sources that were never extracted, or whose file, IndexPattern or lexical
+    configuration changed since they were
+    """
+    patterns = {pattern.name: pattern.version for pattern in IndexPattern.objects.all()}
+    lex_version = get_slug_engine().fingerprint
+    loader = EpubFileLoader()
+
+    epubs = {}
+    for epub in Epub.objects.filter(source__in=list(sources)):
+        epubs[epub.source.name] = epub
+
+    changed = []
+    for source in sources:
+        epub = epubs.get(source)
+        pattern_name = pattern_mapping.get(os.path.basename(loader.get_destination(source)))
+
+        if epub is None or (epub.content_hash, epub.pattern_name, epub.pattern_version, epub.lex_version) != \
+                (Epub.hash_file(source), pattern_name, patterns.get(pattern_name), lex_version):
+            changed.append(source)
+
+    return changed
+
+
+def ingest_epubs(sources, processes=None, loader=None, write=write_epub_staging):
+    """
+    Stages the epubs in a pool of `processes` workers (one per cpu by default, or none at all
+    if 0), and writes them as they come in.  Yields an (Epub, EpubStaging) pair per source,
+    in order.  See `stage_epub` for the loader.
+
+    Staged epubs are written with `write_epub_staging`, or `update_epub_staging` to only
+    apply changes to already extracted epubs.
+    """
+    patterns = {pattern.name: pattern for pattern in IndexPattern.objects.all()}
+    stage = partial(stage_epub, patterns=patterns, loader=loader)
+
+    if processes == 0:
+        for source in sources:
+            staging = stage(source)
+            yield write(staging), staging
+
+        return
+
+    # the workers don't touch the database, so they mustn't inherit the parent's connection
+    close_connections_before_fork()
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes) as pool:
+        for staging in pool.imap(stage, sources):
+            yield write(staging), staging
+
+
+def format_timings(timings):
+    return ', '.join('{} {:.2f}s'.format(stage, duration) for stage, duration in timings.items())
@@ -0,0 +1,51 @@
+import os
+import time
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from otcore.relation.processing import process_dirty_baskets
+from otx_epub.loaders import EpubArchiveLoader
+from manuscripts.ingest import ingest_epubs, epub_sources, changed_sources, update_epub_staging, format_timings
+from manuscripts.cleaning import full_clean
+
+
+class Command(BaseCommand):
+    help = ('Extracts the .epub files that are new, or whose file, IndexPattern or stop words and '
+            'recognizers changed since they were extracted, and only applies the changes. '
+            'Defaults to every file in EPUB_SOURCES_FOLDER')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='.epub files, or folders of .epub files')
+        parser.add_argument('--workers', type=int, default=None,
+            help='Number of parsing processes. Defaults to one per cpu, 0 parses in this process')
+        parser.add_argument('--from-zip', action='store_true',
+            help='Read the epubs straight from their zip files, without decompressing them')
+        parser.add_argument('--mmap', action='store_true',
+            help='Memory map the zip files. Implies --from-zip')
+        parser.add_argument('--skip-rules', action='store_true',
+            help="Don't run hit cleaning and the automatic rules for the changed topics")
+
+    def handle(self, *args, **options):
+        sources = []
+        for path in options['paths'] or [settings.EPUB_SOURCES_FOLDER]:
+            sources += epub_sources(path) if os.path.isdir(path) else [path]
+
+        changed = changed_sources(sources)
+        self.stdout.write('{} of {} epubs changed'.format(len(changed), len(sources)))
+
+        loader = None
+        if options['from_zip'] or options['mmap']:
+            loader = partial(EpubArchiveLoader, use_mmap=options['mmap'])
+
+        started = time.monotonic()
+        for epub, staging in ingest_epubs(changed, processes=options['workers'], loader=loader, write=update_epub_staging):
+            self.stdout.write('{}: {}'.format(epub.title, format_timings(staging.timings)))
+
+        self.stdout.write('Extracted {} epubs in {:.2f}s'.format(len(changed), time.monotonic() - started))
+
+        if not options['skip_rules']:
+            full_clean()
+            process_dirty_baskets()
+
+        self.stdout.write(self.style.SUCCESS('{} epubs have been successfully updated'.format(len(changed))))
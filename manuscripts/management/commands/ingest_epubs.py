@@ -0,0 +1,51 @@
+import os
+import time
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from otx_epub.loaders import EpubArchiveLoader
+from otcore.relation.processing import global_containment
+from manuscripts.ingest import ingest_epubs, epub_sources, format_timings
+from manuscripts.processing import nyu_global_multiple_tokens
+from manuscripts.cleaning import full_clean
+
+
+class Command(BaseCommand):
+    help = ('Extracts Epubs, Locations and Topics from .epub files, parsing them in a pool of '
+            'worker processes.  Defaults to every file in EPUB_SOURCES_FOLDER')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='.epub files, or folders of .epub files')
+        parser.add_argument('--workers', type=int, default=None,
+            help='Number of parsing processes. Defaults to one per cpu, 0 parses in this process')
+        parser.add_argument('--from-zip', action='store_true',
+            help='Read the epubs straight from their zip files, without decompressing them')
+        parser.add_argument('--mmap', action='store_true',
+            help='Memory map the zip files. Implies --from-zip')
+        parser.add_argument('--skip-rules', action='store_true',
+            help="Don't run hit cleaning and the automatic rules after extraction")
+
+    def handle(self, *args, **options):
+        sources = []
+        for path in options['paths'] or [settings.EPUB_SOURCES_FOLDER]:
+            sources += epub_sources(path) if os.path.isdir(path) else [path]
+
+        loader = None
+        if options['from_zip'] or options['mmap']:
+            loader = partial(EpubArchiveLoader, use_mmap=options['mmap'])
+
+        started = time.monotonic()
+        for epub, staging in ingest_epubs(sources, processes=options['workers'], loader=loader):
+            self.stdout.write('{}: {}'.format(epub.title, format_timings(staging.timings)))
+
+        self.stdout.write('Extracted {} epubs in {:.2f}s'.format(len(sources), time.monotonic() - started))
+
+        if not options['skip_rules']:
+            full_clean()
+
+            # Run automatic rules
+            global_containment()
+            nyu_global_multiple_tokens()
+
+        self.stdout.write(self.style.SUCCESS('{} epubs have been successfully extracted'.format(len(sources))))
@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 from django.db import models
@@ -73,6 +74,18 @@ class IndexPattern(models.Model):
         models.CharField(max_length=50, default='-')
     )
 
+    @property
+    def version(self):
+        """
+        Fingerprint of the pattern's parsing fields.  Changes whenever the pattern is edited
+        """
+        values = [
+            (field.attname, getattr(self, field.attname))
+            for field in self._meta.concrete_fields if field.attname not in ('id', 'description')
+        ]
+
+        return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
     def pagenumber_selector_from_location(self, location):
         return self.pagenumber_css_selector_pattern.format(location.localid.split('_')[1])
 
@@ -0,0 +1,81 @@
+import re
+
+from lxml import etree
+
+
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+
+namespaces = {'html': XHTML_NAMESPACE}
+
+# page numbers are arabic or lowercase roman numerals
+PAGE_NUMBER_START = re.compile('[0-9vxi]')
+PAGE_NUMBER_END = re.compile('[^0-9vxi]')
+
+
+class CompiledIndexPattern:
+    """
+    Compiled snapshot of an IndexPattern, for use in extraction and serialization loops.
+
+    XPaths and regexes are compiled once and list fields are frozen into tuples, so that
+    parsing an entry doesn't rebuild them.  Other attributes are read from the IndexPattern.
+    Get one through `compile_index_pattern`, which caches them by pattern name and version.
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.version = pattern.version
+
+        self.pagenumber_pre_strings = tuple(pattern.pagenumber_pre_strings)
+        self.see_split_strings = tuple(pattern.see_split_strings)
+        self.see_also_split_strings = tuple(pattern.see_also_split_strings)
+        self.subentry_classes = frozenset(pattern.subentry_classes)
+
+        # the split strings, plus the start of inline sees and see alsos, if there are any
+        self.see_patterns = self.see_split_strings + \
+                ((pattern.inline_see_start,) if pattern.inline_see_start else ())
+        self.see_also_patterns = self.see_also_split_strings + \
+                ((pattern.inline_see_also_start,) if pattern.inline_see_also_start else ())
+
+        self.seealso_tag = '{{{}}}{}'.format(XHTML_NAMESPACE, pattern.xpath_seealso)
+
+        self.is_entry = etree.XPath('self::html:{}'.format(pattern.xpath_entry), namespaces=namespaces)
+        self.occurrence_links = etree.XPath(
+            './/html:{}'.format(pattern.xpath_occurrence_link), namespaces=namespaces
+        )
+
+        # page numbers at the end of an entry, when they aren't hyperlinked
+        self.pg_regex = re.compile(pattern.separator_between_entry_and_occurrences + '["”]? [0-9vxin–—-]+$')
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(self.pattern, name)
+
+    def clean_pagenumber(self, text):
+        """
+        Strips non-numeric characters.  If it's a range or note, only takes the first number
+        """
+        return PAGE_NUMBER_END.split(text, 1)[0]
+
+    def __str__(self):
+        return self.name
+
+
+_compiled = {}
+
+
+def compile_index_pattern(pattern):
+    """
+    Returns the CompiledIndexPattern of an IndexPattern.  Compiled patterns are cached in
+    process by name and version, so an edited pattern is compiled again.
+    """
+    if isinstance(pattern, CompiledIndexPattern):
+        return pattern
+
+    key = (pattern.name, pattern.version)
+
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = _compiled[key] = CompiledIndexPattern(pattern)
+
+    return compiled
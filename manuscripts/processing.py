@@ -1,8 +1,13 @@
+from collections import defaultdict
+
 from django.db.models import Count
 
 from otcore.relation.models import RelationType, RelatedBasket
-from otcore.relation.processing import single_hit_containment, reverse_containment
-from otcore.hit.models import Hit, Basket
+from otcore.relation.processing import indexed_containment
+from otcore.relation.cache import RelationCache
+from otcore.relation.engines import MultipleTokensEngine
+from otcore.relation import parallel
+from otcore.hit.models import Hit, Basket, SlugToken
 from otcore.topic.models import Tokengroup
 from otcore.settings import otcore_settings
 
@@ -53,27 +58,25 @@ def nyu_process_single_basket(basket, run_containment=True, run_multipletokens=T
     rtypes = get_rtypes()
 
     if run_containment:
-        all_slugs = Hit.objects.order_by('slug').distinct('slug').values_list('slug', flat=True)
-        slug_sets = [(frozenset(slug.split('-')), slug) for slug in all_slugs]
-
         basket_slugs = basket.topic_hits.order_by('slug').distinct('slug').values_list('slug', flat=True)
 
         for slug in basket_slugs:
-            slug_set = (frozenset(slug.split('-')), slug)
-            longer_slugs = [s for s in slug_sets if len(slug_set[0]) < len(s[0])]
-            single_hit_containment(slug_set, longer_slugs, rtypes)
-
-            shorter_slugs = [s for s in slug_sets if len(slug_set[0]) > len(s[0])]
-            reverse_containment(slug_set, shorter_slugs, rtypes)
+            indexed_containment(slug, rtypes)
 
     if run_multipletokens:
-        hits = Hit.objects.all()
-        slug_sets = [(frozenset(hit.slug.split('-')), hit) for hit in hits if len(frozenset(hit.slug.split('-'))) >= otcore_settings.MULTIPLE_RELATIONS_COUNT]
-
+        # every pair checked involves this basket
+        cache = RelationCache.for_baskets([basket.id])
+        graph = SubentryGraph.load(rtypes)
 
         for hit in basket.topic_hits.all():
             slug_set = (frozenset(hit.slug.split('-')), hit)
-            nyu_single_set_multiple_tokens(slug_set, slug_sets, rtypes)
+
+            # only hits sharing enough tokens with this one are candidates
+            candidates = SlugToken.objects.overlaps(slug_set[0], otcore_settings.MULTIPLE_RELATIONS_COUNT)
+            hits = Hit.objects.filter(id__in=[row['hit'] for row in candidates])
+            slug_sets = [(frozenset(other.slug.split('-')), other) for other in hits]
+
+            nyu_single_set_multiple_tokens(slug_set, slug_sets, rtypes, cache=cache, graph=graph)
 
 
 def nyu_global_multiple_tokens():
@@ -82,58 +85,142 @@ def nyu_global_multiple_tokens():
     """
     rtypes = get_rtypes()
 
-    hits = Hit.objects.all()
-    slug_sets = [(frozenset(hit.slug.split('-')), hit) for hit in hits if len(frozenset(hit.slug.split('-'))) >= otcore_settings.MULTIPLE_RELATIONS_COUNT]
+    engine = MultipleTokensEngine(
+        Hit.objects.values_list('slug', 'basket_id'),
+        otcore_settings.MULTIPLE_RELATIONS_COUNT,
+        block_size=otcore_settings.MULTIPLE_TOKENS_BLOCK_SIZE
+    )
+    accept = shared_main_entry_check(rtypes)
+
+    processes = parallel.use_processes()
+    candidates = parallel.multiple_tokens_candidates(engine, processes) if processes else None
+
+    inserted = 0
+    existing = RelatedBasket.objects.existing_pairs()
+    for pairs in engine.basket_pairs(existing=existing, accept=accept, candidates=candidates):
+        inserted += RelatedBasket.objects.insert_pairs(pairs, rtypes['multipletokens'])
+
+    return inserted
+
+
+class SubentryGraph:
+    """
+    Snapshot of the Subentry relations: basket id -> ids of its main entries, and main entry
+    id -> token sets of its names.  Built once per run, so shared main entry checks don't
+    query the database.
+    """
+    def __init__(self, mains, main_tokens):
+        self.mains = mains
+        self.main_tokens = main_tokens
+        self._shared_mains = {}
+
+    @classmethod
+    def load(cls, rtypes=None):
+        if rtypes is None:
+            rtypes = get_rtypes()
+
+        mains = defaultdict(list)
+        subentry_relations = RelatedBasket.objects.filter(relationtype=rtypes['subentry'])
+        for destination_id, source_id in subentry_relations.values_list('destination_id', 'source_id'):
+            mains[destination_id].append(source_id)
+
+        main_tokens = defaultdict(list)
+        main_hits = Hit.objects.filter(basket__from_relations__relationtype=rtypes['subentry'])
+        for basket_id, slug in main_hits.values_list('basket_id', 'slug').order_by().distinct():
+            main_tokens[basket_id].append(frozenset(slug.split('-')))
+
+        return cls(dict(mains), dict(main_tokens))
+
+    def main_entries(self, basket_id):
+        return self.mains.get(basket_id, [])
+
+    def shared_main(self, basket1, basket2):
+        """
+        Returns the id of a main entry shared by both baskets, as `get_shared_main_entry` does,
+        or None
+        """
+        if (basket1, basket2) not in self._shared_mains:
+            second_mains = set(self.main_entries(basket2))
+            self._shared_mains[(basket1, basket2)] = next(
+                (main for main in self.main_entries(basket1) if main in second_mains), None
+            )
+
+        return self._shared_mains[(basket1, basket2)]
+
+    def shared_main_token_count(self, main, tokens1, tokens2):
+        """
+        Size of the largest name of the main entry contained in both token sets, or None if the
+        main entry has no such name
+        """
+        sizes = [len(tokens) for tokens in self.main_tokens.get(main, ())
+                 if tokens < tokens1 and tokens < tokens2]
 
-    while len(slug_sets) > 1:
-        nyu_single_set_multiple_tokens(slug_sets[0], slug_sets[1:], rtypes)
-        slug_sets = slug_sets[1:]
+        return max(sizes) if sizes else None
 
 
-def nyu_single_set_multiple_tokens(slug_set, slug_sets, rtypes):
+def shared_main_entry_check(rtypes=None, graph=None):
+    """
+    Builds a MultipleTokens pair check applying the shared main entry rule of
+    `nyu_single_set_multiple_tokens`: check(basket1, basket2, tokens1, tokens2, shared).
+    Candidate pairs are checked against a SubentryGraph, without querying the database.
+    """
+    if graph is None:
+        graph = SubentryGraph.load(rtypes)
+
+    def check(basket1, basket2, tokens1, tokens2, shared):
+        shared_main = graph.shared_main(basket1, basket2)
+        if shared_main is None:
+            return True
+
+        main_token_count = graph.shared_main_token_count(shared_main, tokens1, tokens2)
+
+        # No main entry name in common with both hits: skip, like nyu_single_set_multiple_tokens
+        if main_token_count is None:
+            return False
+
+        return shared > main_token_count
+
+    return check
+
+
+def nyu_single_set_multiple_tokens(slug_set, slug_sets, rtypes, cache=None, graph=None):
     """
     Check for multiple token relations on a single hit/slug_set pair.  If the two baskets share
     a common main entry, the cuttoff for multiple relations is actually:
        number-of-slugs-in-main-entry + 1
+
+    Existing relations are checked against `cache` (a RelationCache), and main entries against
+    `graph` (a SubentryGraph).  Both are loaded when needed if they aren't passed.
     """
     intersections = [s for s in slug_sets if len(s[0].intersection(slug_set[0])) >= otcore_settings.MULTIPLE_RELATIONS_COUNT]
+    hit1 = slug_set[1]
+
+    if cache is None and intersections:
+        cache = RelationCache.for_baskets([hit1.basket_id])
 
     for hit_set in intersections:
-        hit1 = slug_set[1]
         hit2 = hit_set[1]
 
-        if hit1.basket != hit2.basket and \
-                not RelatedBasket.objects.filter(source=hit1.basket, destination=hit2.basket).exists() and \
-                not RelatedBasket.objects.filter(source=hit2.basket, destination=hit1.basket).exists():
+        if hit1.basket_id != hit2.basket_id and not cache.related(hit1.basket_id, hit2.basket_id):
+            if graph is None:
+                graph = SubentryGraph.load(rtypes)
 
-            shared_main = get_shared_main_entry(hit1.basket, hit2.basket, rtypes=rtypes)
-            # print("{} | {} | {}".format(shared_main, hit1, hit2))
+            shared_main = graph.shared_main(hit1.basket_id, hit2.basket_id)
 
             # Skip creating relation if the number of shared slugs is less than main_slugs + 1
             if shared_main is not None:
-                main_tokens = [set(hit.slug.split('-')) for hit in shared_main.topic_hits.all()]
                 # get the slug of the name in common with the subentries
-                try:
-                    shared_tokens = sorted([tokens for tokens in main_tokens
-                                if tokens < slug_set[0] and tokens < hit_set[0]
-                                ], key=lambda x: len(x), reverse=True)[0]
-                except IndexError:
+                main_token_count = graph.shared_main_token_count(shared_main, slug_set[0], hit_set[0])
+
+                if main_token_count is None:
                     # means that this combination of hits aren't those shared by this topic.
                     # Move on to the next set
-                    print("SKIPPING: {} | {} | {}".format(shared_main, hit1, hit2))
                     continue
 
-
-                main_token_count = len(shared_tokens)
-
                 if len(slug_set[0].intersection(hit_set[0])) <= main_token_count:
                     continue
 
-            RelatedBasket.objects.create(
-                relationtype=rtypes['multipletokens'],
-                source=hit1.basket,
-                destination=hit2.basket
-            )
+            cache.create(hit1.basket_id, hit2.basket_id, rtypes['multipletokens'])
 
 
 def get_shared_main_entry(basket1, basket2, rtypes=None):
@@ -179,6 +266,11 @@ def delete_multiple_tokens_from_shared_subentries():
     two topics share the same main entry
     """
     rtypes = get_rtypes()
-    for relation in RelatedBasket.objects.filter(relationtype=rtypes['multipletokens']):
-        if get_shared_main_entry(relation.source, relation.destination) is not None:
-            relation.delete()
+    graph = SubentryGraph.load(rtypes)
+
+    relations = RelatedBasket.objects.filter(relationtype=rtypes['multipletokens'])
+    shared = [relation_id for relation_id, source_id, destination_id
+              in relations.values_list('id', 'source_id', 'destination_id')
+              if graph.shared_main(source_id, destination_id) is not None]
+
+    RelatedBasket.objects.filter(id__in=shared).delete()
@@ -9,6 +9,7 @@ from otcore.occurrence.models import Location, Document, Occurrence
 from otcore.occurrence.serializers import ContentSerializer, BasketSimpleSerializer, \
     LocationListSerializer, OccurrenceFromLocationSerializer, LocationFullSerializer
 from .models import Index, IndexPattern
+from .patterns import compile_index_pattern
 from initial.pattern_mapping import pattern_mapping
 
 
@@ -60,13 +61,20 @@ class PageNumberSerializer(serializers.ModelSerializer):
     def get_indexpattern(self, instance):
         """
         If an indexpattern is passed into context, return that. This is to prevent redundant lookups
-        when `many=True`. Otherwise, fetch the indexpattern from the database using the pattern_mapping dict.
+        when `many=True`. Otherwise, fetch the indexpattern from the database using the pattern_mapping dict,
+        once per pattern name.  Patterns are returned compiled.
         """
         if self.context.get('indexpattern', None) is not None:
-            return self.context['indexpattern']
+            return compile_index_pattern(self.context['indexpattern'])
         else:
             pattern_name = pattern_mapping[os.path.basename(instance.document.epub.contents)]
-            return IndexPattern.objects.get(name=pattern_name)
+
+            # the context is shared by every serializer of a list
+            patterns = self.context.setdefault('indexpatterns', {})
+            if pattern_name not in patterns:
+                patterns[pattern_name] = compile_index_pattern(IndexPattern.objects.get(name=pattern_name))
+
+            return patterns[pattern_name]
 
     class Meta:
         model = Location
@@ -0,0 +1,421 @@
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from otcore.hit.models import Hit, Basket, SlugToken, get_default_scope, baskets_bulk_created, \
+        defer_display_name, recompute_display_names
+from otcore.occurrence.models import Content, Location, Occurrence
+from otcore.relation.models import RelatedBasket, RelationType
+from otcore.lex.lex_utils import lex_slugify_many
+from otcore.lex.processing import reslug_hits
+from otcore.common.utils import bulk_update_field
+from otcore.settings import otcore_settings
+
+from .models import Index
+
+
+class IndexStaging:
+    """
+    In-memory record of what was parsed out of the indexes of a book: the hit names, in the
+    order they were found, the relations between them (by relation type name), and their
+    page references.
+
+    Only plain python values are stored, so staging can be pickled and written later,
+    with `write_index_staging`.
+    """
+    def __init__(self):
+        self.names = OrderedDict()
+        self.relations = []
+        self.occurrences = []
+
+    def add_hit(self, name):
+        self.names[name] = None
+        return name
+
+    def add_relation(self, rtype, source, destination):
+        self.relations.append((rtype, source, destination))
+
+    def add_occurrence(self, name, page):
+        self.occurrences.append((name, page))
+
+    def __len__(self):
+        return len(self.names)
+
+
+def write_pages(document, pages):
+    """
+    Creates the Contents and Locations of a document from a list of staged
+    (page_number, full_path, page_text).  A page split over several files gets a single
+    Content, with the text of each part appended.
+
+    Pages are segmented in memory, and the Contents and Locations that don't exist yet are
+    created with two batched INSERTs.  Returns a dict of location localid -> location id
+    (see `location_map`), for resolving occurrences.
+    """
+    contents, locations = segment_pages(document, pages)
+
+    existing_contents = Content.objects.filter(content_unique_indicator__in=list(contents))
+    existing_locations = {(location.localid, location.filepath): location.id for location in document.locations.all()}
+
+    content_ids = create_contents(contents, existing_contents)
+    location_ids = create_locations(document, locations, content_ids, existing_locations)
+
+    return page_locations(locations, location_ids)
+
+
+def segment_pages(document, pages):
+    """
+    Groups staged (page_number, full_path, page_text) into the Contents and Locations that
+    `write_pages` creates for them, in memory.
+
+    Returns two OrderedDicts: content_unique_indicator -> {'content_descriptor', 'text'}, and
+    (localid, filepath) -> {'sequence_number', 'content'}, where content is the indicator
+    of the location's Content.
+    """
+    contents = OrderedDict()
+    locations = OrderedDict()
+
+    for sequence_number, (page_number, full_path, page_text) in enumerate(pages, 1):
+        indicator = '{0}-page_{1}'.format(document.id, page_number)
+
+        if indicator in contents:
+            contents[indicator]['text'] += page_text
+        else:
+            contents[indicator] = {'content_descriptor': 'page {}'.format(page_number), 'text': page_text}
+
+        locations.setdefault(('page_{}'.format(page_number), full_path), {
+            'sequence_number': sequence_number,
+            'content': indicator,
+        })
+
+    return contents, locations
+
+
+def sync_pages(document, pages):
+    """
+    Brings the Contents and Locations of an already extracted document in line with its
+    staged pages, with batched statements: missing ones are created, changed ones updated,
+    and the ones that are no longer in the document deleted, along with their occurrences.
+    Returns a dict of location localid -> location id, and the ids of the baskets that lost
+    occurrences.
+    """
+    contents, locations = segment_pages(document, pages)
+
+    existing_locations = {(location.localid, location.filepath): location for location in document.locations.all()}
+    existing_contents = {
+        content.content_unique_indicator: content
+        for content in Content.objects.filter(content_unique_indicator__in=list(contents))
+    }
+
+    stale_locations = [location.id for key, location in existing_locations.items() if key not in locations]
+    stale_baskets = set(Occurrence.objects.filter(location_id__in=stale_locations).values_list('basket_id', flat=True))
+    stale_contents = Content.objects.filter(at_location__in=stale_locations) \
+        .exclude(content_unique_indicator__in=list(contents)).values_list('id', flat=True)
+
+    Content.objects.filter(id__in=list(stale_contents)).delete()
+    Location.objects.filter(id__in=stale_locations).delete()
+
+    bulk_update_field(Content.objects.all(), 'text', {
+        existing_contents[indicator].id: values['text']
+        for indicator, values in contents.items()
+        if indicator in existing_contents and existing_contents[indicator].text != values['text']
+    })
+
+    content_ids = create_contents(contents, existing_contents.values())
+
+    sequence_numbers = {}
+    location_contents = {}
+    for (localid, filepath), values in locations.items():
+        content_id = content_ids[values['content']]
+        location = existing_locations.get((localid, filepath))
+
+        if location is not None:
+            if location.sequence_number != values['sequence_number']:
+                sequence_numbers[location.id] = values['sequence_number']
+            if location.content_id != content_id:
+                location_contents[location.id] = content_id
+
+    bulk_update_field(Location.objects.all(), 'sequence_number', sequence_numbers)
+    bulk_update_field(Location.objects.all(), 'content_id', location_contents)
+
+    location_ids = create_locations(document, locations, content_ids, {
+        key: location.id for key, location in existing_locations.items()
+    })
+
+    return page_locations(locations, location_ids), stale_baskets
+
+
+def create_contents(contents, existing):
+    """
+    Creates the segmented contents (see `segment_pages`) that aren't in `existing`, with a
+    batched INSERT.  Returns a dict of content_unique_indicator -> content id
+    """
+    content_ids = {content.content_unique_indicator: content.id for content in existing}
+
+    new_contents = Content.objects.bulk_create([
+        Content(content_unique_indicator=indicator, **values)
+        for indicator, values in contents.items() if indicator not in content_ids
+    ])
+    content_ids.update((content.content_unique_indicator, content.id) for content in new_contents)
+
+    return content_ids
+
+
+def create_locations(document, locations, content_ids, existing):
+    """
+    Creates the segmented locations (see `segment_pages`) of a document that aren't in
+    `existing`, a dict of (localid, filepath) -> location id, with a batched INSERT.
+    Returns a dict of (localid, filepath) -> location id
+    """
+    location_ids = dict(existing)
+
+    new_locations = Location.objects.bulk_create([
+        Location(
+            localid=localid, filepath=filepath, document=document,
+            content_id=content_ids[values['content']], sequence_number=values['sequence_number']
+        )
+        for (localid, filepath), values in locations.items() if (localid, filepath) not in location_ids
+    ])
+    location_ids.update(((location.localid, location.filepath), location.id) for location in new_locations)
+
+    return location_ids
+
+
+def page_locations(locations, location_ids):
+    """
+    Returns a dict of localid -> location id for segmented locations, in page order.
+    As with `location_map`, the first location wins when a localid is repeated
+    """
+    localids = {}
+    for localid, filepath in locations:
+        localids.setdefault(localid, location_ids[(localid, filepath)])
+
+    return localids
+
+
+def sync_occurrences(occurrences, baskets, locations, document):
+    """
+    Brings the occurrences of an already extracted document in line with its staged occurrences.
+    Occurrences that are no longer staged are deleted and missing ones are created.
+    Returns the ids of the baskets that lost occurrences.
+    """
+    wanted = set(occurrence_pairs(occurrences, baskets, locations))
+
+    stale = {}
+    for occurrence_id, location_id, basket_id in Occurrence.objects.filter(location__document=document) \
+            .values_list('id', 'location_id', 'basket_id'):
+        if (location_id, basket_id) not in wanted:
+            stale[occurrence_id] = basket_id
+
+    Occurrence.objects.filter(id__in=list(stale)).delete()
+    write_occurrences(occurrences, baskets, locations)
+
+    return set(stale.values())
+
+
+def location_map(locations):
+    """
+    Returns a dict of localid -> location id.  The first location wins when a localid
+    is repeated
+    """
+    localids = {}
+    for location in locations:
+        localids.setdefault(location.localid, location.id)
+
+    return localids
+
+
+def write_indexes(epub, pattern, paths):
+    """
+    Records the index files an epub was parsed from
+    """
+    for path in paths:
+        Index.objects.get_or_create(
+            epub = epub,
+            indexpattern = pattern,
+            relative_location = path.split(settings.MEDIA_ROOT)[1].lstrip('/')
+        )
+
+
+def chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def reslug_document_hits(names, document, batch_size=5000):
+    """
+    Recomputes the slugs of the existing hits for the staged names, and of the hits of the
+    baskets that occur in the document, with `reslug_hits`: hits whose slug changed are moved
+    to the basket of their new equivalents.  `resolve_hits` keeps the stored slug of existing
+    hits, so this is needed when the lexical configuration changed since the document was
+    extracted.  Returns the ids of the baskets hits were moved from or to.
+    """
+    hit_ids = set()
+    for batch in chunks(names, batch_size):
+        hit_ids.update(Hit.objects.filter(name__in=batch).values_list('id', flat=True))
+
+    hit_ids.update(
+        Hit.objects.filter(basket__occurs__location__document=document).values_list('id', flat=True)
+    )
+
+    report = reslug_hits(processes=1, hits=Hit.objects.filter(id__in=list(hit_ids)))
+
+    return {
+        basket_id
+        for change in report['changed']
+        for basket_id in (change['old_basket'], change['new_basket']) if basket_id is not None
+    }
+
+
+def resolve_hits(names, changed=None, batch_size=5000):
+    """
+    Gets or creates a hit for each of the names, and attaches it to a basket the way
+    `Hit.create_basket_if_needed` would if the names were processed one at a time, in order:
+    a hit goes to the basket of the first slug-equivalent hit (by name) that has one,
+    otherwise it keeps its own basket, or gets a new one.
+
+    Existing hits and their equivalents are loaded up front, and new hits and baskets are
+    created with batched INSERTs.  Returns a dict of name -> basket id.
+    If a `changed` set is passed, the ids of the baskets whose names changed are added to it.
+    """
+    names = list(names)
+    slugs = dict(zip(names, lex_slugify_many(names)))
+    default_scope = get_default_scope()
+
+    # name -> [id, slug, scope_id, basket_id]
+    hits = {}
+    for batch in chunks(names, batch_size):
+        rows = Hit.objects.filter(name__in=batch).order_by('id') \
+            .values_list('name', 'id', 'slug', 'scope_id', 'basket_id')
+        for name, *row in rows:
+            hits.setdefault(name, row)
+
+    keys = {}
+    for name in names:
+        if name in hits:
+            keys[name] = (hits[name][1], hits[name][2])
+        else:
+            keys[name] = (slugs[name], default_scope)
+
+    # (slug, scope) -> names of the hits with a basket, ordered by name
+    equivalents = defaultdict(list)
+    baskets = {}
+    for batch in chunks({slug for slug, _ in keys.values()}, batch_size):
+        rows = Hit.objects.filter(slug__in=batch, basket__isnull=False).order_by('name') \
+            .values_list('name', 'slug', 'scope_id', 'basket_id')
+        for name, slug, scope_id, basket_id in rows:
+            equivalents[(slug, scope_id)].append(name)
+            baskets[name] = basket_id
+
+    # New baskets are stood in for by their (slug, scope) key until they are created
+    new_baskets = OrderedDict()
+    for name in names:
+        key = keys[name]
+        basket_id = next((baskets[other] for other in equivalents[key] if other != name),
+                         hits[name][3] if name in hits else None)
+
+        if basket_id is None:
+            basket_id = key
+            new_baskets[key] = '%s%s%s' % (key[0], otcore_settings.SCOPE_SEPARATOR, key[1])
+
+        if name not in baskets:
+            equivalents[key].append(name)
+        baskets[name] = basket_id
+
+    created = Basket.objects.bulk_create([Basket(label=label) for label in new_baskets.values()])
+    created_ids = dict(zip(new_baskets, [basket.id for basket in created]))
+    if created:
+        baskets_bulk_created.send(sender=Basket, baskets=created)
+
+    baskets = {name: created_ids.get(basket_id, basket_id) for name, basket_id in baskets.items()}
+
+    new_hits = Hit.objects.bulk_create([
+        Hit(name=name, slug=keys[name][0], scope_id=keys[name][1], basket_id=baskets[name])
+        for name in names if name not in hits
+    ], batch_size=batch_size)
+    SlugToken.rebuild(new_hits)
+
+    moved = {row[0]: baskets[name] for name, row in hits.items() if row[3] != baskets[name]}
+    bulk_update_field(Hit.objects.all(), 'basket_id', moved)
+
+    touched = {hit.basket_id for hit in new_hits} | set(moved.values()) \
+        | {row[3] for row in hits.values() if row[3] is not None and row[0] in moved}
+    recompute_display_names([basket_id for basket_id in touched if not defer_display_name(basket_id)])
+
+    if changed is not None:
+        changed.update(touched)
+
+    return {name: baskets[name] for name in names}
+
+
+def write_relations(relations, baskets):
+    """
+    Creates the staged relations between the baskets of their names, skipping relations
+    that already exist.  Returns the number of created relations.
+    """
+    pairs = defaultdict(OrderedDict)
+    for rtype, source, destination in relations:
+        pairs[rtype][(baskets[source], baskets[destination])] = None
+
+    rtypes = {rtype.rtype: rtype for rtype in RelationType.objects.filter(rtype__in=list(pairs))}
+
+    return sum(RelatedBasket.objects.insert_pairs(rtype_pairs, rtypes[rtype])
+               for rtype, rtype_pairs in pairs.items())
+
+
+def occurrence_pairs(occurrences, baskets, locations):
+    """
+    Returns the (location id, basket id) pairs of staged (name, page) occurrences, in order
+    and without duplicates.  `locations` is a dict of location localid -> location id.
+    """
+    pairs = OrderedDict()
+    for name, page in occurrences:
+        location_id = locations.get('page_{}'.format(page))
+
+        if location_id is None:
+            print("No location found at: {}".format(page))
+        else:
+            pairs[(location_id, baskets[name])] = None
+
+    return list(pairs)
+
+
+def write_occurrences(occurrences, baskets, locations, batch_size=5000):
+    """
+    Creates an occurrence for every staged (name, page) pair, unless the basket already
+    occurs in that location.  `locations` is a dict of location localid -> location id.
+    Returns the list of created occurrences.
+    """
+    wanted = occurrence_pairs(occurrences, baskets, locations)
+
+    location_ids = {location_id for location_id, _ in wanted}
+    existing = set()
+    order = defaultdict(int)
+    for batch in chunks(location_ids, batch_size):
+        for location_id, basket_id, position in Occurrence.objects.filter(location_id__in=batch) \
+                .values_list('location_id', 'basket_id', '_order'):
+            existing.add((location_id, basket_id))
+            order[location_id] = max(order[location_id], position + 1)
+
+    new_occurrences = []
+    for location_id, basket_id in wanted:
+        if (location_id, basket_id) not in existing:
+            new_occurrences.append(Occurrence(location_id=location_id, basket_id=basket_id, _order=order[location_id]))
+            order[location_id] += 1
+
+    return Occurrence.objects.bulk_create(new_occurrences, batch_size=batch_size)
+
+
+@transaction.atomic
+def write_index_staging(staging, locations):
+    """
+    Writes staged hits, relations and occurrences to the database in a single transaction.
+    `locations` is a dict of location localid -> location id.
+    Returns the list of created occurrences.
+    """
+    baskets = resolve_hits(staging.names)
+    write_relations(staging.relations, baskets)
+
+    return write_occurrences(staging.occurrences, baskets, locations)
@@ -1,9 +1,75 @@
-from django.test import TestCase
-
-from otcore.hit.models import Basket
-from otcore.relation.models import RelatedBasket, RelationType
+import os
+import pickle
+import shutil
+import tempfile
+import zipfile
+from functools import partial
+
+from django.test import TestCase, override_settings
+from lxml import etree
+
+from otcore.hit.models import Basket, Hit, SlugToken
+from otcore.occurrence.models import Document, Location, Occurrence
+from otcore.relation.models import RelatedBasket, RelationType, DirtyBasket
+from otcore.lex.models import Recognizer
+from otx_epub.models import Epub
+from otx_epub.archive import EpubArchive
+from otx_epub.loaders import EpubArchiveLoader
+from .extractors import IndexExtractor, namespaces
 from .processing import nyu_process_single_basket, get_main_entry, get_shared_main_entry, get_rtypes, \
-        nyu_global_multiple_tokens, delete_multiple_tokens_from_shared_subentries
+        nyu_global_multiple_tokens, delete_multiple_tokens_from_shared_subentries, SubentryGraph
+from .staging import IndexStaging, write_index_staging, write_pages
+from .ingest import ingest_epubs, stage_epub, changed_sources, update_epub_staging
+from .models import IndexPattern, Index
+from .patterns import compile_index_pattern
+
+
+EPUB_FILES = {
+    'mimetype': 'application/epub+zip',
+    'META-INF/container.xml': (
+        '<?xml version="1.0"?>'
+        '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+        '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+        '</container>'
+    ),
+    'OEBPS/content.opf': (
+        '<?xml version="1.0"?>'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        '<dc:title>Dogs and Cats</dc:title><dc:creator>A. Author</dc:creator><dc:publisher>NYU Press</dc:publisher>'
+        '</metadata>'
+        '<manifest>'
+        '<item id="ch01" href="ch01.xhtml" media-type="application/xhtml+xml"/>'
+        '<item id="ch02" href="ch02.xhtml" media-type="application/xhtml+xml"/>'
+        '<item id="index" href="index.xhtml" media-type="application/xhtml+xml"/>'
+        '</manifest>'
+        '</package>'
+    ),
+    'OEBPS/ch01.xhtml': (
+        '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+        '<p><a id="page_1"/>Dogs are loyal.</p><p><a id="page_2"/>Caring for dogs</p>'
+        '</body></html>'
+    ),
+    'OEBPS/ch02.xhtml': (
+        '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+        '<p><a id="page_2"/> and cats.</p>'
+        '</body></html>'
+    ),
+    'OEBPS/index.xhtml': (
+        '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+        '<p class="indexmain">Dogs, <a href="ch01.xhtml#page_1">1</a></p>'
+        '<p class="indexsub">care of, <a href="ch01.xhtml#page_2">2</a></p>'
+        '<p class="indexmain">Canines. See Dogs</p>'
+        '<p class="indexmain">Cats, <a href="ch02.xhtml#page_2">2</a></p>'
+        '</body></html>'
+    ),
+}
+
+
+def make_epub(path, files=EPUB_FILES):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
 
 
 class SubentryFunctionTests(TestCase):
@@ -88,6 +154,32 @@ class SubentryFunctionTests(TestCase):
 
         self.assertIsNone(target)
 
+    def test_subentry_graph(self):
+        """
+        The SubentryGraph finds the same shared main entries as `get_shared_main_entry`,
+        without querying the database
+        """
+        main_entry = Basket.create_from_string('New York')
+        first_subentry = Basket.create_from_string('New York -- Brooklyn')
+        second_subentry = Basket.create_from_string('New York -- Manhattan')
+        other = Basket.create_from_string('Mineola')
+
+        for subentry in (first_subentry, second_subentry):
+            RelatedBasket.objects.create(
+                source=main_entry, destination=subentry,
+                relationtype=self.rtypes['subentry']
+            )
+
+        graph = SubentryGraph.load(self.rtypes)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(graph.shared_main(first_subentry.id, second_subentry.id), main_entry.id)
+            self.assertIsNone(graph.shared_main(first_subentry.id, other.id))
+            self.assertEqual(graph.shared_main_token_count(
+                main_entry.id, frozenset(['new', 'york', 'brooklyn']), frozenset(['new', 'york', 'manhattan'])), 2)
+            self.assertIsNone(graph.shared_main_token_count(
+                main_entry.id, frozenset(['brooklyn']), frozenset(['new', 'york', 'manhattan'])))
+
 
 class NYUMultipleTokenTests(TestCase):
     def assertMultipleTokens(self, basket1, basket2):
@@ -225,3 +317,284 @@ class NYUMultipleTokenTests(TestCase):
 
         self.assertEqual(RelatedBasket.objects.filter(relationtype=self.rtypes['multipletokens']).count(), 3)
         self.assertNotMultipleTokens(first_subentry, second_subentry)
+
+
+class IndexStagingTests(TestCase):
+    def setUp(self):
+        self.rtypes = get_rtypes()
+        self.see = RelationType.objects.create(rtype='See', role_from='See (Origin)', role_to='See (Destination)', symmetrical=False)
+
+        document = Document.objects.create(title='Index')
+        self.locations = {
+            'page_{}'.format(page): Location.objects.create(localid='page_{}'.format(page), filepath='index.xhtml', document=document).id
+            for page in (1, 2)
+        }
+
+    def stage(self):
+        staging = IndexStaging()
+        staging.add_hit('Dogs')
+        staging.add_hit('Dogs -- care of')
+        staging.add_relation('Subentry', 'Dogs', 'Dogs -- care of')
+        staging.add_hit('Canines')
+        staging.add_relation('See', 'Dogs', 'Canines')
+        staging.add_hit('cats')
+        staging.add_occurrence('Dogs', '1')
+        staging.add_occurrence('Dogs -- care of', '2')
+        staging.add_occurrence('cats', '2')
+        staging.add_occurrence('cats', '3')
+        return staging
+
+    def test_write_index_staging(self):
+        """
+        Staged names are attached to the basket of an existing slug-equivalent hit, or to new
+        baskets, and their relations and occurrences are created once
+        """
+        cats = Hit.objects.create(name='Cats')
+        cats.create_basket_if_needed()
+
+        write_index_staging(self.stage(), self.locations)
+        write_index_staging(self.stage(), self.locations)
+
+        self.assertEqual(Hit.objects.get(name='cats').basket_id, cats.basket_id)
+        self.assertEqual(Basket.objects.count(), 4)
+        self.assertEqual(Hit.objects.count(), 5)
+
+        dogs = Hit.objects.get(name='Dogs').basket
+        self.assertEqual(dogs.display_name, 'Dogs')
+        self.assertTrue(RelatedBasket.objects.filter(source=dogs, relationtype=self.rtypes['subentry'],
+            destination__topic_hits__name='Dogs -- care of').exists())
+        self.assertTrue(RelatedBasket.objects.filter(source=dogs, relationtype=self.see,
+            destination__topic_hits__name='Canines').exists())
+        self.assertEqual(RelatedBasket.objects.count(), 2)
+
+        self.assertEqual(
+            sorted(Occurrence.objects.values_list('location__localid', 'basket__display_name', '_order')),
+            [('page_1', 'Dogs', 0), ('page_2', 'Cats', 1), ('page_2', 'Dogs -- care of', 0)]
+        )
+
+        subentry = Hit.objects.get(name='Dogs -- care of')
+        self.assertEqual(set(subentry.slug_tokens.values_list('token', flat=True)), SlugToken.tokens_for(subentry.slug))
+
+    def test_write_pages(self):
+        """
+        Pages are segmented in memory and written with a constant number of queries.
+        Split pages share a Content, and a localid maps to its first location
+        """
+        document = Document.objects.create(title='Book')
+        pages = [('1', 'ch01.xhtml', 'Dogs are loyal.'), ('2', 'ch01.xhtml', 'Caring for dogs'),
+                 ('2', 'ch02.xhtml', ' and cats.')]
+
+        with self.assertNumQueries(4):
+            locations = write_pages(document, pages)
+
+        first = Location.objects.get(document=document, localid='page_2', filepath='ch01.xhtml')
+        self.assertEqual(locations, {'page_1': Location.objects.get(document=document, localid='page_1').id,
+                                     'page_2': first.id})
+        self.assertEqual(first.content.text, 'Caring for dogs and cats.')
+        self.assertEqual(Location.objects.filter(document=document, content=first.content).count(), 2)
+        self.assertEqual(write_pages(document, pages), locations)
+        self.assertEqual(Location.objects.filter(document=document).count(), 3)
+
+
+class CompiledIndexPatternTests(TestCase):
+    fixtures = ['indexpatterns']
+
+    def test_compiled_pattern_cache(self):
+        """
+        Compiled patterns are reused until the pattern is edited
+        """
+        pattern = IndexPattern.objects.get(name='nyup1')
+        compiled = compile_index_pattern(pattern)
+
+        self.assertIs(compile_index_pattern(IndexPattern.objects.get(name='nyup1')), compiled)
+        self.assertIs(compile_index_pattern(compiled), compiled)
+        self.assertEqual(compiled.subentry_classes, frozenset(pattern.subentry_classes))
+        self.assertEqual(compiled.xpath_entry, pattern.xpath_entry)
+
+        pattern.subentry_classes = ['indexsub', 'indexsub2']
+        pattern.save()
+
+        recompiled = compile_index_pattern(pattern)
+        self.assertIsNot(recompiled, compiled)
+        self.assertEqual(recompiled.subentry_classes, {'indexsub', 'indexsub2'})
+
+    def test_compiled_pattern_pagenumbers(self):
+        compiled = compile_index_pattern(IndexPattern.objects.get(name='nyup1'))
+        entry = etree.fromstring(
+            '<p xmlns="http://www.w3.org/1999/xhtml" class="indexmain">Dogs, '
+            '<a href="ch01.xhtml#page_1">12-14</a>, <a href="ch01.xhtml#page_20">20n3</a></p>'
+        )
+
+        self.assertEqual(
+            [compiled.clean_pagenumber(link.text) for link in compiled.occurrence_links(entry)], ['12', '20']
+        )
+        self.assertTrue(compiled.is_entry(entry))
+
+
+class IngestTests(TestCase):
+    fixtures = ['indexpatterns']
+
+    def setUp(self):
+        get_rtypes()
+        RelationType.objects.create(rtype='See', role_from='See (Origin)', role_to='See (Destination)', symmetrical=False)
+        RelationType.objects.create(rtype='See Also', role_from='See Also (Origin)', role_to='See Also (Destination)', symmetrical=False)
+
+        self.media_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.media_root, 'epubs'))
+        self.source = os.path.join(self.media_root, 'epubs', '9780814706404.epub')
+        make_epub(self.source)
+
+        settings = override_settings(
+            MEDIA_ROOT=self.media_root,
+            EPUB_UPLOAD_FOLDER=os.path.join(self.media_root, 'epubs'),
+            EPUB_DECOMPRESSED_FOLDER=os.path.join(self.media_root, 'decompressed'),
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+    def assertIngested(self, epub):
+        self.assertEqual((epub.title, epub.author, epub.publisher), ('Dogs and Cats', 'A. Author', 'NYU Press'))
+        self.assertEqual(Index.objects.get(epub=epub).indexpattern.name, 'nyup1')
+
+        self.assertEqual(
+            [(location.localid, location.sequence_number, location.content.text) for location in epub.locations.all()],
+            [('page_1', 1, 'Dogs are loyal.'), ('page_2', 2, 'Caring for dogs and cats.'),
+             ('page_2', 3, 'Caring for dogs and cats.')]
+        )
+
+        self.assertEqual(
+            sorted(Occurrence.objects.values_list('location__localid', 'basket__display_name')),
+            [('page_1', 'Dogs'), ('page_2', 'Cats'), ('page_2', 'Dogs -- care of')]
+        )
+        self.assertTrue(RelatedBasket.objects.filter(relationtype__rtype='See',
+            source__display_name='Canines', destination__display_name='Dogs').exists())
+        self.assertTrue(RelatedBasket.objects.filter(relationtype__rtype='Subentry',
+            source__display_name='Dogs', destination__display_name='Dogs -- care of').exists())
+
+    def test_ingest(self):
+        """
+        A staged epub is written with its locations, hits, relations and occurrences
+        """
+        (epub, staging), = ingest_epubs([self.source], processes=0)
+
+        self.assertIngested(epub)
+        self.assertEqual(list(staging.timings), ['load', 'pages', 'index', 'write'])
+
+    def test_ingest_from_zip(self):
+        """
+        Reading the epub from its zip file gives the same result, without a decompressed copy
+        """
+        (epub, _), = ingest_epubs([self.source], processes=0, loader=partial(EpubArchiveLoader, use_mmap=True))
+
+        self.assertIngested(epub)
+        self.assertEqual(epub.contents, os.path.join(self.media_root, 'decompressed', '9780814706404'))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'decompressed')))
+
+    def test_incremental_ingest(self):
+        """
+        Only changed epubs are extracted again, and only the differences are written
+        """
+        list(ingest_epubs([self.source], processes=0))
+        self.assertEqual(changed_sources([self.source]), [])
+
+        epub = Epub.objects.get()
+        self.assertEqual((epub.content_hash, epub.pattern_name), (Epub.hash_file(self.source), 'nyup1'))
+
+        files = dict(EPUB_FILES)
+        files['OEBPS/content.opf'] = files['OEBPS/content.opf'].replace(
+            '<item id="ch02" href="ch02.xhtml" media-type="application/xhtml+xml"/>', '')
+        files['OEBPS/ch01.xhtml'] = files['OEBPS/ch01.xhtml'].replace('Dogs are loyal.', 'Dogs are very loyal.')
+        files['OEBPS/index.xhtml'] = files['OEBPS/index.xhtml'].replace(
+            '<p class="indexmain">Cats, <a href="ch02.xhtml#page_2">2</a></p>',
+            '<p class="indexmain">Birds, <a href="ch01.xhtml#page_1">1</a></p>')
+        make_epub(self.source, files)
+
+        self.assertEqual(changed_sources([self.source]), [self.source])
+        cats = Basket.objects.get(display_name='Cats')
+
+        (updated, _), = ingest_epubs([self.source], processes=0, write=update_epub_staging)
+
+        self.assertEqual(updated.id, epub.id)
+        self.assertEqual(
+            [(location.localid, location.sequence_number, location.content.text) for location in epub.locations.all()],
+            [('page_1', 1, 'Dogs are very loyal.'), ('page_2', 2, 'Caring for dogs')]
+        )
+        self.assertEqual(
+            sorted(Occurrence.objects.values_list('location__localid', 'basket__display_name')),
+            [('page_1', 'Birds'), ('page_1', 'Dogs'), ('page_2', 'Dogs -- care of')]
+        )
+        self.assertFalse(Basket.objects.filter(id=cats.id).exists())
+        self.assertEqual(list(DirtyBasket.objects.values_list('basket__display_name', flat=True)), ['Birds'])
+        self.assertEqual(Index.objects.filter(epub=epub).count(), 1)
+        self.assertEqual(changed_sources([self.source]), [])
+
+    def test_incremental_ingest_reslugs(self):
+        """
+        After a lexical change, existing hits are reslugged before the epub is written again,
+        and only then is the new lex version recorded
+        """
+        cat = Basket.create_from_string('Cat')
+        list(ingest_epubs([self.source], processes=0))
+        self.assertNotEqual(Hit.objects.get(name='Cats').basket_id, cat.id)
+
+        recognizer = Recognizer.objects.create(recognizer=r's$', replacer='')
+        # deleted rather than rolled back, so that cached recognizers are refreshed
+        self.addCleanup(recognizer.delete)
+        self.assertEqual(changed_sources([self.source]), [self.source])
+
+        (epub, _), = ingest_epubs([self.source], processes=0, write=update_epub_staging)
+
+        self.assertEqual(Hit.objects.get(name='Cats').slug, 'cat')
+        self.assertEqual(Hit.objects.get(name='Cats').basket_id, cat.id)
+        self.assertTrue(Occurrence.objects.filter(location__localid='page_2', basket=cat).exists())
+        self.assertTrue(DirtyBasket.objects.filter(basket=cat).exists())
+        self.assertEqual(changed_sources([self.source]), [])
+
+    def test_ingest_in_worker_processes(self):
+        staging = stage_epub(self.source, {pattern.name: pattern for pattern in IndexPattern.objects.all()})
+        self.assertEqual(pickle.loads(pickle.dumps(staging)).index.names, staging.index.names)
+
+        (epub, _), = ingest_epubs([self.source], processes=2)
+
+        self.assertIngested(epub)
+
+    def test_stream_index_entries(self):
+        """
+        Streaming an index groups each main entry with the same subentries as reading the whole tree
+        """
+        files = dict(EPUB_FILES)
+        files['OEBPS/index.xhtml'] = (
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body><div>'
+            '<p class="indexmain">Birds, <a href="ch01.xhtml#page_1">1</a></p>'
+            '<p class="indexsub">flight of, <a href="ch01.xhtml#page_1">1</a></p>'
+            '<br/>'
+            '<p class="indexsub">songs of, <a href="ch01.xhtml#page_2">2</a></p>'
+            '<h2 class="letter">C</h2>'
+            '<p class="indexmain">Cats, <a href="ch02.xhtml#page_2">2</a></p>'
+            '</div><div>'
+            '<p class="indexmain">Dogs, <a href="ch01.xhtml#page_1">1</a></p>'
+            '<p class="indexsub">care of, <a href="ch01.xhtml#page_2">2</a></p>'
+            '</div></body></html>'
+        )
+        make_epub(self.source, files)
+
+        folder = os.path.join(self.media_root, 'decompressed', '9780814706404')
+        epub = Epub(contents=folder, oebps_folder=os.path.join(folder, 'OEBPS'))
+        path = os.path.join(folder, 'OEBPS', 'index.xhtml')
+        text = lambda elem: elem.xpath('string()')
+
+        with EpubArchive(self.source, folder) as archive:
+            extractor = IndexExtractor(epub, pattern=IndexPattern.objects.get(name='nyup1'), files=archive)
+
+            index = archive.parse(path)
+            expected = []
+            for entry in index.xpath('//html:{}'.format(extractor.pattern.xpath_entry), namespaces=namespaces):
+                entry, subentries = extractor.get_separate_line_subentries(entry)
+                expected.append((text(entry), [text(subentry) for subentry in subentries]))
+
+            streamed = [(text(entry), [text(subentry) for subentry in subentries])
+                        for entry, subentries in extractor.iter_entries(path)]
+
+        self.assertEqual(streamed, expected)
+        self.assertEqual([len(subentries) for _, subentries in streamed], [2, 0, 1])
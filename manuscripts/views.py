@@ -13,6 +13,7 @@ from otx_epub.models import Epub
 from .serializers import EpubLocationFullSerializer, EpubDocumentSerializer, \
     EpubListSerializer, IndexSerializer, IndexPatternSerializer
 from .models import Index, IndexPattern
+from .patterns import compile_index_pattern
 from .processing import nyu_process_single_basket
 from initial.pattern_mapping import pattern_mapping
 
@@ -32,7 +33,7 @@ class EpubDocumentDetailView(DocumentDetailView):
 
         if locations:
             pattern_name = pattern_mapping[os.path.basename(locations[0].document.epub.contents)]
-            indexpattern = IndexPattern.objects.get(name=pattern_name)
+            indexpattern = compile_index_pattern(IndexPattern.objects.get(name=pattern_name))
             data = EpubLocationFullSerializer(locations, many=True, context={ 'indexpattern': indexpattern}).data
         else:
             data = []
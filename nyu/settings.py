@@ -174,4 +174,5 @@ OTCORE = {
     'INITIAL_FILE_STOPWORDS': os.path.join(BASE_DIR, 'initial', 'stopwords.txt'),
     'INITIAL_FILE_RECOGNIZERS': 'initial.recognizers',
     'BASKET_TRANSFORMER': 'common.transformers.NYUBasketTransformer',
+    'MULTIPLE_TOKENS_FILTER': 'manuscripts.processing.shared_main_entry_check',
 }
@@ -7,4 +7,5 @@ def get_otcore_apps():
         'otcore.occurrence',
         'otcore.management',
         'otcore.topic',
+        'otcore.job',
     ]
@@ -5,4 +5,6 @@ urlpatterns = [
     url(r'^relation/', include('otcore.relation.api_urls')),
     url(r'^topic/', include('otcore.topic.api_urls')),
     url(r'^occurrence/', include('otcore.occurrence.api_urls')),
+    url(r'^lex/', include('otcore.lex.api_urls')),
+    url(r'^job/', include('otcore.job.api_urls')),
 ]
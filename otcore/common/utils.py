@@ -1,6 +1,7 @@
 import importlib
 
-from django.db.models import Max, Count
+from django.db import connections
+from django.db.models import Max, Count, Case, When, Value
 
 
 def clean_duplicates(queryset, unique_fields):
@@ -22,3 +23,79 @@ def clean_duplicates(queryset, unique_fields):
             .exclude(id=duplicate['max_id'])
             .delete())
         index += 1
+
+
+def bulk_update_field(queryset, field_name, values, batch_size=1000):
+    """
+    Sets `field_name` to a different value on many rows, using one UPDATE ... CASE statement
+    per batch rather than one query per instance.
+    `values` is a dict of pk -> new value
+    """
+    output_field = queryset.model._meta.get_field(field_name)
+    items = list(values.items())
+
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+
+        queryset.filter(pk__in=[pk for pk, _ in batch]).update(**{
+            field_name: Case(
+                *[When(pk=pk, then=Value(value)) for pk, value in batch],
+                output_field=output_field
+            )
+        })
+
+
+def bulk_duplicate(queryset, field_name, value, batch_size=1000):
+    """
+    Copies every instance of the queryset with `field_name` set to `value`, using batched
+    INSERTs.  Many to many values are copied as well, and `_order` is set for models with
+    `order_with_respect_to`, as a regular save() would.
+    Returns the list of new instances.
+    """
+    model = queryset.model
+    opts = model._meta
+
+    instances = list(queryset)
+    old_ids = [instance.pk for instance in instances]
+
+    for instance in instances:
+        instance.pk = None
+        setattr(instance, field_name, value)
+
+    if opts.order_with_respect_to is not None and instances:
+        attname = opts.order_with_respect_to.attname
+        keys = {getattr(instance, attname) for instance in instances}
+
+        counts = dict(model._base_manager.filter(**{attname + '__in': keys})
+                      .values_list(attname).annotate(count=Count('pk')).order_by())
+        for instance in instances:
+            key = getattr(instance, attname)
+            instance._order = counts.get(key, 0)
+            counts[key] = instance._order + 1
+
+    model.objects.bulk_create(instances, batch_size=batch_size)
+    new_ids = {old_id: instance.pk for old_id, instance in zip(old_ids, instances)}
+
+    for field in opts.many_to_many:
+        through = field.remote_field.through
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+
+        rows = through.objects.filter(**{source + '__in': old_ids}).values_list(source + '_id', target + '_id')
+        through.objects.bulk_create([
+            through(**{source + '_id': new_ids[old_id], target + '_id': target_id})
+            for old_id, target_id in rows
+        ], batch_size=batch_size)
+
+    return instances
+
+
+def close_connections_before_fork():
+    """
+    Closes the database connections before a process pool is forked, so that workers don't
+    inherit their sockets.  Connections are reopened by the parent on their next query.
+    A connection inside an atomic block is left open, as closing it would abort the transaction;
+    workers never query the database, so they don't use it.
+    """
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
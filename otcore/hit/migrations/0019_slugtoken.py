@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 11:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def index_existing_hits(apps, schema_editor):
+    Hit = apps.get_model('hit', 'Hit')
+    SlugToken = apps.get_model('hit', 'SlugToken')
+
+    batch = []
+    for hit_id, slug in Hit.objects.values_list('id', 'slug').iterator():
+        tokens = frozenset(slug.split('-'))
+        batch += [SlugToken(token=token, hit_id=hit_id, size=len(tokens)) for token in tokens]
+
+        if len(batch) >= 5000:
+            SlugToken.objects.bulk_create(batch)
+            batch = []
+
+    SlugToken.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hit', '0018_basket_description'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlugToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(db_index=True, max_length=512)),
+                ('size', models.PositiveIntegerField()),
+                ('hit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slug_tokens', to='hit.Hit')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='slugtoken',
+            unique_together=set([('token', 'hit')]),
+        ),
+        migrations.RunPython(index_existing_hits, migrations.RunPython.noop),
+    ]
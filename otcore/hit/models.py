@@ -1,6 +1,10 @@
 import itertools
+import threading
+from contextlib import contextmanager
 
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Count, F
+from django.dispatch import Signal
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.exceptions import FieldError
@@ -20,6 +24,17 @@ def pop_from(instance):
     return instance.name
 
 
+def combination_count(n, k):
+    """
+    Number of k-combinations of n items
+    """
+    count = 1
+    for i in range(min(k, n - k)):
+        count = count * (n - i) // (i + 1)
+
+    return count if k <= n else 0
+
+
 class Scope(models.Model):
     """
     Scope is the way to disambiguate between names using the same string. 
@@ -61,20 +76,43 @@ class Basket(models.Model):
         """
         Creates token groups for the current basket.
         """
+        Basket.build_tokengroups([self.id])
+
+    @classmethod
+    def build_tokengroups(cls, basket_ids):
+        """
+        Creates token groups for a batch of baskets: every combination of
+        MULTIPLE_RELATIONS_COUNT tokens of the basket's slugs.  The combinations are
+        computed in memory, and groups and links are inserted in bulk.
+
+        Baskets with more combinations than TOKENGROUP_COMBINATION_LIMIT are skipped.
+        Returns the list of skipped basket ids.
+        """
+        count = otcore_settings.MULTIPLE_RELATIONS_COUNT
+        limit = otcore_settings.TOKENGROUP_COMBINATION_LIMIT
+
+        slugs = {basket_id: [] for basket_id in basket_ids}
+        for basket_id, slug in Hit.objects.filter(basket_id__in=list(slugs)).values_list('basket_id', 'slug'):
+            slugs[basket_id].append(slug)
 
-        slugs = '-'.join([hit.slug for hit in self.topic_hits.all()])
+        basket_groups = {}
+        skipped = []
+        for basket_id, basket_slugs in slugs.items():
+            tokens = sorted(set('-'.join(basket_slugs).split('-')))
 
-        alltokens = '-'.join(list(set(slugs.split('-'))))
-        tokens = alltokens.split('-')
+            # Only make token groups if there are more then a certain number of words in the name.
+            if len(tokens) < count:
+                continue
 
-        # Only make token groups if there are more then a certain number of words in the name.
-        if len(tokens) >= otcore_settings.MULTIPLE_RELATIONS_COUNT:
-            tokengroups = ['-'.join(sorted(list(x))) for x in itertools.combinations(tokens, otcore_settings.MULTIPLE_RELATIONS_COUNT)]
-            tokengroup_objects = []
-            for tokengroup in tokengroups:
-                tokengroup_objects.append(Tokengroup.objects.get_or_create(group=tokengroup)[0])
+            if limit is not None and combination_count(len(tokens), count) > limit:
+                skipped.append(basket_id)
+                continue
 
-            self.tokengroups.add(*tokengroup_objects)
+            basket_groups[basket_id] = ['-'.join(x) for x in itertools.combinations(tokens, count)]
+
+        Tokengroup.objects.link(basket_groups)
+
+        return skipped
 
     @property
     def related_baskets(self):
@@ -118,6 +156,9 @@ class Basket(models.Model):
     # If there is no preferred name, populates it based on the current set of names
     # to change the preferred name, always use the hit.set_preferred() function, which will update the basket
     def save(self, *args, **kwargs):
+        if self.id is not None and defer_display_name(self.id):
+            return super(Basket, self).save(*args, **kwargs)
+
         self.update_display_name(save_on_change=False)
 
         return super(Basket, self).save(*args, **kwargs)
@@ -292,7 +333,7 @@ class Hit(models.Model):
     def save(self, *args, **kwargs):
         super(Hit, self).save(*args, **kwargs)
 
-        if self.basket:
+        if self.basket_id and not defer_display_name(self.basket_id):
             self.basket.update_display_name()
 
         
@@ -307,7 +348,7 @@ def update_display_name_on_hit_delete(sender, instance, **kwargs):
     deleted
     """
     try:
-        if instance.basket:
+        if instance.basket_id and not defer_display_name(instance.basket_id):
             instance.basket.update_display_name()
     except Basket.DoesNotExist:
         pass
@@ -319,3 +360,203 @@ models.signals.post_delete.connect(
     weak=False, 
     dispatch_uid='models.update_display_name_on_hit_delete'
 )
+
+
+# Sent after baskets are created with bulk_create, which doesn't send post_save
+baskets_bulk_created = Signal(providing_args=['baskets'])
+
+
+_display_names = threading.local()
+
+
+def defer_display_name(basket_id):
+    """
+    Queues a display name recomputation if inside `deferred_display_names`.
+    Returns False if recomputation isn't deferred, and should happen right away.
+    """
+    dirty = getattr(_display_names, 'dirty', None)
+    if dirty is None:
+        return False
+
+    dirty.add(basket_id)
+    return True
+
+
+@contextmanager
+def deferred_display_names():
+    """
+    Runs the block in a transaction in which basket display names aren't recomputed on every
+    Hit or Basket save.  The affected baskets are collected, and their display names are
+    recomputed once, in bulk, before the transaction commits.
+    Nested blocks are flushed by the outermost one.
+    """
+    if getattr(_display_names, 'dirty', None) is not None:
+        yield
+        return
+
+    with transaction.atomic():
+        _display_names.dirty = set()
+        try:
+            yield
+            dirty = _display_names.dirty
+        finally:
+            _display_names.dirty = None
+
+        recompute_display_names(dirty)
+
+
+def recompute_display_names(basket_ids=None):
+    """
+    Recomputes basket display names with a single UPDATE, following the rules of
+    `Basket.update_display_name`.  Recomputes every basket if no ids are passed.
+    Returns the number of changed display names.
+    """
+    if basket_ids is not None:
+        basket_ids = list(basket_ids)
+        if not basket_ids:
+            return 0
+
+    basket_table = Basket._meta.db_table
+    hit_table = Hit._meta.db_table
+
+    sql = """
+        UPDATE {basket} SET display_name = computed.name FROM (
+            SELECT b.id, CASE
+                WHEN NOT EXISTS (SELECT 1 FROM {hit} h WHERE h.basket_id = b.id)
+                    THEN '*NO AVAILABLE NAME* - ' || b.label
+                WHEN NOT EXISTS (SELECT 1 FROM {hit} h WHERE h.basket_id = b.id AND NOT h.hidden)
+                    THEN '*NO VISIBLE NAME* - ' || b.label
+                ELSE COALESCE(
+                    (SELECT h.name FROM {hit} h WHERE h.basket_id = b.id AND h.preferred
+                     ORDER BY h.name LIMIT 1),
+                    (SELECT h.name FROM {hit} h WHERE h.basket_id = b.id AND NOT h.hidden
+                     ORDER BY char_length(h.name) DESC, h.name LIMIT 1)
+                )
+            END AS name
+            FROM {basket} b {where}
+        ) computed
+        WHERE {basket}.id = computed.id AND {basket}.display_name <> computed.name
+    """.format(basket=basket_table, hit=hit_table, where='' if basket_ids is None else 'WHERE b.id = ANY(%s)')
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [] if basket_ids is None else [basket_ids])
+        return cursor.rowcount
+
+
+class SlugTokenQuerySet(models.QuerySet):
+    """
+    Lookups on the token -> hit inverted index.  Each method returns a values queryset of
+    `hit` ids annotated with the number of `matched` tokens.  Extra hit fields can be included
+    in the values, e.g. SlugToken.objects.supersets(tokens, 'hit__slug', 'hit__basket')
+    """
+    def matching(self, tokens, *fields):
+        return (self.filter(token__in=set(tokens))
+            .values('hit', *fields)
+            .annotate(matched=Count('id'))
+            .order_by())
+
+    def supersets(self, tokens, *fields, strict=True):
+        """
+        Hits whose slug contains all of the given tokens
+        """
+        tokens = set(tokens)
+        queryset = self.filter(size__gt=len(tokens)) if strict else self
+
+        return queryset.matching(tokens, *fields).filter(matched=len(tokens))
+
+    def subsets(self, tokens, *fields, strict=True):
+        """
+        Hits whose slug tokens are all in the given tokens
+        """
+        tokens = set(tokens)
+        queryset = self.filter(size__lt=len(tokens)) if strict else self
+
+        return queryset.matching(tokens, 'size', *fields).filter(matched=F('size'))
+
+    def overlaps(self, tokens, k, *fields):
+        """
+        Hits sharing at least k tokens with the given tokens
+        """
+        return self.matching(tokens, *fields).filter(matched__gte=k)
+
+
+class SlugToken(models.Model):
+    """
+    Inverted index of slug tokens.  One row per token per hit, kept in sync when a hit is saved
+    (and deleted through the cascade).  `size` is the number of tokens in the hit's slug.
+    """
+    token = models.CharField(max_length=512, db_index=True)
+    hit = models.ForeignKey(Hit, related_name='slug_tokens', on_delete=models.CASCADE)
+    size = models.PositiveIntegerField()
+
+    objects = SlugTokenQuerySet.as_manager()
+
+    def __str__(self):
+        return self.token
+
+    class Meta:
+        unique_together = (('token', 'hit'))
+
+    @staticmethod
+    def tokens_for(slug):
+        return frozenset(slug.split('-'))
+
+    @classmethod
+    def build(cls, hits):
+        """
+        Returns unsaved SlugTokens for a list of hits
+        """
+        slug_tokens = []
+        for hit in hits:
+            tokens = cls.tokens_for(hit.slug)
+            slug_tokens += [cls(token=token, hit_id=hit.id, size=len(tokens)) for token in tokens]
+
+        return slug_tokens
+
+    @classmethod
+    def rebuild(cls, hits=None):
+        """
+        Rebuilds the index for the given hits (or for all hits) with batched inserts
+        """
+        if hits is None:
+            cls.objects.all().delete()
+            hits = Hit.objects.only('id', 'slug').iterator()
+        else:
+            hits = list(hits)
+            cls.objects.filter(hit__in=[hit.id for hit in hits]).delete()
+
+        batch = []
+        for hit in hits:
+            batch.append(hit)
+            if len(batch) >= 1000:
+                cls.objects.bulk_create(cls.build(batch))
+                batch = []
+
+        cls.objects.bulk_create(cls.build(batch))
+
+
+def sync_slug_tokens(sender, instance, created, raw=False, **kwargs):
+    """
+    Keeps the SlugToken index in sync with the slug of a saved hit
+    """
+    if raw:
+        return
+
+    tokens = SlugToken.tokens_for(instance.slug)
+
+    if not created:
+        indexed = set(SlugToken.objects.filter(hit=instance).values_list('token', flat=True))
+        if indexed == tokens:
+            return
+
+        SlugToken.objects.filter(hit=instance).delete()
+
+    SlugToken.objects.bulk_create(SlugToken.build([instance]))
+
+
+models.signals.post_save.connect(
+    sync_slug_tokens,
+    sender=Hit,
+    weak=False,
+    dispatch_uid='models.sync_slug_tokens'
+)
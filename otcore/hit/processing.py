@@ -1,15 +1,19 @@
 from django.shortcuts import render
+from django.db import transaction
 from django.db.models import Q
 from django.db.utils import IntegrityError
 
-from .models import Hit
+from .models import Hit, Basket, baskets_bulk_created, recompute_display_names
 from .serializers import BasketSerializer
 from otcore.relation.models import RelatedHit, RelatedBasket
 from otcore.relation.serializers import RelatedBasketSerializer
 from otcore.occurrence.models import Occurrence
+from otcore.topic.models import Ttype
 from otcore.settings import otcore_settings
+from otcore.common.utils import bulk_duplicate, bulk_update_field
 
 
+@transaction.atomic
 def detach(hit, old_basket, split_data):
     """
     Detach hit from basket.
@@ -45,7 +49,7 @@ def detach(hit, old_basket, split_data):
 
     # handle occurrence splits
     split_non_m2m_field(
-        old_basket.occurs.all().order_by('id').distinct('id'),
+        old_basket.occurs.all(),
         split_data['occurrences'],
         old_basket,
         new_basket,
@@ -54,7 +58,7 @@ def detach(hit, old_basket, split_data):
 
     # handle from relation splits
     split_non_m2m_field(
-        old_basket.from_relations.filter(forbidden=False).order_by('id').distinct('id'),
+        old_basket.from_relations.filter(forbidden=False),
         split_data['relations'],
         old_basket,
         new_basket,
@@ -63,7 +67,7 @@ def detach(hit, old_basket, split_data):
 
     # handle to relation splits
     split_non_m2m_field(
-        old_basket.to_relations.filter(forbidden=False).order_by('id').distinct('id'),
+        old_basket.to_relations.filter(forbidden=False),
         split_data['relations'],
         old_basket,
         new_basket,
@@ -73,7 +77,7 @@ def detach(hit, old_basket, split_data):
     # handle type split
     if split_data.get('types', None) is not None:
         split_m2m_field(
-            old_basket.types.all().order_by('id').distinct('id'),
+            old_basket.types.all(),
             split_data['types'],
             old_basket,
             new_basket,
@@ -91,113 +95,171 @@ def detach(hit, old_basket, split_data):
     return old_basket, new_basket
 
 
-def duplicate_except_one(old_instance, non_dupe_field, non_dupe_value):
+def group_split_data(field_split_data):
     """
-    Duplicates a moodel except for one field (passed as a string into
-    the non_dupe_field arg, and set to the value in non_dupe_value)
-    Returns the new model instance
+    Groups split data (a dict of instance id -> 'stay', 'move' or 'both') into lists of ids.
+    Instances with any other value are left alone
     """
-    instance = old_instance.__class__()
+    groups = {'stay': [], 'move': [], 'both': []}
+    for instance_id, split in dict(field_split_data or {}).items():
+        if split in groups:
+            groups[split].append(int(instance_id))
 
-    fields = instance._meta.get_fields()
-    local_fields = [x for x in fields if not x.many_to_many and not x.auto_created]
-    m2m_fields = [x for x in fields if x.many_to_many]
+    return groups
 
-    for field in local_fields:
-        if field.name == 'id':
-            pass
-        elif field.name == non_dupe_field:
-            setattr(instance, non_dupe_field, non_dupe_value)
-        else:
-            old_value = getattr(old_instance, field.name)
-            setattr(instance, field.name, old_value)
 
-    instance.save()
+def split_non_m2m_field(field_queryset, field_split_data, old_basket, new_basket, set_field):
+    """
+    Takes a queryset of all the instances of a related field (field_query).
+    Instances to move are pointed to the new basket with a single UPDATE, and instances
+    kept on both baskets are duplicated onto the new basket in bulk.
+    """
+    groups = group_split_data(field_split_data)
+
+    bulk_duplicate(field_queryset.filter(id__in=groups['both']), set_field, new_basket)
+    field_queryset.filter(id__in=groups['move']).update(**{set_field: new_basket})
 
-    for field in m2m_fields:
-        old_values = getattr(old_instance, field.name).all()
-        getattr(instance, field.name).add(*old_values)
 
-    return instance
+def split_m2m_field(field_queryset, field_split_data, old_basket, new_basket, set_field):
+    groups = group_split_data(field_split_data)
 
+    moved = list(field_queryset.filter(id__in=groups['move']))
+    both = list(field_queryset.filter(id__in=groups['both']))
 
-def split_non_m2m_field(field_queryset, field_split_data, old_basket, new_basket, set_field):
+    getattr(old_basket, set_field).remove(*moved)
+    getattr(new_basket, set_field).add(*(moved + both))
+
+
+def bulk_set_bypass(hit_ids, bypass_val):
     """
-    Takes a queryset of all the instances of a related field (field_query).
+    Sets the bypass attribute of many hits with set-based queries, with the same result as
+    calling `Hit.set_bypass` on each of them.
+
+    Bypassed hits are taken off their basket, and baskets left without hits are deleted.
+    Unbypassed hits are attached to the basket of a slug-equivalent hit, or to a new basket shared
+    by the unbypassed hits with the same slug.
+    Returns the ids of the baskets the hits were taken from or added to.
     """
-    for instance in field_queryset:
-        print("{0}: {1}".format(set_field, instance.id))
-        if field_split_data[str(instance.id)] == 'stay':
-            pass
-        elif field_split_data[str(instance.id)] == 'move':
-            setattr(instance, set_field, new_basket)
-            instance.save()
-        elif field_split_data[str(instance.id)] == 'both':
-            duplicate_except_one(instance, set_field, new_basket)
+    bypass_val = bool(bypass_val)
+    hits = Hit.objects.filter(id__in=hit_ids).exclude(bypass=bypass_val)
 
+    with transaction.atomic():
+        if bypass_val:
+            basket_ids = set(hits.exclude(basket=None).values_list('basket_id', flat=True))
+            hits.update(bypass=True, basket=None)
 
-def split_m2m_field(field_queryset, field_split_data, old_basket, new_basket, set_field):
-    for instance in field_queryset:
-        print("{0}: {1}".format(set_field, instance.id))
-        if field_split_data[str(instance.id)] == 'stay':
-            pass
-        elif field_split_data[str(instance.id)] == 'move':
-            getattr(old_basket, set_field).remove(instance)
-            getattr(new_basket, set_field).add(instance)
-        elif field_split_data[str(instance.id)] == 'both':
-            getattr(new_basket, set_field).add(instance)
+            Basket.objects.filter(id__in=basket_ids, topic_hits__isnull=True).delete()
+        else:
+            rows = list(hits.order_by('name').values_list('id', 'slug', 'scope_id'))
+            hits.update(bypass=False)
+
+            # the first equivalent hit with a basket, by name, decides the basket of a slug
+            targets = {}
+            equivalents = Hit.objects.filter(slug__in={slug for _, slug, _ in rows}, basket__isnull=False) \
+                .exclude(id__in=[hit_id for hit_id, _, _ in rows]).order_by('name')
+            for slug, scope_id, basket_id in equivalents.values_list('slug', 'scope_id', 'basket_id'):
+                targets.setdefault((slug, scope_id), basket_id)
+
+            labels = {}
+            for _, slug, scope_id in rows:
+                if (slug, scope_id) not in targets:
+                    labels.setdefault((slug, scope_id), '%s%s%s' % (slug, otcore_settings.SCOPE_SEPARATOR, scope_id))
+
+            new_baskets = Basket.objects.bulk_create([Basket(label=label) for label in labels.values()])
+            targets.update(zip(labels, [basket.id for basket in new_baskets]))
+            if new_baskets:
+                baskets_bulk_created.send(sender=Basket, baskets=new_baskets)
+
+            bulk_update_field(Hit.objects.all(), 'basket_id', {
+                hit_id: targets[(slug, scope_id)] for hit_id, slug, scope_id in rows
+            })
+            basket_ids = {targets[(slug, scope_id)] for _, slug, scope_id in rows}
+
+        recompute_display_names(basket_ids)
+
+    return list(basket_ids)
 
 
 def merge_baskets(basket_discarded, basket_remaining):
-    for hit in basket_discarded.topic_hits.all():
-        hit.basket = basket_remaining
-        hit.save()
-    # Types & weblinks for basket2 redirected to basket1
-    for ttype in basket_discarded.types.all():
-        basket_remaining.types.add(ttype)
-
-    # Occurrences for basket2 get redirected to basket1
-    # Unless an occurrence for that relation already exists
-    for occ in basket_discarded.occurs.all():
-        occ.basket = basket_remaining
-        occ.save()
-
-        # TODO: This seems like unecessary database hits: fix so that it just fetches the 
-        # basket remains occurrences once instead of rechecking each time
-        if Occurrence.objects.filter(basket=occ.basket, location=occ.location).count() > 1:
-            occ.delete()
-
-    # Delete relations between the merged baskets
-    RelatedBasket.objects.filter(source=basket_discarded, destination=basket_remaining).delete()
-    RelatedBasket.objects.filter(source=basket_remaining, destination=basket_discarded).delete()
-
-    relations = list(basket_discarded.from_relations.all()) + list(basket_discarded.to_relations.all())
-
-    existing_relations = [(x.source_id, x.relationtype_id) for x in basket_remaining.to_relations.all()] + [(x.destination_id, x.relationtype_id) for x in basket_remaining.from_relations.all()]
-    for relation in relations:
-        if relation.source == basket_remaining or relation.destination == basket_remaining:
-            relation.delete()
-        else:
-            if relation.source == basket_discarded:
-                if (relation.destination_id, relation.relationtype_id) not in existing_relations:
-                    relation.source = basket_remaining
-                    relation.save()
-                    existing_relations.append((relation.destination_id, relation.relationtype_id))
-                else:
-                    relation.delete()
+    """
+    Merges basket_discarded into basket_remaining, and returns basket_remaining.
+    See `merge_many_baskets`
+    """
+    return merge_many_baskets([basket_discarded], basket_remaining)
+
+
+def merge_many_baskets(baskets_discarded, basket_remaining):
+    """
+    Merges a list of baskets into basket_remaining, in a single transaction of set-based
+    statements, and returns basket_remaining.  The result is the same as merging the baskets
+    one at a time, in order.
+
+    Hits, types, occurrences and relations of the discarded baskets are moved over.  An occurrence
+    is dropped if the merged basket already has one in the same location, and a relation is
+    dropped if the merged basket already has a relation of the same type with the same basket,
+    in either direction.  Relations between the merged baskets are deleted.  The display name and
+    tokengroups of the remaining basket are recomputed once, at the end.
+    """
+    discarded_ids = [basket.id for basket in baskets_discarded if basket.id != basket_remaining.id]
+    order = {basket_id: index for index, basket_id in enumerate(discarded_ids)}
+    merged_ids = discarded_ids + [basket_remaining.id]
+
+    with transaction.atomic():
+        Hit.objects.filter(basket_id__in=discarded_ids).update(basket=basket_remaining)
+
+        # Types & weblinks for basket2 redirected to basket1
+        basket_remaining.types.add(*Ttype.objects.filter(baskets__id__in=discarded_ids).distinct())
+
+        # Occurrences get redirected to the remaining basket
+        # Unless an occurrence for that location already exists
+        locations = set(basket_remaining.occurs.values_list('location_id', flat=True))
+        occurrences = Occurrence.objects.filter(basket_id__in=discarded_ids).values_list('id', 'basket_id', 'location_id')
+
+        duplicates = []
+        for occurrence_id, basket_id, location_id in sorted(occurrences, key=lambda row: order[row[1]]):
+            if location_id in locations:
+                duplicates.append(occurrence_id)
+            else:
+                locations.add(location_id)
+
+        Occurrence.objects.filter(id__in=duplicates).delete()
+        Occurrence.objects.filter(basket_id__in=discarded_ids).update(basket=basket_remaining)
+
+        # Delete relations between the merged baskets
+        RelatedBasket.objects.filter(source_id__in=merged_ids, destination_id__in=merged_ids).delete()
+
+        existing_relations = set(basket_remaining.to_relations.values_list('source_id', 'relationtype_id')) | \
+            set(basket_remaining.from_relations.values_list('destination_id', 'relationtype_id'))
+
+        # Relations are considered basket by basket, relations from the basket before relations to it
+        relations = []
+        rows = RelatedBasket.objects.filter(Q(source_id__in=discarded_ids) | Q(destination_id__in=discarded_ids)) \
+            .values_list('id', 'source_id', 'destination_id', 'relationtype_id')
+        for relation_id, source_id, destination_id, relationtype_id in rows:
+            if source_id in order:
+                relations.append(((order[source_id], 0), relation_id, destination_id, relationtype_id))
+            else:
+                relations.append(((order[destination_id], 1), relation_id, source_id, relationtype_id))
+
+        moved_sources = []
+        moved_destinations = []
+        duplicates = []
+        for (index, direction), relation_id, other_id, relationtype_id in sorted(relations, key=lambda row: row[0]):
+            if (other_id, relationtype_id) in existing_relations:
+                duplicates.append(relation_id)
             else:
-                if (relation.source_id, relation.relationtype_id) not in existing_relations:
-                    relation.destination = basket_remaining
-                    relation.save()
-                    existing_relations.append((relation.source_id, relation.relationtype_id))
-                else:
-                    relation.delete()
+                existing_relations.add((other_id, relationtype_id))
+                (moved_sources if direction == 0 else moved_destinations).append(relation_id)
 
+        RelatedBasket.objects.filter(id__in=duplicates).delete()
+        RelatedBasket.objects.filter(id__in=moved_sources).update(source=basket_remaining)
+        RelatedBasket.objects.filter(id__in=moved_destinations).update(destination=basket_remaining)
 
-    # tokengroups are recalculated for the merged basket.
-    basket_remaining.local_tokengroup()
+        Basket.objects.filter(id__in=discarded_ids).delete()
 
-    basket_discarded.delete()
+        # tokengroups and display name are recalculated for the merged basket.
+        basket_remaining.local_tokengroup()
+        basket_remaining.update_display_name()
 
     return basket_remaining
 
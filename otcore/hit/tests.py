@@ -1,10 +1,14 @@
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from .forms import add_or_create_from_uiselect
-from .models import Hit, Basket, Scope
-from .processing import detach, merge_baskets
+from .models import Hit, Basket, Scope, SlugToken, deferred_display_names, recompute_display_names
+from .processing import detach, merge_baskets, merge_many_baskets, bulk_set_bypass, group_split_data
 from ..relation.models import RelatedHit, RelatedBasket, RelationType
 from ..occurrence.models import Occurrence, Location, Document
+from ..topic.models import Tokengroup, Ttype, tokengroup_key
 
 
 # Create your tests here.
@@ -53,6 +57,82 @@ class HitModelTests(TestCase):
         self.assertEqual(h.basket.display_name, 'New York City')
 
 
+class SlugTokenTests(TestCase):
+    def setUp(self):
+        self.ny = Hit.objects.create(name="New York")
+        self.nyc = Hit.objects.create(name="New York City")
+        self.nyu = Hit.objects.create(name="New York University Press")
+
+    def test_index_follows_hit_save_and_delete(self):
+        """
+        Tokens are rewritten when the name changes, and removed when the hit is deleted
+        """
+        self.assertEqual(set(self.ny.slug_tokens.values_list('token', flat=True)), {'new', 'york'})
+
+        self.ny.name = 'York'
+        self.ny.save()
+        self.assertEqual(list(self.ny.slug_tokens.values_list('token', 'size')), [('york', 1)])
+
+        self.ny.delete()
+        self.assertEqual(SlugToken.objects.filter(token='york').count(), 2)
+
+    def test_supersets_and_subsets(self):
+        """
+        Strict superset and subset lookups
+        """
+        supersets = {row['hit'] for row in SlugToken.objects.supersets({'new', 'york'})}
+        self.assertEqual(supersets, {self.nyc.id, self.nyu.id})
+
+        subsets = {row['hit'] for row in SlugToken.objects.subsets({'city', 'new', 'york'})}
+        self.assertEqual(subsets, {self.ny.id})
+
+    def test_overlaps(self):
+        """
+        k-token overlap lookups
+        """
+        overlaps = {row['hit'] for row in SlugToken.objects.overlaps({'new', 'york', 'press'}, 3)}
+        self.assertEqual(overlaps, {self.nyu.id})
+
+        overlaps = {row['hit'] for row in SlugToken.objects.overlaps({'new', 'york', 'press'}, 2)}
+        self.assertEqual(overlaps, {self.ny.id, self.nyc.id, self.nyu.id})
+
+
+class TokengroupTests(TestCase):
+    def test_local_tokengroup(self):
+        """
+        Every combination of 3 tokens of the basket's names becomes a group, stored once
+        """
+        basket1 = Basket.create_from_string("Crosby Stills Nash")
+        Hit.objects.create(name="Young", basket=basket1)
+        basket2 = Basket.create_from_string("Crosby Stills Nash Young")
+
+        basket1.local_tokengroup()
+        basket2.local_tokengroup()
+        basket1.local_tokengroup()
+
+        groups = set(basket1.tokengroups.values_list('group', flat=True))
+        self.assertEqual(groups, {'crosby-nash-stills', 'crosby-nash-young', 'crosby-stills-young', 'nash-stills-young'})
+        self.assertEqual(set(basket2.tokengroups.values_list('group', flat=True)), groups)
+        self.assertEqual(Tokengroup.objects.count(), 4)
+
+        tokengroup = Tokengroup.objects.get(group='crosby-nash-stills')
+        self.assertEqual(tokengroup.key, tokengroup_key('crosby-nash-stills'))
+
+    def test_combination_limit(self):
+        """
+        Baskets with too many combinations are skipped
+        """
+        basket1 = Basket.create_from_string("Crosby Stills Nash")
+        basket2 = Basket.create_from_string("Crosby Stills Nash Young")
+
+        with override_settings(OTCORE=dict(settings.OTCORE, TOKENGROUP_COMBINATION_LIMIT=3)):
+            skipped = Basket.build_tokengroups([basket1.id, basket2.id])
+
+        self.assertEqual(skipped, [basket2.id])
+        self.assertEqual(basket1.tokengroups.count(), 1)
+        self.assertEqual(basket2.tokengroups.count(), 0)
+
+
 class MergeTests(TestCase):
     def test_basic_merge(self):
         """
@@ -167,6 +247,108 @@ class MergeTests(TestCase):
 
         self.assertEqual(Occurrence.objects.count(), 1)
 
+    def merge_fixture(self, city, size):
+        """
+        Merges two baskets of a city, with `size` extra hits and `size` occurrences, some of
+        them shared, and relations to a third basket.  Returns the merged basket and the
+        number of queries the merge took
+        """
+        document = Document.objects.get_or_create(title="Map")[0]
+        main = Basket.create_from_string(city)
+        other = Basket.create_from_string('{} City'.format(city))
+        state = Basket.create_from_string('{} State'.format(city))
+
+        for index in range(size):
+            Hit.objects.create(name='{} alias {}'.format(city, index), basket=other)
+
+            location = Location.objects.create(document=document, localid='{}{}'.format(city, index), filepath=city)
+            Occurrence.objects.create(basket=other, location=location)
+            if index % 2:
+                Occurrence.objects.create(basket=main, location=location)
+
+        RelatedBasket.objects.create(source=other, destination=state)
+        RelatedBasket.objects.create(source=state, destination=main)
+
+        main.display_name = ''
+        main.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            merged = merge_baskets(other, main)
+
+        self.assertEqual(merged.topic_hits.count(), size + 2)
+        self.assertEqual(merged.occurs.count(), size)
+        self.assertEqual(RelatedBasket.objects.filter(source=state).count(), 1)
+        self.assertNotEqual(Basket.objects.get(id=main.id).display_name, '')
+
+        return merged, len(queries)
+
+    def test_merge_is_set_based(self):
+        """
+        The number of queries doesn't grow with the number of hits, occurrences and relations,
+        and the display name of the merged basket is recomputed
+        """
+        # both merged baskets stay under TOKENGROUP_COMBINATION_LIMIT, so both get tokengroups
+        _, small = self.merge_fixture('Boston', 3)
+        _, large = self.merge_fixture('Denver', 12)
+
+        self.assertEqual(small, large)
+
+
+class MergeManyTests(TestCase):
+    def build(self):
+        """
+        Four baskets to merge, sharing locations and relations with each other and with
+        outside baskets
+        """
+        Basket.objects.all().delete()
+        Location.objects.all().delete()
+
+        document = Document.objects.get_or_create(title="Map")[0]
+        locations = [Location.objects.create(document=document, localid=str(i), filepath=str(i)) for i in range(4)]
+        rtype = RelationType.objects.get_or_create(rtype='SeeAlso')[0]
+
+        merged = [Basket.create_from_string(name) for name in ('New York', 'NYC', 'Big Apple', 'Gotham')]
+        state, country = Basket.create_from_string('New York State'), Basket.create_from_string('United States')
+
+        for index, basket in enumerate(merged):
+            Occurrence.objects.create(basket=basket, location=locations[index % 3])
+            Occurrence.objects.create(basket=basket, location=locations[3])
+
+        RelatedBasket.objects.create(source=merged[1], destination=state)
+        RelatedBasket.objects.create(source=state, destination=merged[2], forbidden=True)
+        RelatedBasket.objects.create(source=merged[3], destination=state, relationtype=rtype)
+        RelatedBasket.objects.create(source=country, destination=merged[3])
+        RelatedBasket.objects.create(source=merged[1], destination=merged[2])
+        RelatedBasket.objects.create(source=merged[0], destination=merged[3])
+
+        return merged
+
+    def snapshot(self):
+        return {
+            'hits': set(Hit.objects.values_list('name', 'basket__label')),
+            'occurrences': sorted(Occurrence.objects.values_list('basket__label', 'location__localid')),
+            'relations': set(RelatedBasket.objects.values_list(
+                'source__label', 'destination__label', 'relationtype__rtype', 'forbidden')),
+        }
+
+    def test_matches_sequential_merges(self):
+        """
+        Merging several baskets at once gives the same result as merging them one at a time
+        """
+        merged = self.build()
+        remaining = merged.pop()
+        for basket in merged:
+            remaining = merge_baskets(basket, remaining)
+        sequential = self.snapshot()
+
+        merged = self.build()
+        remaining = merged.pop()
+        merge_many_baskets(merged, remaining)
+
+        self.assertEqual(self.snapshot(), sequential)
+        self.assertEqual(len(sequential['occurrences']), 4)
+        self.assertEqual(len(sequential['relations']), 3)
+
 
 class DetachTests(TestCase):
     def setUp(self):
@@ -254,6 +436,51 @@ class DetachTests(TestCase):
         self.assertEqual(Hit.objects.count(), 2)
         self.assertEqual(Basket.objects.count(), 2)
 
+    def test_split_data(self):
+        """
+        Occurrences, relations and types are kept, moved or copied to the new basket
+        """
+        document = Document.objects.create(title="Map")
+        locations = [Location.objects.create(document=document, localid=str(i), filepath=str(i)) for i in range(3)]
+        rtype = RelationType.objects.create(rtype='SeeAlso')
+        ttypes = [Ttype.objects.create(ttype=name) for name in ('Place', 'City')]
+
+        ny = Basket.create_from_string('New York')
+        nyc = Hit.objects.create(name='New York City', basket=ny)
+        state = Basket.create_from_string('New York State')
+        ny.types.add(*ttypes)
+
+        occurrences = [Occurrence.objects.create(basket=ny, location=location) for location in locations]
+        moved = RelatedBasket.objects.create(source=ny, destination=state)
+        copied = RelatedBasket.objects.create(source=state, destination=ny, relationtype=rtype)
+
+        split_data = {
+            'occurrences': {str(occurrences[0].id): 'stay', str(occurrences[1].id): 'move', str(occurrences[2].id): 'both'},
+            'relations': {str(moved.id): 'move', str(copied.id): 'both'},
+            'types': {str(ttypes[0].id): 'move', str(ttypes[1].id): 'both'},
+        }
+        old_basket, new_basket = detach(nyc, ny, split_data)
+
+        self.assertEqual(set(old_basket.occurs.values_list('location_id', flat=True)), {locations[0].id, locations[2].id})
+        self.assertEqual(set(new_basket.occurs.values_list('location_id', flat=True)), {locations[1].id, locations[2].id})
+        self.assertEqual(list(locations[2].occurrences.values_list('_order', flat=True)), [0, 1])
+
+        self.assertEqual(RelatedBasket.objects.get(id=moved.id).source, new_basket)
+        self.assertTrue(RelatedBasket.objects.filter(source=state, destination=old_basket, relationtype=rtype).exists())
+        self.assertTrue(RelatedBasket.objects.filter(source=state, destination=new_basket, relationtype=rtype).exists())
+
+        self.assertEqual(list(old_basket.types.all()), [ttypes[1]])
+        self.assertEqual(set(new_basket.types.all()), set(ttypes))
+
+    def test_unknown_split_values(self):
+        """
+        Instances with a split value other than stay, move or both are left alone
+        """
+        self.assertEqual(
+            group_split_data({'1': 'stay', '2': 'move', '3': 'somewhere', '4': 'both'}),
+            {'stay': [1], 'move': [2], 'both': [4]}
+        )
+
 
 class BasketModelTests(TestCase):
     def test_empty_basket_display_name(self):
@@ -319,6 +546,91 @@ class BasketModelTests(TestCase):
             Basket.create_from_string('new york')
 
 
+class BulkBypassTests(TestCase):
+    def build(self):
+        Basket.objects.all().delete()
+        Hit.objects.all().delete()
+
+        ny = Basket.create_from_string('New York')
+        Hit.objects.create(name='NYC', basket=ny)
+        Basket.create_from_string('Table 1')
+        Basket.create_from_string('Table 2')
+
+        for name in ('new york', 'NEW YORK', 'Figure 3', 'figure 3', 'Figure 4'):
+            Hit.objects.create(name=name, bypass=True)
+
+        return list(Hit.objects.values_list('id', flat=True))
+
+    def snapshot(self):
+        hits = Hit.objects.values_list('name', 'bypass', 'basket__label', 'basket__display_name')
+        return set(hits), Basket.objects.count()
+
+    def test_matches_set_bypass(self):
+        """
+        Bulk bypass and unbypass give the same result as calling `set_bypass` on each hit
+        """
+        hit_ids = self.build()
+        for hit in Hit.objects.filter(id__in=hit_ids):
+            hit.set_bypass(not hit.bypass)
+        sequential = self.snapshot()
+
+        hit_ids = self.build()
+        bypassed = list(Hit.objects.filter(bypass=True).values_list('id', flat=True))
+        bulk_set_bypass([hit_id for hit_id in hit_ids if hit_id not in bypassed], True)
+        bulk_set_bypass(bypassed, False)
+
+        self.assertEqual(self.snapshot(), sequential)
+        self.assertEqual(sequential[1], 3)
+
+
+class DisplayNameTests(TestCase):
+    def test_deferred_display_names(self):
+        """
+        Display names are recomputed once, when the block exits
+        """
+        basket = Basket.create_from_string('New York')
+
+        with deferred_display_names():
+            Hit.objects.create(name='New York City', basket=basket)
+            Hit.objects.create(name='Big Apple', basket=basket, preferred=True)
+            other = Basket.create_from_string('Gotham')
+            Hit.objects.filter(basket=other).delete()
+
+            self.assertEqual(Basket.objects.get(id=basket.id).display_name, 'New York')
+
+        self.assertEqual(Basket.objects.get(id=basket.id).display_name, 'Big Apple')
+        self.assertEqual(Basket.objects.get(id=other.id).display_name, '*NO AVAILABLE NAME* - {}'.format(other.label))
+
+    def test_recompute_matches_update_display_name(self):
+        """
+        The bulk recompute follows the same rules as `update_display_name`
+        """
+        longest = Basket.create_from_string('New York')
+        Hit.objects.create(name='New York City', basket=longest)
+        Hit.objects.create(name='The Big Apple of NY', basket=longest, hidden=True)
+
+        preferred = Basket.create_from_string('Gotham')
+        Hit.objects.create(name='Gotham City', basket=preferred, preferred=True)
+
+        hidden = Basket.create_from_string('Manhattan')
+        Hit.objects.filter(basket=hidden).update(hidden=True)
+
+        empty = Basket.create_from_string('Brooklyn')
+        Hit.objects.filter(basket=empty).update(basket=None)
+
+        expected = {}
+        for basket in Basket.objects.all():
+            basket.update_display_name(save_on_change=False)
+            expected[basket.id] = basket.display_name
+
+        Basket.objects.update(display_name='')
+        self.assertEqual(recompute_display_names(), 4)
+
+        self.assertEqual(dict(Basket.objects.values_list('id', 'display_name')), expected)
+        self.assertEqual(expected[longest.id], 'New York City')
+        self.assertEqual(expected[preferred.id], 'Gotham City')
+
+
 class HitFormTests(TestCase):
     def test_add_or_create_ui_select_new(self):
         """
@@ -13,8 +13,8 @@ from .forms import add_or_create_from_uiselect
 from .models import Hit, Basket, Scope
 from .serializers import *
 from otcore.settings import otcore_settings
-from .processing import merge_baskets, detach
-from otcore.relation.models import RelatedBasket
+from .processing import merge_baskets, merge_many_baskets, detach, bulk_set_bypass
+from otcore.relation.models import RelatedBasket, DirtyBasket
 from otcore.relation.serializers import RelatedBasketSerializer
 from otcore.occurrence.models import Occurrence
 from otcore.lex.lex_utils import lex_slugify
@@ -133,6 +133,9 @@ class HitChangeView(APIView):
         hit.save()
         hit.basket.save() # basket save forces display name to recalculate display_name
 
+        if name_changed:
+            DirtyBasket.objects.mark(hit.basket)
+
         return Response(HitSerializer(hit).data)
 
 
@@ -187,6 +190,7 @@ class BasketMergeView(APIView):
         basket_remaining = Basket.objects.get(id=request.data['basket_remaining_id'])
 
         merged_basket = merge_baskets(basket_discarded, basket_remaining)
+        DirtyBasket.objects.mark(basket_remaining)
 
         transformer = otcore_settings.BASKET_TRANSFORMER
         data = transformer(merged_basket).data
@@ -203,15 +207,18 @@ class BulkMergeByHitView(APIView):
     def patch(self, request, *args, **kwargs):
         hit_ids = self.request.data.get('hit_ids', [])
 
-        hits = list(Hit.objects.filter(id__in=hit_ids))
+        hits = list(Hit.objects.filter(id__in=hit_ids).select_related('basket'))
         basket = hits.pop().basket
 
+        # hits already on the merged basket are skipped
+        baskets = []
         for hit in hits:
-            # skip if the hit is already on the merged basket
-            if hit.basket == basket:
-                continue
+            if hit.basket not in baskets:
+                baskets.append(hit.basket)
+
+        basket = merge_many_baskets(baskets, basket)
 
-            basket = merge_baskets(hit.basket, basket)
+        DirtyBasket.objects.mark(basket)
 
         return Response({"basket": basket.id})
 
@@ -317,6 +324,7 @@ class AddHit_Main(APIView):
                     hit = Hit.objects.create(name=newHitName, basket=basket)
 
                 hit.save()
+                DirtyBasket.objects.mark(basket)
                 return Response({'editorialAction': 'addHit',
                                  'hit': HitSerializer(hit).data,})
 
@@ -330,6 +338,7 @@ class AddHit_Main(APIView):
         else:
             hit = Hit.objects.create(name=newHitName, basket=basket)
             hit.save()
+            DirtyBasket.objects.mark(basket)
             return Response({'editorialAction': 'addHit',
                              'hit': HitSerializer(hit).data,})
 
@@ -418,7 +427,8 @@ class DetachView(APIView):
         old_basket = Basket.objects.get(id=request.data['basket_id'])
         hit = Hit.objects.get(id=request.data['hit_id'])
 
-        corrected_old_basket, _ = detach(hit, old_basket, request.data['split_data'])
+        corrected_old_basket, new_basket = detach(hit, old_basket, request.data['split_data'])
+        DirtyBasket.objects.mark(corrected_old_basket, new_basket)
 
         transformer = otcore_settings.BASKET_TRANSFORMER
         data = transformer(corrected_old_basket).data
@@ -449,14 +459,17 @@ class SetHitBypassView(generics.UpdateAPIView):
         hit = self.get_object()
 
         bypass_val = request.data.get('bypass_val', None)
+        old_basket_id = hit.basket_id
         hit.set_bypass(bypass_val)
 
+        DirtyBasket.objects.mark(old_basket_id, hit.basket_id)
+
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 class BaseBulkBypassView(APIView):
     """
-    Sets the bypass of a list of hits to bypass_val by calling set_bypass
+    Sets the bypass of a list of hits to bypass_val with bulk_set_bypass
     Expects to recieve a `hits` patch data object, with a list of hit ids to be bypassed
     """
     bypass_val = None
@@ -469,10 +482,9 @@ class BaseBulkBypassView(APIView):
 
         hit_ids = request.data.get('hits', [])
 
-        hits = Hit.objects.filter(id__in=hit_ids)
+        basket_ids = bulk_set_bypass(hit_ids, self.bypass_val)
 
-        for hit in hits:
-            hit.set_bypass(self.bypass_val)
+        DirtyBasket.objects.mark(*basket_ids)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -0,0 +1,9 @@
+from django.conf.urls import url
+from . import views
+
+
+urlpatterns = [
+    url(r'^all/$', views.JobListView.as_view()),
+    url(r'^(?P<pk>\d+)/$', views.JobDetailView.as_view()),
+    url(r'^(?P<pk>\d+)/cancel/$', views.JobCancelView.as_view()),
+]
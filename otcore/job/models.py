@@ -0,0 +1,132 @@
+import time
+
+from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.utils import timezone
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a running task when its job has been cancelled
+    """
+    pass
+
+
+class JobQuerySet(models.QuerySet):
+    def enqueue(self, task, **kwargs):
+        """
+        Queues a task for the job worker.  `task` is the dotted path to a function
+        accepting the job as its first argument; kwargs must be JSON serializable
+        """
+        return self.create(task=task, kwargs=kwargs)
+
+
+class Job(models.Model):
+    """
+    A long running task, queued in the database and run by the `run_job_worker` command.
+    Tasks report their progress through `set_stage` and `advance`, which also stop the task
+    if the job has been cancelled.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    STATUSES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+
+    task = models.CharField(max_length=255)
+    kwargs = JSONField(default=dict, blank=True)
+
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED, db_index=True)
+    cancel_requested = models.BooleanField(default=False)
+
+    stage = models.CharField(max_length=100, blank=True)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    timings = JSONField(default=dict, blank=True)
+
+    result = JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    objects = JobQuerySet.as_manager()
+
+    PROGRESS_INTERVAL = 1
+
+    def __str__(self):
+        return '{} ({})'.format(self.task, self.status)
+
+    class Meta:
+        ordering = ('-created', )
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED, self.CANCELLED)
+
+    def set_stage(self, stage, total=None):
+        """
+        Starts a new stage of the task.  The time spent on the previous stage is
+        recorded in `timings`
+        """
+        self.end_stage()
+
+        self.stage = stage
+        self.progress = 0
+        self.total = total
+        self._stage_started = time.monotonic()
+
+        self.update_fields('stage', 'progress', 'total', 'timings')
+
+    def end_stage(self):
+        started = getattr(self, '_stage_started', None)
+        if self.stage and started is not None:
+            self.timings[self.stage] = round(time.monotonic() - started, 3)
+
+        self._stage_started = None
+
+    def advance(self, count=1):
+        """
+        Increments the progress counter of the current stage.  The counter is written
+        at most once per PROGRESS_INTERVAL seconds, and when the stage completes
+        """
+        self.progress += count
+
+        now = time.monotonic()
+        last_write = getattr(self, '_progress_written', None)
+
+        if last_write is None or now - last_write >= self.PROGRESS_INTERVAL or self.progress == self.total:
+            self._progress_written = now
+            self.update_fields('progress')
+
+    def update_fields(self, *fields):
+        """
+        Writes the given fields, then raises JobCancelled if the job was cancelled
+        """
+        Job.objects.filter(id=self.id).update(**{field: getattr(self, field) for field in fields})
+
+        if Job.objects.filter(id=self.id, cancel_requested=True).exists():
+            raise JobCancelled()
+
+    def cancel(self):
+        """
+        Cancels a queued job immediately.  A running job is flagged, and stops
+        at its next progress update
+        """
+        if Job.objects.filter(id=self.id, status=self.QUEUED).update(
+                status=self.CANCELLED, cancel_requested=True, finished=timezone.now()):
+            self.status = self.CANCELLED
+        elif not self.is_finished:
+            Job.objects.filter(id=self.id).update(cancel_requested=True)
+
+        self.cancel_requested = True
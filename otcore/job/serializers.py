@@ -0,0 +1,10 @@
+from rest_framework import serializers
+
+from .models import Job
+
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = ('id', 'task', 'status', 'cancel_requested', 'stage', 'progress', 'total',
+                  'timings', 'result', 'error', 'created', 'started', 'finished')
@@ -0,0 +1,92 @@
+from django.test import TestCase
+
+from otcore.hit.models import Basket
+from otcore.relation.models import RelatedBasket
+from .models import Job
+from .worker import claim_next_job, run_job
+
+
+def counting_task(job, count):
+    job.set_stage('counting', total=count)
+    for _ in range(count):
+        job.advance()
+
+    return {'counted': count}
+
+
+def failing_task(job):
+    job.set_stage('failing')
+    raise ValueError('Something went wrong')
+
+
+def cancelling_task(job):
+    Job.objects.filter(id=job.id).update(cancel_requested=True)
+    job.set_stage('after cancel')
+
+
+class JobTests(TestCase):
+    def run_queued_jobs(self):
+        """
+        Same as `run_worker(once=True)`, without closing the test database connection
+        """
+        job = claim_next_job()
+        while job is not None:
+            run_job(job)
+            job = claim_next_job()
+
+    def test_job_runs_and_records_progress(self):
+        """
+        The worker runs queued jobs in order, and records stage, progress, timings and result
+        """
+        job = Job.objects.enqueue('otcore.job.tests.counting_task', count=3)
+
+        self.run_queued_jobs()
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.stage, 'counting')
+        self.assertEqual((job.progress, job.total), (3, 3))
+        self.assertEqual(job.result, {'counted': 3})
+        self.assertIn('counting', job.timings)
+        self.assertIn('total', job.timings)
+
+    def test_failed_job_records_error(self):
+        """
+        An exception fails the job and stores the traceback
+        """
+        job = Job.objects.enqueue('otcore.job.tests.failing_task')
+
+        self.run_queued_jobs()
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('Something went wrong', job.error)
+
+    def test_cancel(self):
+        """
+        A queued job is cancelled immediately, a running job at its next progress update
+        """
+        queued = Job.objects.enqueue('otcore.job.tests.counting_task', count=1)
+        queued.cancel()
+        self.assertIsNone(claim_next_job())
+
+        running = Job.objects.enqueue('otcore.job.tests.cancelling_task')
+        run_job(claim_next_job())
+        running.refresh_from_db()
+
+        self.assertEqual(running.status, Job.CANCELLED)
+        self.assertEqual(Job.objects.get(id=queued.id).status, Job.CANCELLED)
+
+    def test_automatic_relations_job(self):
+        """
+        Automatic relations run through the job worker
+        """
+        Basket.create_from_string('Nash')
+        Basket.create_from_string('John Nash')
+        job = Job.objects.enqueue('otcore.relation.tasks.automatic_relations_task')
+
+        self.run_queued_jobs()
+        job.refresh_from_db()
+
+        self.assertEqual(job.result, {'containment': 1, 'multiple_tokens': 0})
+        self.assertEqual(RelatedBasket.objects.count(), 1)
@@ -0,0 +1,40 @@
+from rest_framework import generics, status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+
+from .models import Job
+from .serializers import JobSerializer
+
+
+def enqueued_response(task, **kwargs):
+    """
+    Queues a task and returns the job info, for views that hand their work to the job worker
+    """
+    job = Job.objects.enqueue(task, **kwargs)
+
+    return Response(JobSerializer(job).data, status.HTTP_202_ACCEPTED)
+
+
+class JobListView(generics.ListAPIView):
+    serializer_class = JobSerializer
+    queryset = Job.objects.all()
+
+
+class JobDetailView(generics.RetrieveAPIView):
+    """
+    Polling endpoint for a job's status, stage and progress
+    """
+    serializer_class = JobSerializer
+    queryset = Job.objects.all()
+
+
+class JobCancelView(APIView):
+    def post(self, request, *args, **kwargs):
+        try:
+            job = Job.objects.get(id=self.kwargs['pk'])
+        except Job.DoesNotExist:
+            return Response({"Error": "No Job Matches that ID"}, status.HTTP_404_NOT_FOUND)
+
+        job.cancel()
+
+        return Response(JobSerializer(job).data)
@@ -0,0 +1,77 @@
+import os
+import socket
+import time
+import traceback
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from otcore.settings import import_from_string
+from .models import Job, JobCancelled
+
+
+def claim_next_job():
+    """
+    Marks the oldest queued job as running and returns it.  The status is changed with a
+    conditional UPDATE, so two workers can never claim the same job
+    """
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    while True:
+        job = Job.objects.filter(status=Job.QUEUED).order_by('created', 'id').first()
+        if job is None:
+            return None
+
+        claimed = Job.objects.filter(id=job.id, status=Job.QUEUED).update(
+            status=Job.RUNNING, started=timezone.now(), worker=worker
+        )
+
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def run_job(job):
+    """
+    Runs a claimed job and records its result, or the error that stopped it
+    """
+    try:
+        task = import_from_string(job.task)
+        job.result = task(job, **job.kwargs)
+        job.status = Job.DONE
+    except JobCancelled:
+        job.status = Job.CANCELLED
+    except Exception:
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+
+    job.end_stage()
+    job.finished = timezone.now()
+    job.timings['total'] = round((job.finished - job.started).total_seconds(), 3)
+
+    Job.objects.filter(id=job.id).update(
+        status=job.status,
+        result=job.result,
+        error=job.error,
+        timings=job.timings,
+        finished=job.finished,
+    )
+
+    return job
+
+
+def run_worker(interval=2, once=False):
+    """
+    Runs queued jobs one at a time.  If `once` is True, returns when the queue is empty,
+    otherwise polls the queue every `interval` seconds
+    """
+    while True:
+        close_old_connections()
+        job = claim_next_job()
+
+        if job is not None:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(interval)
@@ -0,0 +1,7 @@
+from django.conf.urls import url
+from . import views
+
+
+urlpatterns = [
+    url(r'^reslug/$', views.ReslugHitsView.as_view()),
+]
@@ -0,0 +1,168 @@
+import hashlib
+import re
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from otcore.settings import otcore_settings
+from .models import StopWord, Recognizer
+
+
+LEX_VERSION_KEY = 'lex_version'
+
+
+class SlugEngine:
+    """
+    In-process, compiled snapshot of the lexical configuration used for slugification.
+
+    Recognizer patterns are compiled once and the stopwords are frozen into a set, so
+    that slugifying a word doesn't require a cache round-trip or a regex compilation.
+    Each engine is tied to a lex version: when StopWords or Recognizers change, the version
+    changes and a new engine is built.
+    """
+    def __init__(self, recognizers, stopwords, version=None):
+        self.version = version
+        self.recognizers = tuple(
+            (re.compile(recognizer.recognizer, flags=re.U), recognizer.replacer, recognizer.passthrough)
+            for recognizer in recognizers
+        )
+        self.stopwords = frozenset(stopwords)
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the recognizers and stopwords.  Unlike the lex version, it's the same in every
+        process and across cache flushes, so it can be stored to tell which configuration
+        slugs were made with
+        """
+        recognizers = [(pattern.pattern, replacer, passthrough) for pattern, replacer, passthrough in self.recognizers]
+        value = repr((recognizers, sorted(self.stopwords)))
+
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    def stem(self, word):
+        """
+        Runs the word through the recognizer chain. Stops at the first matching,
+        non-passthrough recognizer
+        """
+        for pattern, replacer, passthrough in self.recognizers:
+            word, count = pattern.subn(replacer, word)
+
+            if count > 0 and not passthrough:
+                return word
+
+        return word
+
+    def remove_stopwords(self, slug_set):
+        """
+        Removes stopwords from a set of tokens.  If nothing is left after stopwords
+        are removed, the stopwords are ignored altogether.
+        """
+        minus_stopwords = slug_set.difference(self.stopwords)
+
+        if len(minus_stopwords):
+            return list(minus_stopwords)
+        else:
+            return list(slug_set)
+
+
+_engine = None
+_checked_at = None
+_reset_callbacks = []
+
+
+def get_lex_version():
+    """
+    Returns the current lex version, shared between processes through the cache.
+    """
+    version = cache.get(LEX_VERSION_KEY)
+
+    if version is None:
+        cache.add(LEX_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(LEX_VERSION_KEY)
+
+    return version
+
+
+def build_slug_engine(version=None):
+    """
+    Builds a new SlugEngine from the current StopWords and Recognizers
+    """
+    # imported here to avoid a circular import between lex_utils and recognizers
+    from .lex_utils import load_stopwords
+    from .recognizers import load_recognizers
+
+    return SlugEngine(load_recognizers(), load_stopwords(), version=version)
+
+
+def get_slug_engine():
+    """
+    Returns the in-process SlugEngine, rebuilding it if the lex version has changed.
+    The shared version is only checked every SLUG_ENGINE_CHECK_INTERVAL seconds, so
+    most calls don't touch the cache at all.
+    """
+    global _engine, _checked_at
+
+    now = time.monotonic()
+    interval = otcore_settings.SLUG_ENGINE_CHECK_INTERVAL
+
+    if _engine is None or _checked_at is None or now - _checked_at >= interval:
+        version = get_lex_version()
+
+        if _engine is None or _engine.version != version:
+            _reset()
+            _engine = build_slug_engine(version=version)
+
+        _checked_at = now
+
+    return _engine
+
+
+def set_slug_engine(engine):
+    """
+    Installs a prebuilt engine, eg. one passed to a worker process
+    """
+    global _engine, _checked_at
+
+    _reset()
+    _engine = engine
+    _checked_at = time.monotonic()
+
+
+def on_engine_reset(callback):
+    """
+    Registers a callback to be run whenever the engine is discarded.
+    Used to clear memoized slugs.
+    """
+    _reset_callbacks.append(callback)
+    return callback
+
+
+def _reset():
+    for callback in _reset_callbacks:
+        callback()
+
+
+def reset_slug_engine():
+    """
+    Discards the in-process engine and bumps the shared lex version, so that other
+    processes rebuild theirs as well
+    """
+    global _engine, _checked_at
+
+    cache.set(LEX_VERSION_KEY, uuid.uuid4().hex, None)
+
+    _reset()
+    _engine = None
+    _checked_at = None
+
+
+@receiver(post_save, sender=StopWord, dispatch_uid='reset_slug_engine_stopword_save')
+@receiver(post_delete, sender=StopWord, dispatch_uid='reset_slug_engine_stopword_delete')
+@receiver(post_save, sender=Recognizer, dispatch_uid='reset_slug_engine_recognizer_save')
+@receiver(post_delete, sender=Recognizer, dispatch_uid='reset_slug_engine_recognizer_delete')
+def reset_slug_engine_on_change(*args, **kwargs):
+    reset_slug_engine()
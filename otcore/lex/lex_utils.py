@@ -1,50 +1,144 @@
 # -- coding: utf-8 --
 from __future__ import unicode_literals
+import threading
 import unicodedata
+from collections import OrderedDict
 
 from django.conf import settings
 from django.utils.text import slugify
 from django.core.cache import cache
 
 from otcore.lex.models import StopWord, Recognizer, recache_stopwords
+from otcore.lex.engine import get_slug_engine, on_engine_reset
 from otcore.settings import otcore_settings
 
 
 def lex_slugify(value):
+    """
+    Memoized slugification. Results are cached per lex version: the memo is cleared
+    whenever StopWords or Recognizers change.
+    """
+    # Make sure the engine is current before reading from the memo
+    get_slug_engine()
+
+    slug = slug_memo.get(value)
+    if slug is None:
+        slug = _slugify(value)
+        slug_memo.set(value, slug)
+
+    return slug
+
+
+def lex_slugify_many(names):
+    """
+    Slugifies an iterable of names in a single pass, returning a list of slugs in the
+    same order as the names.  Most names share words, so each distinct word is only run
+    through the SINGLE_WORD_TOKENIZERS chain once.  Results also populate the lex_slugify
+    memo, so that subsequent saves of the same names don't recompute their slugs.
+    """
+    get_slug_engine()
+
+    word_tokens = {}
+    slugs = []
+    for name in names:
+        slug = slug_memo.get(name)
+        if slug is None:
+            slug = _slugify(name, word_tokens)
+            slug_memo.set(name, slug)
+
+        slugs.append(slug)
+
+    return slugs
+
+
+def _slugify(value, word_tokens=None):
     for tokenizer in otcore_settings.WHOLE_NAME_TOKENIZERS:
         value = tokenizer(value)
 
     # Perform django slugifiction
     words = clean_words(value)
 
-    slug_set = run_tokenizers(words) 
+    slug_set = run_tokenizers(words, word_tokens)
     slug_list = extract_stopwords(slug_set)
 
     slug_value = '-'.join(sorted(slug_list))
     return slug_value.strip('-')
 
 
-def run_tokenizers(words):
+class SlugMemo:
+    """
+    Bounded LRU memo of name -> slug.  Thread safe, as it's shared by the threads of a worker
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            try:
+                slug = self.data[name]
+            except KeyError:
+                return None
+
+            self.data.move_to_end(name)
+            return slug
+
+    def set(self, name, slug):
+        with self.lock:
+            self.data[name] = slug
+            self.data.move_to_end(name)
+
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+slug_memo = SlugMemo(otcore_settings.SLUG_CACHE_SIZE)
+on_engine_reset(slug_memo.clear)
+
+
+def run_tokenizers(words, word_tokens=None):
     """
     Iterate through tokenizers. If the produced token has a hyphen, split and recursively move
-    process the new tokens
+    process the new tokens.
+    If a `word_tokens` dict is passed, the tokens of each word are memoized in it
     """
     slug_set = set()
     for word in list(words):
-        for tokenizer in otcore_settings.SINGLE_WORD_TOKENIZERS:
-            word = tokenizer(word)
-
-        if '-' in word:
-            slug_set |= run_tokenizers(word.split('-'))
-        else:
-            slug_set.add(word)
+        slug_set |= tokenize_word(word, word_tokens)
 
     return slug_set
 
 
+def tokenize_word(word, word_tokens=None):
+    """
+    Runs a single word through the SINGLE_WORD_TOKENIZERS chain and returns its set of tokens
+    """
+    if word_tokens is not None and word in word_tokens:
+        return word_tokens[word]
+
+    token = word
+    for tokenizer in otcore_settings.SINGLE_WORD_TOKENIZERS:
+        token = tokenizer(token)
+
+    if '-' in token:
+        tokens = run_tokenizers(token.split('-'), word_tokens)
+    else:
+        tokens = {token}
+
+    if word_tokens is not None:
+        word_tokens[word] = tokens
+
+    return tokens
+
+
 def clean_words(value):
     """
-    replacement for django's slugify.  For various reasons, we don't want to 
+    replacement for django's slugify.  For various reasons, we don't want to
     strip out all punctuation at this stage, so this just cleans and splits
     """
     value = unicodedata.normalize('NFKC', value)
@@ -55,26 +149,20 @@ def load_stopwords():
     """
     Fetches stopwords from cache, if CACHE_STOPWORDS is True.
     """
-    if otcore_settings.CACHE_RECOGNIZERS:
+    if otcore_settings.CACHE_STOPWORDS:
         stopwords = cache.get('stopwords')
-      
+
         if stopwords is None:
             stopwords = recache_stopwords()
 
     else:
-        stopwords = StopWord.objects.values_list('word', flat=True) 
+        stopwords = StopWord.objects.values_list('word', flat=True)
 
     return set(stopwords)
-    
-
-def extract_stopwords(slug_set):
-    stopwords = load_stopwords()
 
-    minus_stopwords = slug_set.difference(stopwords)
-    # If there is nothing left after stopwords are removed, ignore the stopwords altogether.
-    if len(minus_stopwords):
-        slug_list = list(minus_stopwords)
-    else:
-        slug_list = list(slug_set)
 
-    return slug_list
+def extract_stopwords(slug_set):
+    """
+    Removes stopwords using the compiled stopword set of the current SlugEngine
+    """
+    return get_slug_engine().remove_stopwords(slug_set)
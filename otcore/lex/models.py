@@ -1,5 +1,5 @@
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.cache import cache
 
@@ -20,6 +20,7 @@ class StopWord(models.Model):
 
 
 @receiver(post_save, sender=StopWord, dispatch_uid='recache_stopwords')
+@receiver(post_delete, sender=StopWord, dispatch_uid='recache_stopwords_on_delete')
 def recache_stopwords(*args, **kwargs):
     if otcore_settings.CACHE_STOPWORDS:
         stopwords = StopWord.objects.values_list('word', flat=True) 
@@ -48,6 +49,7 @@ class Recognizer(models.Model):
 
 
 @receiver(post_save, sender=Recognizer, dispatch_uid='recache_recognizers')
+@receiver(post_delete, sender=Recognizer, dispatch_uid='recache_recognizers_on_delete')
 def recache_recognizers(*args, **kwargs):
     if otcore_settings.CACHE_RECOGNIZERS:
         recognizers = list(Recognizer.objects.all())
@@ -1,8 +1,17 @@
 import importlib
+import os
+from multiprocessing import Pool
 from otcore.settings import otcore_settings
 import codecs
 
+from django.db import transaction
+
+from otcore.common.utils import bulk_update_field, close_connections_before_fork
+from otcore.hit.models import Basket, Hit, SlugToken
+from otcore.hit.processing import merge_baskets
 from .models import StopWord, Recognizer
+from .engine import get_slug_engine, set_slug_engine
+from .lex_utils import lex_slugify_many
 
 
 def lines_in_file(filename):
@@ -38,3 +47,137 @@ def read_recognizers():
                 'priority': recognizer[0]
             }
         )
+
+
+def reslug_hits(batch_size=None, processes=None, hits=None):
+    """
+    Recomputes the slug of every hit against the current StopWords and Recognizers.
+    Pass a queryset as `hits` to only recompute the slugs of some hits.
+
+    Hits are slugified in batches across a process pool (run inline if `processes` is 1),
+    changed slugs are written with bulk updates, and only the hits whose slug changed are
+    re-homed (see `rehome_hits`).  Writes are made in a single transaction.
+
+    Returns a report of the form:
+    {
+        "checked": NUMBER_OF_HITS,
+        "changed": [{"hit", "name", "old_slug", "new_slug", "old_basket", "new_basket"}, ...]
+    }
+    """
+    batch_size = batch_size or otcore_settings.RESLUG_BATCH_SIZE
+    processes = processes or otcore_settings.RESLUG_PROCESSES or os.cpu_count() or 1
+
+    hits = hits if hits is not None else Hit.objects.all()
+    rows = list(hits.order_by('id').values_list('id', 'name', 'slug'))
+    batches = [rows[start:start + batch_size] for start in range(0, len(rows), batch_size)]
+
+    engine = get_slug_engine()
+
+    if processes > 1 and len(batches) > 1:
+        # forked workers must not share the parent's database connections
+        close_connections_before_fork()
+
+        with Pool(processes, initializer=_init_reslug_worker, initargs=(engine,)) as pool:
+            results = pool.map(reslug_batch, batches)
+    else:
+        results = [reslug_batch(batch) for batch in batches]
+
+    changes = [change for result in results for change in result]
+
+    with transaction.atomic():
+        bulk_update_field(Hit.objects.all(), 'slug', {hit_id: new_slug for hit_id, old_slug, new_slug in changes})
+        SlugToken.rebuild(Hit.objects.filter(id__in=[hit_id for hit_id, _, _ in changes]).only('id', 'slug'))
+
+        changed = rehome_hits(changes)
+
+    return {
+        'checked': len(rows),
+        'changed': changed,
+    }
+
+
+def _init_reslug_worker(engine):
+    set_slug_engine(engine)
+
+
+def reslug_batch(rows):
+    """
+    Slugifies a batch of (id, name, slug) rows.  Returns (id, old_slug, new_slug) for the rows
+    whose slug changed.  Doesn't touch the database, so that it can run in a worker process
+    """
+    new_slugs = lex_slugify_many([name for _, name, _ in rows])
+
+    return [
+        (hit_id, old_slug, new_slug)
+        for (hit_id, _, old_slug), new_slug in zip(rows, new_slugs)
+        if old_slug != new_slug
+    ]
+
+
+def rehome_hits(changes):
+    """
+    Moves hits whose slug changed to the basket of their new slug equivalents, if any.
+
+    A hit that was alone on its basket has its basket merged into the equivalent one, otherwise
+    the hit alone is moved.  Hits without a new equivalent stay on their basket, which is relabelled
+    if its label was derived from an old slug.  Tokengroups of every affected basket are recomputed.
+
+    `changes` is a list of (hit_id, old_slug, new_slug). Returns a list of report dicts.
+    """
+    separator = otcore_settings.SCOPE_SEPARATOR
+    report = []
+    affected_baskets = set()
+    stale_labels = set()
+
+    for hit_id, old_slug, new_slug in changes:
+        hit = Hit.objects.select_related('basket').get(id=hit_id)
+        old_basket_id = hit.basket_id
+
+        if hit.basket is not None:
+            stale_labels.add('%s%s%s' % (old_slug, separator, hit.scope_id))
+
+            target_id = (Hit.objects
+                .filter(slug=new_slug, scope_id=hit.scope_id, basket__isnull=False)
+                .exclude(basket_id=hit.basket_id)
+                .order_by('basket_id')
+                .values_list('basket_id', flat=True)
+                .first())
+
+            if target_id is not None:
+                target = Basket.objects.get(id=target_id)
+
+                if hit.basket.topic_hits.count() == 1:
+                    merge_baskets(hit.basket, target)
+                    hit.basket = target
+                else:
+                    old_basket = hit.basket
+                    hit.basket = target
+                    hit.preferred = False
+                    hit.save()
+
+                    old_basket.update_display_name()
+                    affected_baskets.add(old_basket.id)
+
+            affected_baskets.add(hit.basket_id)
+
+        report.append({
+            'hit': hit.id,
+            'name': hit.name,
+            'old_slug': old_slug,
+            'new_slug': new_slug,
+            'old_basket': old_basket_id,
+            'new_basket': hit.basket_id,
+        })
+
+    for basket in Basket.objects.filter(id__in=affected_baskets).prefetch_related('topic_hits'):
+        hits = sorted(basket.topic_hits.all(), key=lambda x: x.id)
+        labels = ['%s%s%s' % (x.slug, separator, x.scope_id) for x in hits]
+
+        if labels and basket.label in stale_labels and basket.label not in labels:
+            basket.label = labels[0]
+            basket.save()
+
+        basket.tokengroups.clear()
+        basket.local_tokengroup()
+
+    return report
@@ -1,9 +1,8 @@
-import re
-
 from django.core.cache import cache
 
 from otcore.settings import otcore_settings
 from .models import Recognizer, recache_recognizers
+from .engine import get_slug_engine
 
 
 def load_recognizers():
@@ -13,7 +12,7 @@ def load_recognizers():
     """
     if otcore_settings.CACHE_RECOGNIZERS:
         recognizers = cache.get('recognizers')
-      
+
         if recognizers is None:
             recognizers = recache_recognizers()
 
@@ -26,14 +25,8 @@ def load_recognizers():
 def stemmer(word):
     """
     If a recognizer pattern matches the word, perform the replacement and return the new word.
-    Otherwise return the unaltered word
-    """
-    recognizers = load_recognizers()
+    Otherwise return the unaltered word.
 
-    for recognizer in recognizers:
-        word, count = re.subn(recognizer.recognizer, recognizer.replacer, word, flags=re.U)
-
-        if count > 0 and not recognizer.passthrough:
-            return word
-
-    return word
+    Uses the precompiled recognizer chain of the current SlugEngine
+    """
+    return get_slug_engine().stem(word)
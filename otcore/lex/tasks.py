@@ -0,0 +1,7 @@
+from .processing import reslug_hits
+
+
+def reslug_hits_task(job):
+    job.set_stage('reslugging')
+
+    return reslug_hits()
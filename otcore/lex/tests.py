@@ -1,8 +1,15 @@
+import threading
+
 from django.test import TestCase
+from rest_framework.test import APIClient
 
-from .processing import read_stopwords, read_recognizers
+from otcore.hit.models import Basket, Hit
+from otcore.job.models import Job
+from otcore.job.worker import claim_next_job, run_job
+from .processing import read_stopwords, read_recognizers, reslug_hits
 from .models import StopWord, Recognizer
-from .lex_utils import lex_slugify
+from .lex_utils import lex_slugify, lex_slugify_many, slug_memo, SlugMemo
+from .engine import get_slug_engine
 
 
 # Create your tests here.
@@ -100,3 +107,130 @@ class LexModelTests(TestCase):
         Recognizer.objects.create(recognizer=r's$', replacer='')
         self.assertEqual(lex_slugify("Matt's Art"), 'art-matt')
         self.assertEqual(lex_slugify("States' Rights"), 'right-state')
+
+
+class SlugEngineTests(TestCase):
+    def test_engine_is_reused(self):
+        """
+        The compiled engine is kept in process between slugifications
+        """
+        self.assertIs(get_slug_engine(), get_slug_engine())
+
+    def test_engine_rebuilt_on_recognizer_change(self):
+        """
+        Memoized slugs are discarded when a recognizer is added
+        """
+        Recognizer.objects.create(recognizer=r'[^\w\s-]', replacer='', passthrough=True)
+        self.assertEqual(lex_slugify('Databases'), 'databases')
+
+        Recognizer.objects.create(recognizer=r's$', replacer='')
+        self.assertEqual(lex_slugify('Databases'), 'database')
+
+    def test_engine_rebuilt_on_stopword_delete(self):
+        """
+        Deleting a stopword invalidates the engine and the memoized slugs
+        """
+        stopword = StopWord.objects.create(word='of')
+        self.assertEqual(lex_slugify('Duke of York'), 'duke-york')
+
+        stopword.delete()
+        self.assertEqual(lex_slugify('Duke of York'), 'duke-of-york')
+
+    def test_slugify_many(self):
+        """
+        Batch slugification returns the same slugs as lex_slugify, in input order
+        """
+        Recognizer.objects.create(recognizer=r'[^\w\s-]', replacer='', passthrough=True)
+        Recognizer.objects.create(recognizer=r's$', replacer='')
+        StopWord.objects.create(word='of')
+
+        names = ['Duke of York', 'Dukes, York', 'Fort-Worth Cats', 'Duke of York']
+        slugs = lex_slugify_many(names)
+        self.assertEqual(slugs, ['duke-york', 'duke-york', 'cat-fort-worth', 'duke-york'])
+
+        slug_memo.clear()
+        self.assertEqual(slugs, [lex_slugify(name) for name in names])
+
+    def test_slug_memo_threads(self):
+        """
+        The memo can be shared by the threads of a worker
+        """
+        memo = SlugMemo(8)
+        errors = []
+
+        def churn(offset):
+            try:
+                for i in range(2000):
+                    name = str((i + offset) % 16)
+                    memo.set(name, name)
+                    memo.get(name)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=churn, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(memo.data), 8)
+
+
+class ReslugTests(TestCase):
+    def setUp(self):
+        Recognizer.objects.create(recognizer=r'[^\w\s-]', replacer='', passthrough=True)
+
+    def test_reslug_merges_single_hit_basket(self):
+        """
+        A hit alone on its basket is merged into the basket of its new slug equivalent
+        """
+        database = Basket.create_from_string('Database')
+        databases = Basket.create_from_string('Databases')
+
+        Recognizer.objects.create(recognizer=r's$', replacer='')
+        report = reslug_hits(processes=1)
+
+        self.assertEqual(report['checked'], 2)
+        self.assertEqual(len(report['changed']), 1)
+        self.assertEqual(report['changed'][0]['new_slug'], 'database')
+        self.assertEqual(Hit.objects.get(name='Databases').basket, database)
+        self.assertFalse(Basket.objects.filter(id=databases.id).exists())
+
+    def test_reslug_moves_hit_and_relabels(self):
+        """
+        A hit sharing its basket is moved alone, and the stale basket label is replaced
+        """
+        database = Basket.create_from_string('Database')
+        databases = Basket.create_from_string('Databases')
+        Hit.objects.create(name='Data stores', basket=databases)
+
+        Recognizer.objects.create(recognizer=r's$', replacer='')
+        reslug_hits(processes=1)
+
+        databases.refresh_from_db()
+        self.assertEqual(Hit.objects.get(name='Databases').basket, database)
+        self.assertEqual(Hit.objects.get(name='Data stores').slug, 'data-store')
+        self.assertEqual(Hit.objects.get(name='Data stores').basket, databases)
+        self.assertTrue(databases.label.startswith('data-store'))
+
+    def test_reslug_endpoint_queues_job(self):
+        """
+        The endpoint queues a job, ignoring client supplied batch sizes and process counts
+        """
+        database = Basket.create_from_string('Database')
+        Basket.create_from_string('Databases')
+        Recognizer.objects.create(recognizer=r's$', replacer='')
+
+        response = APIClient().post('/api/lex/reslug/', {'processes': '64', 'batch_size': 'x'})
+        self.assertEqual(response.status_code, 202)
+
+        job = Job.objects.get(id=response.data['id'])
+        self.assertEqual(job.kwargs, {})
+
+        run_job(claim_next_job())
+        job.refresh_from_db()
+
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.result['checked'], 2)
+        self.assertEqual(Hit.objects.get(name='Databases').basket, database)
@@ -0,0 +1,13 @@
+from rest_framework.views import APIView
+
+from otcore.job.views import enqueued_response
+
+
+class ReslugHitsView(APIView):
+    """
+    Queues a job recomputing all hit slugs after StopWords or Recognizers have changed.
+    The job result lists the hits whose slug changed, and the baskets they were moved from/to.
+    Batch size and worker processes come from the RESLUG_* settings
+    """
+    def post(self, request, *args, **kwargs):
+        return enqueued_response('otcore.lex.tasks.reslug_hits_task')
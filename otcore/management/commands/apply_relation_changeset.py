@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from otcore.relation.changeset import read_changeset, apply_changeset
+
+
+class Command(BaseCommand):
+    help = 'Writes a changeset computed by `relation_changeset` in a single transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename', help='Changeset file')
+
+    def handle(self, *args, **options):
+        counts = apply_changeset(read_changeset(options['filename']))
+
+        for name in counts['added']:
+            self.stdout.write(self.style.SUCCESS('{}: {} added, {} removed'.format(
+                name, counts['added'][name], counts['removed'][name])))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from otcore.relation.processing import process_dirty_baskets
+
+
+class Command(BaseCommand):
+    help = 'Recomputes Containment and MultipleTokens relations for baskets edited since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Maximum number of baskets to process')
+
+    def handle(self, *args, **options):
+        processed = process_dirty_baskets(limit=options['limit'])
+
+        self.stdout.write(self.style.SUCCESS('{} baskets processed'.format(processed)))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from otcore.hit.models import recompute_display_names
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the display names of all baskets with a single UPDATE'
+
+    def handle(self, *args, **options):
+        changed = recompute_display_names()
+
+        self.stdout.write(self.style.SUCCESS('{} display names changed'.format(changed)))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from otcore.relation.changeset import compute_changeset, write_changeset
+
+
+class Command(BaseCommand):
+    help = ('Computes the automatic relations that the Containment and MultipleTokens rules would '
+            'add and remove, without writing them, and saves the changeset to a file')
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename', help='Changeset file. Gzipped if it ends with .gz')
+
+    def handle(self, *args, **options):
+        changeset = compute_changeset()
+        write_changeset(changeset, options['filename'])
+
+        for stage, seconds in changeset['timings'].items():
+            self.stdout.write('{}: {:.3f}s'.format(stage, seconds))
+
+        for name in changeset['relationtypes']:
+            self.stdout.write(self.style.SUCCESS('{}: {} to add, {} to remove'.format(
+                name, len(changeset['add'][name]), len(changeset['remove'][name]))))
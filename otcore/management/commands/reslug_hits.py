@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from otcore.lex.processing import reslug_hits
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the slugs of all hits against the current StopWords and Recognizers, '
+            'and moves the hits whose slug changed to the correct basket')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Number of hits slugified per batch')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of worker processes. Use 1 to run inline')
+
+    def handle(self, *args, **options):
+        report = reslug_hits(batch_size=options['batch_size'], processes=options['processes'])
+
+        for change in report['changed']:
+            self.stdout.write('{name}: {old_slug} -> {new_slug} (basket {old_basket} -> {new_basket})'.format(**change))
+
+        self.stdout.write(self.style.SUCCESS('{} hits checked, {} slugs changed'.format(
+            report['checked'], len(report['changed']))))
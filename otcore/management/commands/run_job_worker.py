@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from otcore.job.worker import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (automatic relations, bulk extraction, reports, reconciliation)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Seconds between polls of an empty queue')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        run_worker(interval=options['interval'], once=options['once'])
@@ -1,5 +1,6 @@
 import logging
 
+from otcore.hit.models import deferred_display_names
 from .models import Document
 from .loaders import BaseLoader
 
@@ -54,14 +55,16 @@ class BaseDocumentExtractor:
         """
         self.import_document()
 
-        if self.extract_document:
-            self.document = self.create_document()
+        # basket display names are recomputed once, after all hits are created
+        with deferred_display_names():
+            if self.extract_document:
+                self.document = self.create_document()
 
-        if self.extract_locations:
-            self.locations = self.create_locations()
+            if self.extract_locations:
+                self.locations = self.create_locations()
 
-        if self.extract_hits:
-            self.occurrences = self.create_hits()
+            if self.extract_hits:
+                self.occurrences = self.create_hits()
 
         logger.info("Extracted all info from {}".format(self.source))
 
@@ -0,0 +1,15 @@
+from otcore.settings import import_from_string
+
+
+def bulk_extract_task(job, extractor, sources):
+    """
+    Extracts each source with the `bulk_extract` method of the extractor class at
+    the dotted path `extractor`
+    """
+    extractor_class = import_from_string(extractor)
+
+    job.set_stage('extracting', total=len(sources))
+
+    for source in sources:
+        extractor_class.bulk_extract([source])
+        job.advance()
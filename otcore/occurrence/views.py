@@ -11,6 +11,7 @@ from .serializers import DocumentListSerializer, DocumentDetailSerializer, \
 from .processing import create_occurrence_rings
 from otcore.hit.forms import add_or_create_from_uiselect
 from otcore.hit.models import Hit
+from otcore.job.views import enqueued_response
 from otcore.lex.lex_utils import lex_slugify
 
 
@@ -267,6 +268,8 @@ class BaseExtractorView(generics.GenericAPIView):
 class BaseBulkExtractorView(BaseExtractorView):
     """
     Base class for Bulk Extracting Documents
+    Extraction is queued as a background job: sources must be JSON serializable (eg. urls or
+    file paths).  Returns the job, which can be polled at /api/job/JOB_ID/
     """
     data_source_key = 'sources'
 
@@ -274,9 +277,11 @@ class BaseBulkExtractorView(BaseExtractorView):
         extractor_class = self.get_extractor_class(request)
 
         sources = self.load_source(request)
+        if isinstance(sources, Response):
+            return sources
 
-        extractor_class.bulk_extract(sources)
-
-        return Response(status.HTTP_204_NO_CONTENT)
-        
-        
+        return enqueued_response(
+            'otcore.occurrence.tasks.bulk_extract_task',
+            extractor='{}.{}'.format(extractor_class.__module__, extractor_class.__name__),
+            sources=list(sources)
+        )
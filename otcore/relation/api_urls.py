@@ -14,4 +14,5 @@ urlpatterns = [
     url(r'^rtype/with-counts/$', views.RelationTypeWithCountsView.as_view()),
     url(r'^rtype/(?P<pk>\d+)/$', views.RelationTypeUpdateView.as_view()),
     url(r'^automatic/all/$', views.RunAutomaticRelationsView.as_view()),
+    url(r'^automatic/dirty/$', views.ProcessDirtyBasketsView.as_view()),
 ]
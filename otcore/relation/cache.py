@@ -0,0 +1,79 @@
+from collections import defaultdict
+
+from .models import RelatedBasket
+
+
+def _id(obj):
+    return getattr(obj, 'id', obj)
+
+
+class RelationCache:
+    """
+    In-memory set of existing (source_id, destination_id) relation pairs, overall and per
+    relation type.  Rule functions check it instead of querying RelatedBasket for every
+    candidate pair, and relations created through the cache are added to it.
+
+    Baskets and relation types can be passed either as instances or as ids.
+    """
+    def __init__(self, triples=()):
+        self.pairs = set()
+        self.by_type = defaultdict(set)
+
+        for relationtype_id, source_id, destination_id in triples:
+            self.add(source_id, destination_id, relationtype_id)
+
+    @classmethod
+    def load(cls, queryset=None):
+        """
+        Loads the relations of `queryset` (all relations by default) in a single query.
+        Lookups are only accurate for pairs covered by the queryset.
+        """
+        if queryset is None:
+            queryset = RelatedBasket.objects.all()
+
+        return cls(queryset.values_list('relationtype_id', 'source_id', 'destination_id').order_by())
+
+    @classmethod
+    def for_baskets(cls, basket_ids):
+        """
+        Loads every relation from or to the given baskets
+        """
+        basket_ids = list(basket_ids)
+
+        return cls.load(
+            RelatedBasket.objects.filter(source_id__in=basket_ids) |
+            RelatedBasket.objects.filter(destination_id__in=basket_ids)
+        )
+
+    def exists(self, source, destination, relationtype=None):
+        pair = (_id(source), _id(destination))
+
+        if relationtype is None:
+            return pair in self.pairs
+
+        return pair in self.by_type[_id(relationtype)]
+
+    def related(self, basket1, basket2, relationtype=None):
+        """
+        Checks for a relation in either direction
+        """
+        return self.exists(basket1, basket2, relationtype) or self.exists(basket2, basket1, relationtype)
+
+    def add(self, source, destination, relationtype):
+        pair = (_id(source), _id(destination))
+
+        self.pairs.add(pair)
+        self.by_type[_id(relationtype)].add(pair)
+
+    def create(self, source, destination, relationtype):
+        """
+        Creates the relation, and records it in the cache
+        """
+        relation = RelatedBasket.objects.create(
+            relationtype_id=_id(relationtype),
+            source_id=_id(source),
+            destination_id=_id(destination)
+        )
+        self.add(source, destination, relationtype)
+
+        return relation
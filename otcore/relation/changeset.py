@@ -0,0 +1,132 @@
+"""
+Dry-run of the automatic relation rules.
+
+`compute_changeset` runs Containment and MultipleTokens from scratch against the current names,
+and diffs the result with the automatic relations in the database, without writing anything.
+The changeset can be saved to a file, inspected, and written later by `apply_changeset` in a
+single transaction.
+"""
+import gzip
+import json
+import time
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.utils import timezone
+
+from otcore.hit.models import Hit
+from otcore.settings import otcore_settings
+from .engines import ContainmentEngine, MultipleTokensEngine
+from .models import RelatedBasket
+from .processing import get_rtypes
+from . import parallel
+
+
+@contextmanager
+def timed(timings, stage):
+    """
+    Records the duration of a stage in `timings`, in seconds
+    """
+    started = time.monotonic()
+    yield
+    timings[stage] = round(time.monotonic() - started, 3)
+
+
+def compute_changeset():
+    """
+    Computes the automatic relations to add and to remove, by relation type.
+
+    The rules run as they would on an empty set of automatic relations: only forbidden automatic
+    relations and relations of other types block new ones.  Relations to remove are the existing,
+    non-forbidden automatic relations the rules wouldn't create anymore.
+    """
+    rtypes = get_rtypes()
+    timings = {}
+    processes = parallel.use_processes()
+
+    with timed(timings, 'load'):
+        automatic = RelatedBasket.objects.filter(relationtype__in=rtypes.values(), forbidden=False)
+        current = {
+            name: automatic.filter(relationtype=rtype).existing_pairs()
+            for name, rtype in rtypes.items()
+        }
+        blocking = RelatedBasket.objects.exclude(id__in=automatic).existing_pairs()
+
+        slug_rows = list(Hit.objects.values_list('slug', 'basket_id'))
+
+    with timed(timings, 'containment'):
+        engine = ContainmentEngine(slug_rows)
+        if processes:
+            containment = parallel.containment_pairs(engine, blocking, processes)
+        else:
+            containment = engine.basket_pairs(existing=blocking)
+
+    with timed(timings, 'multipletokens'):
+        accept = otcore_settings.MULTIPLE_TOKENS_FILTER
+        if accept is not None:
+            accept = accept()
+
+        engine = MultipleTokensEngine(
+            slug_rows,
+            otcore_settings.MULTIPLE_RELATIONS_COUNT,
+            block_size=otcore_settings.MULTIPLE_TOKENS_BLOCK_SIZE
+        )
+        candidates = parallel.multiple_tokens_candidates(engine, processes) if processes else None
+
+        multipletokens = set()
+        for pairs in engine.basket_pairs(existing=blocking | containment, accept=accept, candidates=candidates):
+            multipletokens.update(pairs)
+
+    with timed(timings, 'diff'):
+        target = {'containment': containment, 'multipletokens': multipletokens}
+        add = {name: sorted(target[name] - current[name]) for name in rtypes}
+        remove = {name: sorted(current[name] - target[name]) for name in rtypes}
+
+    return {
+        'created': timezone.now().isoformat(),
+        'multiple_relations_count': otcore_settings.MULTIPLE_RELATIONS_COUNT,
+        'relationtypes': {name: rtype.id for name, rtype in rtypes.items()},
+        'timings': timings,
+        'add': add,
+        'remove': remove,
+    }
+
+
+def _open(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+
+    return open(filename, mode, encoding='utf-8')
+
+
+def write_changeset(changeset, filename):
+    """
+    Writes a changeset as compact JSON.  Gzipped if the filename ends with .gz
+    """
+    with _open(filename, 'w') as f:
+        json.dump(changeset, f, separators=(',', ':'))
+
+
+def read_changeset(filename):
+    with _open(filename, 'r') as f:
+        return json.load(f)
+
+
+def apply_changeset(changeset):
+    """
+    Writes a changeset in a single transaction: removed relations are deleted (forbidden ones
+    are always kept) and added relations are inserted, skipping those that already exist.
+    Returns the counts of deleted and inserted relations, by relation type.
+    """
+    rtypes = get_rtypes()
+    counts = {'removed': {}, 'added': {}}
+
+    with transaction.atomic():
+        for name, rtype in rtypes.items():
+            counts['removed'][name] = RelatedBasket.objects.delete_pairs(changeset['remove'].get(name, []), rtype)
+
+        for name, rtype in rtypes.items():
+            counts['added'][name] = RelatedBasket.objects.insert_pairs(
+                [tuple(pair) for pair in changeset['add'].get(name, [])], rtype)
+
+    return counts
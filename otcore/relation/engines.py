@@ -0,0 +1,188 @@
+import zlib
+from collections import defaultdict
+
+
+class ContainmentEngine:
+    """
+    In-memory containment rule.
+
+    Built from (slug, basket_id) tuples.  Every slug is split into its token set, and each token
+    keeps a posting list of the slugs it appears in.  The strict supersets of a slug are found by
+    intersecting the posting lists of its tokens, rarest token first, instead of comparing the slug
+    against every longer slug.
+    """
+    def __init__(self, rows):
+        self.baskets = defaultdict(set)
+        for slug, basket_id in rows:
+            if basket_id is not None:
+                self.baskets[slug].add(basket_id)
+
+        self.token_sets = {slug: frozenset(slug.split('-')) for slug in self.baskets}
+
+        self.postings = defaultdict(set)
+        for slug, tokens in self.token_sets.items():
+            for token in tokens:
+                self.postings[token].add(slug)
+
+    def supersets(self, slug):
+        """
+        Returns the slugs whose token set is a strict superset of `slug`'s
+        """
+        tokens = self.token_sets[slug]
+        postings = sorted((self.postings[token] for token in tokens), key=len)
+
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates &= posting
+            if not candidates:
+                break
+
+        return [candidate for candidate in candidates if len(self.token_sets[candidate]) > len(tokens)]
+
+    def rarest_token(self, slug):
+        """
+        The token of `slug` with the shortest posting list.  Every superset of the slug
+        contains it, so a slug's containment pairs can be computed from that token alone.
+        """
+        return min(self.token_sets[slug], key=lambda token: (len(self.postings[token]), token))
+
+    def shards(self, count):
+        """
+        Splits the slugs into `count` lists, by the bucket of their rarest token
+        """
+        shards = [[] for _ in range(count)]
+        for slug in sorted(self.token_sets):
+            bucket = zlib.crc32(self.rarest_token(slug).encode('utf-8')) % count
+            shards[bucket].append(slug)
+
+        return shards
+
+    def slug_pairs(self, slugs=None):
+        """
+        Yields every (contained slug, containing slug) pair, for all slugs or for `slugs` only
+        """
+        for slug in (sorted(self.token_sets) if slugs is None else slugs):
+            for superset in sorted(self.supersets(slug)):
+                yield slug, superset
+
+    def basket_pairs(self, existing=frozenset(), slugs=None):
+        """
+        Returns the set of (source basket, destination basket) containment pairs, skipping pairs
+        within a single basket and the pairs in `existing`
+        """
+        pairs = set()
+
+        for slug, superset in self.slug_pairs(slugs):
+            for source in self.baskets[slug]:
+                for destination in self.baskets[superset]:
+                    if source != destination and (source, destination) not in existing:
+                        pairs.add((source, destination))
+
+        return pairs
+
+
+class MultipleTokensEngine:
+    """
+    Vectorized MultipleTokens rule.
+
+    Hits are loaded as a sparse hit x token incidence matrix, so the number of tokens shared
+    by every pair of hits is the matrix product M * M^T.  The product is computed one block of
+    rows at a time, keeping only pairs of hits on different baskets that share at least
+    `min_count` tokens.
+
+    Rows are (slug, basket_id) tuples, in the order in which hits would be compared sequentially:
+    for each pair of baskets, the first qualifying pair of hits decides the relation direction.
+    """
+    def __init__(self, rows, min_count, block_size=2000):
+        import numpy as np
+        from scipy import sparse
+
+        self.min_count = min_count
+        self.block_size = block_size
+
+        self.token_sets = []
+        baskets = []
+        for slug, basket_id in rows:
+            tokens = frozenset(slug.split('-'))
+            if basket_id is not None and len(tokens) >= min_count:
+                self.token_sets.append(tokens)
+                baskets.append(basket_id)
+
+        vocabulary = {}
+        indices = [vocabulary.setdefault(token, len(vocabulary))
+                   for tokens in self.token_sets for token in tokens]
+        indptr = np.cumsum([0] + [len(tokens) for tokens in self.token_sets])
+
+        self.baskets = np.array(baskets, dtype=np.int64)
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), np.array(indices, dtype=np.int64), indptr),
+            shape=(len(self.token_sets), len(vocabulary))
+        )
+        self.transposed = self.matrix.T.tocsc()
+
+    def block_starts(self):
+        return list(range(0, self.matrix.shape[0], self.block_size))
+
+    def block_pairs(self, start):
+        """
+        Returns (first, second, shared) arrays of hit indices and shared token counts for the
+        block of rows beginning at `start`, ordered by first then second hit, with first < second
+        """
+        import numpy as np
+
+        product = self.matrix[start:start + self.block_size].dot(self.transposed).tocoo()
+
+        first = product.row.astype(np.int64) + start
+        second = product.col.astype(np.int64)
+
+        mask = (
+            (product.data >= self.min_count) &
+            (second > first) &
+            (self.baskets[first] != self.baskets[second])
+        )
+        first, second, shared = first[mask], second[mask], product.data[mask]
+
+        order = np.lexsort((second, first))
+        return first[order], second[order], shared[order]
+
+    def candidate_pairs(self):
+        """
+        Yields the candidate pairs of each block of rows, in order
+        """
+        for start in self.block_starts():
+            yield self.block_pairs(start)
+
+    def basket_pairs(self, existing=frozenset(), accept=None, candidates=None):
+        """
+        Yields lists of new (source, destination) basket pairs, one list per block.
+
+        A pair is skipped if a relation already exists between the two baskets in either direction
+        (`existing`, or one emitted earlier in the run).
+        `accept(source, destination, source_tokens, destination_tokens, shared)`, if given, can
+        reject a pair of hits, in which case later pairs of hits on the same baskets are still
+        considered.
+        `candidates` can replace `candidate_pairs()`, eg. with blocks computed in worker processes.
+        """
+        related = {(min(pair), max(pair)) for pair in existing}
+
+        if candidates is None:
+            candidates = self.candidate_pairs()
+
+        for first, second, shared in candidates:
+            batch = []
+
+            for i, j, count in zip(first.tolist(), second.tolist(), shared.tolist()):
+                source, destination = int(self.baskets[i]), int(self.baskets[j])
+                key = (min(source, destination), max(source, destination))
+
+                if key in related:
+                    continue
+
+                if accept is not None and \
+                        not accept(source, destination, self.token_sets[i], self.token_sets[j], count):
+                    continue
+
+                related.add(key)
+                batch.append((source, destination))
+
+            yield batch
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.3 on 2026-10-18 11:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hit', '0019_slugtoken'),
+        ('relation', '0005_auto_20161021_1712'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyBasket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('marked', models.DateTimeField(auto_now=True)),
+                ('basket', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='dirty', to='hit.Basket')),
+            ],
+        ),
+    ]
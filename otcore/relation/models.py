@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, connection
 
 from otcore.settings import otcore_settings
 
@@ -38,6 +38,68 @@ class RelatedBasketQuerySet(models.QuerySet):
         for obj in self.select_related('relationtype'):
             obj.check_delete()
 
+    def existing_pairs(self):
+        """
+        Returns the set of (source_id, destination_id) pairs in the queryset
+        """
+        return set(self.values_list('source_id', 'destination_id').order_by())
+
+    def insert_pairs(self, pairs, relationtype, batch_size=5000):
+        """
+        Creates relations of `relationtype` for an iterable of (source_id, destination_id) pairs,
+        using batched multi-row INSERTs.  Pairs that already exist for this relationtype are
+        skipped by the database (ON CONFLICT DO NOTHING), rather than raising an IntegrityError.
+        Returns the number of inserted relations.
+        """
+        table = self.model._meta.db_table
+        relationtype_id = getattr(relationtype, 'id', relationtype)
+        pairs = list(pairs)
+        inserted = 0
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(pairs), batch_size):
+                batch = pairs[start:start + batch_size]
+
+                values = ', '.join(['(%s, false, %s, %s)'] * len(batch))
+                params = [param for source, destination in batch
+                          for param in (relationtype_id, source, destination)]
+
+                cursor.execute(
+                    'INSERT INTO {} (relationtype_id, forbidden, source_id, destination_id) '
+                    'VALUES {} ON CONFLICT DO NOTHING'.format(table, values),
+                    params
+                )
+                inserted += cursor.rowcount
+
+        return inserted
+
+    def delete_pairs(self, pairs, relationtype, batch_size=5000):
+        """
+        Deletes the non-forbidden relations of `relationtype` matching an iterable of
+        (source_id, destination_id) pairs, using batched DELETE statements.
+        Returns the number of deleted relations.
+        """
+        table = self.model._meta.db_table
+        relationtype_id = getattr(relationtype, 'id', relationtype)
+        pairs = list(pairs)
+        deleted = 0
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(pairs), batch_size):
+                batch = pairs[start:start + batch_size]
+
+                values = ', '.join(['(%s, %s)'] * len(batch))
+                params = [relationtype_id] + [param for pair in batch for param in pair]
+
+                cursor.execute(
+                    'DELETE FROM {} WHERE relationtype_id = %s AND NOT forbidden '
+                    'AND (source_id, destination_id) IN (VALUES {})'.format(table, values),
+                    params
+                )
+                deleted += cursor.rowcount
+
+        return deleted
+
 
 class RelatedBasket(models.Model):
     relationtype = models.ForeignKey(RelationType, default=get_default_type, on_delete=models.SET_DEFAULT, related_name='related_baskets')
@@ -75,3 +137,63 @@ class RelatedHit(models.Model):
     class Meta:
         ordering = ('relationtype', 'source', 'destination')
         unique_together = (('relationtype', 'source', 'destination'))
+
+
+class DirtyBasketQuerySet(models.QuerySet):
+    def mark(self, *baskets):
+        """
+        Queues baskets (or basket ids) for automatic relation processing.  Baskets that no
+        longer exist are ignored, and already queued baskets have their timestamp refreshed.
+        Timestamps come from the database clock, at the time of the statement rather than at
+        the start of its transaction, so that a basket marked again always gets a new one.
+        """
+        basket_ids = {getattr(basket, 'id', basket) for basket in baskets if basket is not None}
+        if not basket_ids:
+            return
+
+        table = self.model._meta.db_table
+        basket_table = self.model._meta.get_field('basket').related_model._meta.db_table
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {} (basket_id, marked) '
+                'SELECT id, clock_timestamp() FROM {} WHERE id IN ({}) '
+                'ON CONFLICT (basket_id) DO UPDATE SET marked = EXCLUDED.marked'.format(
+                    table, basket_table, ', '.join(['%s'] * len(basket_ids))
+                ),
+                list(basket_ids)
+            )
+
+    def unmark(self, queued, batch_size=1000):
+        """
+        Removes processed baskets from the queue.  `queued` is a list of (basket_id, marked) as
+        read before processing: a basket marked again since then has a new timestamp, and
+        stays queued.  Timestamps are only ever compared with each other, never with a clock.
+        """
+        table = self.model._meta.db_table
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(queued), batch_size):
+                batch = queued[start:start + batch_size]
+
+                cursor.execute(
+                    'DELETE FROM {0} USING (VALUES {1}) AS processed (basket_id, marked) '
+                    'WHERE {0}.basket_id = processed.basket_id AND {0}.marked = processed.marked'.format(
+                        table, ', '.join(['(%s, %s::timestamptz)'] * len(batch))
+                    ),
+                    [value for row in batch for value in row]
+                )
+
+
+class DirtyBasket(models.Model):
+    """
+    Queue of baskets whose names changed since automatic relations were last computed.
+    See `otcore.relation.processing.process_dirty_baskets`
+    """
+    basket = models.OneToOneField('hit.Basket', related_name='dirty', on_delete=models.CASCADE)
+    marked = models.DateTimeField(auto_now=True)
+
+    objects = DirtyBasketQuerySet.as_manager()
+
+    def __str__(self):
+        return str(self.basket_id)
@@ -0,0 +1,70 @@
+"""
+Sharded execution of the automatic relation rules across a process pool.
+
+The engine is stored in a module global before the pool is created, so forked workers share it
+with the parent instead of receiving a pickled copy.  Workers only compute candidate relations
+and never touch the database: the parent process merges, dedupes and inserts their results.
+"""
+import multiprocessing
+import os
+
+from otcore.common.utils import close_connections_before_fork
+from otcore.settings import otcore_settings
+
+
+_engine = None
+_existing = frozenset()
+
+
+def use_processes():
+    """
+    Returns the number of worker processes to use, or None if the rules should run serially
+    """
+    if otcore_settings.RELATION_EXECUTION != 'parallel':
+        return None
+
+    return otcore_settings.RELATION_PROCESSES or os.cpu_count() or 1
+
+
+def run_sharded(function, shards, engine, existing=frozenset(), processes=None):
+    """
+    Maps `function` over `shards` in a pool of forked processes sharing `engine` and `existing`.
+    Results are returned in the order of the shards.
+    """
+    global _engine, _existing
+
+    _engine, _existing = engine, existing
+
+    try:
+        close_connections_before_fork()
+
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes) as pool:
+            return pool.map(function, shards)
+    finally:
+        _engine, _existing = None, frozenset()
+
+
+def _containment_shard(slugs):
+    return _engine.basket_pairs(existing=_existing, slugs=slugs)
+
+
+def _multiple_tokens_block(start):
+    return _engine.block_pairs(start)
+
+
+def containment_pairs(engine, existing, processes):
+    """
+    Containment pairs of a ContainmentEngine, with slugs sharded by their rarest token
+    """
+    results = run_sharded(_containment_shard, engine.shards(processes * 4), engine, existing, processes)
+
+    return set().union(*results)
+
+
+def multiple_tokens_candidates(engine, processes):
+    """
+    Candidate hit pairs of a MultipleTokensEngine, one block of rows per task.  Blocks are
+    returned in order, so the sequential dedupe of `basket_pairs` gives the same relations.
+    """
+    return run_sharded(_multiple_tokens_block, engine.block_starts(), engine, processes=processes)
@@ -1,8 +1,11 @@
 from django.db.models import Q, Count
-from otcore.hit.models import Hit, Basket
-from otcore.relation.models import RelationType, RelatedBasket
+from otcore.hit.models import Hit, Basket, SlugToken
+from otcore.relation.models import RelationType, RelatedBasket, DirtyBasket
 from otcore.topic.models import Tokengroup
 from otcore.settings import otcore_settings
+from .cache import RelationCache
+from .engines import ContainmentEngine, MultipleTokensEngine
+from . import parallel
 
 
 
@@ -31,18 +34,22 @@ def get_rtypes():
 def global_containment():
     """
     Runs the containment rule for every hit.
+    A basket is contained by another if one of its slugs is a strict subset of one of the other's
+    slugs, and no relation (of any type) already exists from the first to the second
     """
     rtypes = get_rtypes()
 
-    counter=0
-    all_slugs = Hit.objects.order_by('slug').distinct('slug').values_list('slug', flat=True)
-    slug_sets = [(frozenset(slug.split('-')), slug) for slug in all_slugs]
-    slug_sets = sorted(list(slug_sets), key=lambda x: len(x[0]))
+    rows = Hit.objects.filter(basket__isnull=False).values_list('slug', 'basket_id').order_by().distinct()
+    engine = ContainmentEngine(rows)
+    existing = RelatedBasket.objects.existing_pairs()
 
-    while len(slug_sets) > 0:
-        single_hit_containment(slug_sets[0], slug_sets[1:], rtypes)
-        slug_sets = slug_sets[1:]
-        counter += 1
+    processes = parallel.use_processes()
+    if processes:
+        pairs = parallel.containment_pairs(engine, existing, processes)
+    else:
+        pairs = engine.basket_pairs(existing=existing)
+
+    return RelatedBasket.objects.insert_pairs(sorted(pairs), rtypes['containment'])
 
 
 def process_single_basket(basket):
@@ -52,94 +59,130 @@ def process_single_basket(basket):
     rtypes = get_rtypes()
 
     # Containment
-    all_slugs = Hit.objects.order_by('slug').distinct('slug').values_list('slug', flat=True)
-    slug_sets = [(frozenset(slug.split('-')), slug) for slug in all_slugs]
-
     basket_slugs = basket.topic_hits.order_by('slug').distinct('slug').values_list('slug', flat=True)
 
     for slug in basket_slugs:
-        slug_set = (frozenset(slug.split('-')), slug)
-        longer_slugs = [s for s in slug_sets if len(slug_set[0]) < len(s[0])]
-        single_hit_containment(slug_set, longer_slugs, rtypes)
-
-        shorter_slugs = [s for s in slug_sets if len(slug_set[0]) > len(s[0])]
-        reverse_containment(slug_set, shorter_slugs, rtypes)
+        indexed_containment(slug, rtypes)
 
     # Multiple Tokens
     basket.local_tokengroup()
-    for tokengroup in basket.tokengroups.all():
-        single_tokengroup_check(tokengroup, rtypes)
+    tokengroups = list(basket.tokengroups.all())
+    cache = RelationCache.for_baskets(
+        Basket.objects.filter(tokengroups__in=tokengroups).values_list('id', flat=True).distinct()
+    )
+
+    for tokengroup in tokengroups:
+        single_tokengroup_check(tokengroup, rtypes, cache=cache)
+
+
+def indexed_containment(slug, rtypes):
+    """
+    Runs containment on a single slug, fetching its longer and shorter candidates
+    from the SlugToken index
+    """
+    slug_set = (frozenset(slug.split('-')), slug)
+
+    longer_slugs = indexed_slug_sets(SlugToken.objects.supersets(slug_set[0], 'hit__slug'))
+    single_hit_containment(slug_set, longer_slugs, rtypes)
+
+    shorter_slugs = indexed_slug_sets(SlugToken.objects.subsets(slug_set[0], 'hit__slug'))
+    reverse_containment(slug_set, shorter_slugs, rtypes)
 
 
-def single_hit_containment(slug_set, slug_sets, rtypes):
+def indexed_slug_sets(rows):
+    """
+    Turns SlugToken lookup rows into a sorted list of (token set, slug) tuples
+    """
+    slugs = sorted({row['hit__slug'] for row in rows})
+    return [(frozenset(slug.split('-')), slug) for slug in slugs]
+
+
+def slug_baskets(slugs):
+    """
+    Maps each slug to the sorted ids of the baskets of its hits, in a single query
+    """
+    baskets = {slug: set() for slug in slugs}
+
+    rows = Hit.objects.filter(slug__in=list(baskets), basket__isnull=False) \
+        .values_list('slug', 'basket_id').order_by().distinct()
+    for slug, basket_id in rows:
+        baskets[slug].add(basket_id)
+
+    return {slug: sorted(ids) for slug, ids in baskets.items()}
+
+
+def single_hit_containment(slug_set, slug_sets, rtypes, cache=None):
     """
     runs containment on a single slug.  Assumes that the slug being passed in is
     shorter than the remaining slugs.  If it's longer, run the `reverse_containment` instead
+
+    Existing relations are checked against `cache` (a RelationCache).  If none is passed, the
+    relations from the baskets of the slug are loaded.
     """
     results = [s[1] for s in slug_sets if slug_set[0] < s[0]]
+    if not results:
+        return
 
-    for result in results:
-        source_hits = Hit.objects.filter(slug=slug_set[1], basket__isnull=False)
-        result_hits = Hit.objects.filter(slug=result, basket__isnull=False)
+    baskets = slug_baskets([slug_set[1]] + results)
+    source_baskets = baskets[slug_set[1]]
 
-        for source_hit in source_hits:
-            for result_hit in result_hits:
-                if source_hit.basket != result_hit.basket and not RelatedBasket.objects.filter(source=source_hit.basket, destination=result_hit.basket).exists():
-                    RelatedBasket.objects.create(
-                        relationtype=rtypes['containment'],
-                        source=source_hit.basket,
-                        destination=result_hit.basket
-                    )
+    if cache is None:
+        cache = RelationCache.load(RelatedBasket.objects.filter(source_id__in=source_baskets))
+
+    for result in results:
+        for source_basket in source_baskets:
+            for result_basket in baskets[result]:
+                if source_basket != result_basket and not cache.exists(source_basket, result_basket):
+                    cache.create(source_basket, result_basket, rtypes['containment'])
 
 
-def reverse_containment(slug_set, slug_sets, rtypes):
+def reverse_containment(slug_set, slug_sets, rtypes, cache=None):
+    """
+    Runs containment on a single slug against the shorter slugs.  If no `cache` is passed, the
+    relations to the baskets of the slug are loaded.
+    """
     results = [s[1] for s in slug_sets if s[0] < slug_set[0]]
+    if not results:
+        return
 
-    for result in results:
-        source_hits = Hit.objects.filter(slug=slug_set[1], basket__isnull=False)
-        result_hits = Hit.objects.filter(slug=result, basket__isnull=False)
+    baskets = slug_baskets([slug_set[1]] + results)
+    source_baskets = baskets[slug_set[1]]
 
-        for source_hit in source_hits:
-            for result_hit in result_hits:
-                if source_hit.basket != result_hit.basket and not RelatedBasket.objects.filter(source=result_hit.basket, destination=source_hit.basket).exists():
-                    RelatedBasket.objects.create(
-                        relationtype=rtypes['containment'],
-                        source=result_hit.basket,
-                        destination=source_hit.basket
-                    )
+    if cache is None:
+        cache = RelationCache.load(RelatedBasket.objects.filter(destination_id__in=source_baskets))
+
+    for result in results:
+        for source_basket in source_baskets:
+            for result_basket in baskets[result]:
+                if source_basket != result_basket and not cache.exists(result_basket, source_basket):
+                    cache.create(result_basket, source_basket, rtypes['containment'])
 
 
 def one_containment(name):
     """
     Runs the containment rule for one hit.
     """
-    all_slugs = Hit.objects.order_by('slug').distinct('slug').values_list('slug', flat=True)
-    slug_sets = [(frozenset(slug.split('-')), slug) for slug in all_slugs]
-
     rtypes = get_rtypes()
 
     hits = Hit.objects.filter(name=name)
-    slug = hits[0].slug
-
-    slug_set = (frozenset(slug.split('-')), slug)
-    longer_slugs = [s for s in slug_sets if len(slug_set[0]) < len(s[0])]
-    single_hit_containment(slug_set, longer_slugs, rtypes)
-
-    shorter_slugs = [s for s in slug_sets if len(slug_set[0]) > len(s[0])]
-    reverse_containment(slug_set, shorter_slugs, rtypes)
+    indexed_containment(hits[0].slug, rtypes)
 
 
 def global_tokengroups():
     """
-    Create token groups for all baskets.
+    Create token groups for all baskets, in batches of TOKENGROUP_BATCH_SIZE baskets.
     """
     print('Processing: Global Token Groups')
-    counter = 0
-    baskets_number = Basket.objects.count()
-    for basket in Basket.objects.all().order_by('id').distinct('id'):
-        counter += 1
-        print('TOKENGROUPS: %s of %s' % (counter, baskets_number))
-        basket.local_tokengroup()
+    batch_size = otcore_settings.TOKENGROUP_BATCH_SIZE
+    basket_ids = list(Basket.objects.order_by('id').values_list('id', flat=True))
+
+    skipped = []
+    for start in range(0, len(basket_ids), batch_size):
+        print('TOKENGROUPS: %s of %s' % (min(start + batch_size, len(basket_ids)), len(basket_ids)))
+        skipped += Basket.build_tokengroups(basket_ids[start:start + batch_size])
+
+    if skipped:
+        print('TOKENGROUPS: skipped {} baskets over the combination limit'.format(len(skipped)))
 
 
 def global_multiple_tokens():
@@ -148,31 +191,33 @@ def global_multiple_tokens():
     """
     rtypes = get_rtypes()
 
+    cache = RelationCache.load()
+
     counter=0
     total=Tokengroup.objects.annotate(c=Count('basket')).filter(c__gt=1).count()
     for tokengroup in Tokengroup.objects.annotate(c=Count('basket')).filter(c__gt=1):
         print("Multiple Tokens {} of {}".format(counter, total))
         counter += 1
 
-        single_tokengroup_check(tokengroup, rtypes)
+        single_tokengroup_check(tokengroup, rtypes, cache=cache)
 
 
-def single_tokengroup_check(tokengroup, rtypes):
+def single_tokengroup_check(tokengroup, rtypes, cache=None):
     """
-    Does a multipletoken check on a single tokengropu
+    Does a multipletoken check on a single tokengropu.  If no `cache` is passed, the relations
+    of the tokengroup's baskets are loaded.
     """
-    baskets = list(tokengroup.basket_set.all())
+    baskets = list(tokengroup.basket_set.values_list('id', flat=True))
+
+    if cache is None:
+        cache = RelationCache.for_baskets(baskets)
 
     while len(baskets) > 1:
         source_basket = baskets.pop()
 
         for dest_basket in baskets:
-            if not RelatedBasket.objects.filter(source=source_basket, destination=dest_basket).exists() and not RelatedBasket.objects.filter(source=dest_basket, destination=source_basket).exists():
-                RelatedBasket.objects.create(
-                    relationtype=rtypes['multipletokens'],
-                    source=source_basket,
-                    destination=dest_basket
-                )
+            if not cache.related(source_basket, dest_basket):
+                cache.create(source_basket, dest_basket, rtypes['multipletokens'])
 
 
 def alt_global_multiple_tokens():
@@ -181,34 +226,138 @@ def alt_global_multiple_tokens():
     """
     rtypes = get_rtypes()
 
-    hits = Hit.objects.all()
-    slug_sets = [(frozenset(hit.slug.split('-')), hit) for hit in hits if len(frozenset(hit.slug.split('-'))) >= otcore_settings.MULTIPLE_RELATIONS_COUNT]
+    engine = MultipleTokensEngine(
+        Hit.objects.values_list('slug', 'basket_id'),
+        otcore_settings.MULTIPLE_RELATIONS_COUNT,
+        block_size=otcore_settings.MULTIPLE_TOKENS_BLOCK_SIZE
+    )
 
-    counter=0
-    total=len(slug_sets)
-    while len(slug_sets) > 1:
-        counter += 1
-        print("Multiple Tokens {} of {}".format(counter, total))
+    processes = parallel.use_processes()
+    candidates = parallel.multiple_tokens_candidates(engine, processes) if processes else None
+
+    inserted = 0
+    for pairs in engine.basket_pairs(existing=RelatedBasket.objects.existing_pairs(), candidates=candidates):
+        inserted += RelatedBasket.objects.insert_pairs(pairs, rtypes['multipletokens'])
 
-        alt_single_set_multiple_tokens(slug_sets[0], slug_sets[1:], rtypes)
-        slug_sets = slug_sets[1:]
+    return inserted
 
 
-def alt_single_set_multiple_tokens(slug_set, slug_sets, rtypes):
+def alt_single_set_multiple_tokens(slug_set, slug_sets, rtypes, cache=None):
     """
-    Check for multiple token relations on a single hit/slug_set pair
+    Check for multiple token relations on a single hit/slug_set pair.  If no `cache` is
+    passed, the relations of the hit's basket are loaded.
     """
     intersections = [s for s in slug_sets if len(s[0].intersection(slug_set[0])) >= otcore_settings.MULTIPLE_RELATIONS_COUNT]
+    hit1 = slug_set[1]
+
+    if cache is None and intersections:
+        cache = RelationCache.for_baskets([hit1.basket_id])
 
     for hit_set in intersections:
-        hit1 = slug_set[1]
         hit2 = hit_set[1]
 
-        if hit1.basket != hit2.basket and \
-                not RelatedBasket.objects.filter(source=hit1.basket, destination=hit2.basket).exists() and \
-                not RelatedBasket.objects.filter(source=hit2.basket, destination=hit1.basket).exists():
-            RelatedBasket.objects.create(
-                relationtype=rtypes['multipletokens'],
-                source=hit1.basket,
-                destination=hit2.basket
-            )
+        if hit1.basket_id != hit2.basket_id and not cache.related(hit1.basket_id, hit2.basket_id):
+            cache.create(hit1.basket_id, hit2.basket_id, rtypes['multipletokens'])
+
+
+def process_dirty_baskets(limit=None):
+    """
+    Recomputes Containment and MultipleTokens relations for the baskets queued in DirtyBasket,
+    using the SlugToken index.  Returns the number of processed baskets.
+
+    If the MULTIPLE_TOKENS_FILTER setting is set, it's called to build an extra check on
+    MultipleTokens pairs (see `refresh_basket_relations`)
+    """
+    rtypes = get_rtypes()
+
+    pair_filter = otcore_settings.MULTIPLE_TOKENS_FILTER
+    if pair_filter is not None:
+        pair_filter = pair_filter()
+
+    queued = list(DirtyBasket.objects.order_by('marked').values_list('basket_id', 'marked')[:limit])
+
+    for basket_id, _ in queued:
+        refresh_basket_relations(basket_id, rtypes, pair_filter=pair_filter)
+
+    # baskets marked again while processing stay queued
+    DirtyBasket.objects.unmark(queued)
+
+    return len(queued)
+
+
+def refresh_basket_relations(basket_id, rtypes, pair_filter=None):
+    """
+    Brings the automatic relations of a single basket in line with its current names.
+    Containment and MultipleTokens relations that no longer hold are deleted, unless they
+    are forbidden.  Missing relations are created, following the same rules as
+    `global_containment` and `alt_global_multiple_tokens`.
+
+    `pair_filter(source, destination, source_tokens, destination_tokens, shared)` can reject a
+    MultipleTokens pair of hits
+    """
+    min_count = otcore_settings.MULTIPLE_RELATIONS_COUNT
+    hits = Hit.objects.filter(basket_id=basket_id).values_list('name', 'slug')
+
+    containment = set()
+    multiple_tokens = {}
+
+    for name, slug in hits:
+        tokens = frozenset(slug.split('-'))
+
+        for row in SlugToken.objects.supersets(tokens, 'hit__basket'):
+            if row['hit__basket'] not in (None, basket_id):
+                containment.add((basket_id, row['hit__basket']))
+
+        for row in SlugToken.objects.subsets(tokens, 'hit__basket'):
+            if row['hit__basket'] not in (None, basket_id):
+                containment.add((row['hit__basket'], basket_id))
+
+        if len(tokens) < min_count:
+            continue
+
+        for row in SlugToken.objects.overlaps(tokens, min_count, 'hit__basket', 'hit__name', 'hit__slug'):
+            other = row['hit__basket']
+            if other in (None, basket_id):
+                continue
+
+            # as in the global rule, the hit that comes first by name is the source
+            other_tokens = frozenset(row['hit__slug'].split('-'))
+            if name <= row['hit__name']:
+                order, pair = (name, row['hit__name']), (basket_id, other)
+                pair_tokens = (tokens, other_tokens)
+            else:
+                order, pair = (row['hit__name'], name), (other, basket_id)
+                pair_tokens = (other_tokens, tokens)
+
+            if pair_filter is not None and not pair_filter(*pair, *pair_tokens, row['matched']):
+                continue
+
+            key = (min(pair), max(pair))
+            if key not in multiple_tokens or order < multiple_tokens[key][0]:
+                multiple_tokens[key] = (order, pair)
+
+    relations = RelatedBasket.objects.filter(Q(source_id=basket_id) | Q(destination_id=basket_id))
+
+    # Retract automatic relations that no longer hold
+    stale = []
+    for relation in relations.filter(forbidden=False, relationtype__in=[rtypes['containment'], rtypes['multipletokens']]):
+        pair = (relation.source_id, relation.destination_id)
+
+        if relation.relationtype_id == rtypes['containment'].id and pair not in containment:
+            stale.append(relation.id)
+        elif relation.relationtype_id == rtypes['multipletokens'].id and (min(pair), max(pair)) not in multiple_tokens:
+            stale.append(relation.id)
+
+    RelatedBasket.objects.filter(id__in=stale).delete()
+
+    existing = relations.existing_pairs()
+
+    new_containment = sorted(pair for pair in containment if pair not in existing)
+    RelatedBasket.objects.insert_pairs(new_containment, rtypes['containment'])
+    existing.update(new_containment)
+
+    new_multiple_tokens = sorted(
+        pair for _, pair in multiple_tokens.values()
+        if pair not in existing and pair[::-1] not in existing
+    )
+    RelatedBasket.objects.insert_pairs(new_multiple_tokens, rtypes['multipletokens'])
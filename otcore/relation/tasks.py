@@ -0,0 +1,14 @@
+from .processing import global_containment, alt_global_multiple_tokens
+
+
+def automatic_relations_task(job):
+    job.set_stage('containment')
+    containment = global_containment()
+
+    job.set_stage('multiple tokens')
+    multiple_tokens = alt_global_multiple_tokens()
+
+    return {
+        'containment': containment,
+        'multiple_tokens': multiple_tokens,
+    }
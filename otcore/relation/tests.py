@@ -1,10 +1,22 @@
 from django.test import TestCase
 
-from otcore.hit.models import Basket
-from otcore.relation.models import RelatedBasket
+import itertools
+import os
+import random
+import tempfile
+
+from django.conf import settings
+from django.test import override_settings
+from rest_framework.test import APIClient
+from otcore.hit.models import Basket, Hit
+from otcore.relation.models import RelatedBasket, RelationType, DirtyBasket
 from otcore.lex.models import Recognizer
 
-from .processing import global_containment, process_single_basket
+from .cache import RelationCache
+from .changeset import compute_changeset, write_changeset, read_changeset, apply_changeset
+from .engines import ContainmentEngine, MultipleTokensEngine
+from .processing import global_containment, process_single_basket, process_dirty_baskets, get_rtypes, \
+    alt_global_multiple_tokens, single_hit_containment, alt_single_set_multiple_tokens
 
 
 class ContainmentTests(TestCase):
@@ -86,3 +98,315 @@ class ContainmentTests(TestCase):
         global_containment()
 
         self.assertEqual(RelatedBasket.objects.count(), 5)
+
+    def test_global_containment_skips_existing_relations(self):
+        """
+        A relation of any type from the contained basket blocks a new Containment, but a relation
+        in the opposite direction doesn't
+        """
+        basket1 = Basket.create_from_string("Nash")
+        basket2 = Basket.create_from_string("John Nash")
+        basket3 = Basket.create_from_string("Nash Equilibrium")
+        generic = RelationType.objects.create(rtype="Generic Relation")
+        RelatedBasket.objects.create(source=basket1, destination=basket2, relationtype=generic)
+        RelatedBasket.objects.create(source=basket3, destination=basket1, relationtype=generic)
+
+        global_containment()
+        global_containment()
+
+        self.assertEqual(RelatedBasket.objects.count(), 3)
+        self.assertIsContained(basket1, basket3)
+        self.assertEqual(RelatedBasket.objects.filter(source=basket1, destination=basket2).get().relationtype, generic)
+
+    def test_engine_matches_pairwise_scan(self):
+        """
+        The posting list engine finds exactly the basket pairs of a pairwise subset comparison
+        """
+        rng = random.Random(5)
+        tokens = ['a', 'b', 'c', 'd', 'e', 'f']
+        rows = set()
+        for basket_id in range(40):
+            for _ in range(rng.randint(1, 2)):
+                slug = '-'.join(sorted(rng.sample(tokens, rng.randint(1, 4))))
+                rows.add((slug, basket_id))
+
+        expected = set()
+        for (slug1, basket1), (slug2, basket2) in itertools.permutations(rows, 2):
+            if frozenset(slug1.split('-')) < frozenset(slug2.split('-')) and basket1 != basket2:
+                expected.add((basket1, basket2))
+
+        self.assertEqual(ContainmentEngine(rows).basket_pairs(), expected)
+
+
+class MultipleTokensEngineTests(TestCase):
+    def sequential_pairs(self, rows, min_count):
+        """
+        Pairwise version of the rule, as run by alt_single_set_multiple_tokens
+        """
+        slug_sets = [(frozenset(slug.split('-')), basket) for slug, basket in rows
+                     if len(frozenset(slug.split('-'))) >= min_count]
+        pairs = []
+        for index, (tokens1, basket1) in enumerate(slug_sets):
+            for tokens2, basket2 in slug_sets[index + 1:]:
+                if len(tokens1 & tokens2) >= min_count and basket1 != basket2 and \
+                        (basket1, basket2) not in pairs and (basket2, basket1) not in pairs:
+                    pairs.append((basket1, basket2))
+
+        return pairs
+
+    def test_engine_matches_pairwise_scan(self):
+        """
+        The sparse engine finds the same relations, in the same directions, as a pairwise scan
+        """
+        rng = random.Random(6)
+        tokens = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+        rows = [('-'.join(sorted(rng.sample(tokens, rng.randint(2, 6)))), rng.randint(1, 30))
+                for _ in range(80)]
+
+        engine = MultipleTokensEngine(rows, 3, block_size=7)
+        pairs = [pair for batch in engine.basket_pairs() for pair in batch]
+
+        self.assertEqual(pairs, self.sequential_pairs(rows, 3))
+
+    def test_engine_skips_existing_relations(self):
+        """
+        Existing relations in either direction block a new relation
+        """
+        rows = [('a-b-c', 1), ('a-b-c-d', 2), ('a-b-c-e', 3)]
+        engine = MultipleTokensEngine(rows, 3)
+
+        pairs = [pair for batch in engine.basket_pairs(existing={(2, 1)}) for pair in batch]
+
+        self.assertEqual(pairs, [(1, 3), (2, 3)])
+
+
+class RelationCacheTests(TestCase):
+    def setUp(self):
+        Recognizer.objects.create(recognizer=r'[^\w\s-]', replacer='')
+        self.rtypes = get_rtypes()
+
+        self.nash = Basket.create_from_string("Nash")
+        self.john_nash = Basket.create_from_string("John Nash")
+        self.john_forbes_nash = Basket.create_from_string("John Forbes Nash")
+
+    def test_lookups(self):
+        """
+        Pairs are tracked per relation type, and created relations are added to the cache
+        """
+        RelatedBasket.objects.create(source=self.nash, destination=self.john_nash,
+                                     relationtype=self.rtypes['containment'])
+        cache = RelationCache.load()
+
+        self.assertTrue(cache.exists(self.nash, self.john_nash))
+        self.assertTrue(cache.exists(self.nash.id, self.john_nash.id, self.rtypes['containment']))
+        self.assertFalse(cache.exists(self.nash, self.john_nash, self.rtypes['multipletokens']))
+        self.assertFalse(cache.exists(self.john_nash, self.nash))
+        self.assertTrue(cache.related(self.john_nash, self.nash))
+
+        cache.create(self.john_nash, self.john_forbes_nash, self.rtypes['multipletokens'])
+        self.assertTrue(cache.exists(self.john_nash, self.john_forbes_nash, self.rtypes['multipletokens']))
+        self.assertEqual(RelatedBasket.objects.count(), 2)
+
+    def test_rules_use_cache(self):
+        """
+        Rule functions check for existing relations in the cache instead of the database
+        """
+        cache = RelationCache.load()
+        slug_sets = [(frozenset(hit.slug.split('-')), hit.slug) for hit in Hit.objects.all()]
+
+        with self.assertNumQueries(3):
+            single_hit_containment((frozenset(['nash']), 'nash'), slug_sets, self.rtypes, cache=cache)
+
+        self.assertTrue(cache.exists(self.nash, self.john_forbes_nash))
+        self.assertEqual(RelatedBasket.objects.count(), 2)
+
+        Basket.create_from_string("John Forbes Nash Junior")
+        hit_sets = [(frozenset(hit.slug.split('-')), hit) for hit in Hit.objects.filter(name__startswith='John Forbes')]
+
+        # the reverse check finds the relation created by the first call in the cache
+        with self.assertNumQueries(1):
+            alt_single_set_multiple_tokens(hit_sets[0], hit_sets, self.rtypes, cache=cache)
+            alt_single_set_multiple_tokens(hit_sets[1], hit_sets, self.rtypes, cache=cache)
+
+    def test_loads_cache_when_missing(self):
+        """
+        Without a cache, rule functions load the relations they need and skip existing ones
+        """
+        RelatedBasket.objects.create(source=self.nash, destination=self.john_nash,
+                                     relationtype=self.rtypes['containment'])
+        slug_sets = [(frozenset(hit.slug.split('-')), hit.slug) for hit in Hit.objects.all()]
+
+        single_hit_containment((frozenset(['nash']), 'nash'), slug_sets, self.rtypes)
+
+        self.assertEqual(RelatedBasket.objects.filter(source=self.nash).count(), 2)
+
+
+class DirtyBasketTests(TestCase):
+    def setUp(self):
+        Recognizer.objects.create(recognizer=r'[^\w\s-]', replacer='')
+        self.rtypes = get_rtypes()
+
+        self.nash = Basket.create_from_string("Nash")
+        self.john_nash = Basket.create_from_string("John Nash")
+        global_containment()
+
+    def rename(self, basket, name):
+        hit = basket.topic_hits.get()
+        hit.name = name
+        hit.save()
+        DirtyBasket.objects.mark(basket)
+
+    def test_retracts_stale_relations(self):
+        """
+        A containment relation is removed once the names no longer contain each other
+        """
+        self.assertTrue(RelatedBasket.objects.filter(source=self.nash, destination=self.john_nash).exists())
+
+        self.rename(self.john_nash, "John Smith")
+        self.assertEqual(process_dirty_baskets(), 1)
+
+        self.assertEqual(RelatedBasket.objects.count(), 0)
+        self.assertEqual(DirtyBasket.objects.count(), 0)
+
+    def test_keeps_forbidden_relations(self):
+        """
+        Forbidden relations are kept, and block recreation of the relation
+        """
+        RelatedBasket.objects.filter(source=self.nash, destination=self.john_nash).update(forbidden=True)
+
+        self.rename(self.john_nash, "John Smith")
+        self.rename(self.john_nash, "John Nash")
+        process_dirty_baskets()
+
+        self.assertEqual(RelatedBasket.objects.get().forbidden, True)
+
+    def test_creates_new_relations(self):
+        """
+        Containment and MultipleTokens relations are created for the dirty basket only
+        """
+        nash_equilibrium = Basket.create_from_string("Nash Equilibrium Game Theory")
+        game_theory = Basket.create_from_string("Game Theory Equilibrium Models")
+
+        DirtyBasket.objects.mark(nash_equilibrium)
+        process_dirty_baskets()
+
+        self.assertTrue(RelatedBasket.objects.filter(
+            source=self.nash, destination=nash_equilibrium, relationtype=self.rtypes['containment']).exists())
+        self.assertTrue(RelatedBasket.objects.filter(
+            source=game_theory, destination=nash_equilibrium, relationtype=self.rtypes['multipletokens']).exists())
+        self.assertEqual(RelatedBasket.objects.count(), 3)
+
+    def test_marked_again_stays_queued(self):
+        """
+        A basket marked again after the queue was read stays queued once it's processed
+        """
+        DirtyBasket.objects.mark(self.nash)
+        queued = list(DirtyBasket.objects.values_list('basket_id', 'marked'))
+
+        DirtyBasket.objects.mark(self.nash)
+        DirtyBasket.objects.unmark(queued)
+        self.assertEqual(DirtyBasket.objects.count(), 1)
+
+        DirtyBasket.objects.unmark(list(DirtyBasket.objects.values_list('basket_id', 'marked')))
+        self.assertEqual(DirtyBasket.objects.count(), 0)
+
+    def test_dirty_endpoint_validates_limit(self):
+        self.rename(self.john_nash, "John Smith")
+        self.rename(self.nash, "Nash Smith")
+
+        client = APIClient()
+        self.assertEqual(client.post('/api/relation/automatic/dirty/', {'limit': 'all'}).status_code, 400)
+        self.assertEqual(client.post('/api/relation/automatic/dirty/', {'limit': '-1'}).status_code, 400)
+
+        response = client.post('/api/relation/automatic/dirty/', {'limit': '1'})
+        self.assertEqual(response.data, {'processed': 1})
+        self.assertEqual(DirtyBasket.objects.count(), 1)
+
+
+class ParallelExecutionTests(TestCase):
+    def setUp(self):
+        Recognizer.objects.create(recognizer=r'[^\w\s-]', replacer='')
+
+        names = ["Nash", "John Nash", "John Forbes Nash", "Nash Equilibrium Game Theory",
+                 "Game Theory Equilibrium Models", "Crosby, Stills, and Nash",
+                 "Crosby, Stills, Nash, and Young", "Young Crosby Stills Models"]
+        for name in names:
+            Basket.create_from_string(name)
+
+    def run_rules(self):
+        RelatedBasket.objects.all().delete()
+        global_containment()
+        alt_global_multiple_tokens()
+
+        return set(RelatedBasket.objects.values_list('relationtype__rtype', 'source_id', 'destination_id'))
+
+    def test_parallel_matches_serial(self):
+        """
+        Sharded execution creates the same relations as serial execution
+        """
+        serial = self.run_rules()
+
+        parallel_settings = dict(settings.OTCORE, RELATION_EXECUTION='parallel', RELATION_PROCESSES=2)
+        with override_settings(OTCORE=parallel_settings):
+            parallel = self.run_rules()
+
+        self.assertEqual(parallel, serial)
+        self.assertTrue(len(serial) > 5)
+
+
+class ChangesetTests(TestCase):
+    def setUp(self):
+        Recognizer.objects.create(recognizer=r'[^\w\s-]', replacer='')
+        self.rtypes = get_rtypes()
+
+        names = ["Nash", "John Nash", "John Forbes Nash", "Nash Equilibrium Game Theory",
+                 "Game Theory Equilibrium Models", "Crosby, Stills, and Nash"]
+        self.baskets = [Basket.create_from_string(name) for name in names]
+
+    def relations(self):
+        return set(RelatedBasket.objects.values_list('relationtype__rtype', 'source_id', 'destination_id', 'forbidden'))
+
+    def test_dry_run_matches_rules(self):
+        """
+        The changeset holds the relations the rules would create, and nothing is written
+        """
+        changeset = compute_changeset()
+        self.assertEqual(RelatedBasket.objects.count(), 0)
+        self.assertEqual(set(changeset['timings']), {'load', 'containment', 'multipletokens', 'diff'})
+
+        global_containment()
+        alt_global_multiple_tokens()
+        expected = self.relations()
+        RelatedBasket.objects.all().delete()
+
+        apply_changeset(changeset)
+        self.assertEqual(self.relations(), expected)
+
+        # nothing left to change
+        changeset = compute_changeset()
+        self.assertEqual(changeset['add'], {'containment': [], 'multipletokens': []})
+        self.assertEqual(changeset['remove'], {'containment': [], 'multipletokens': []})
+
+    def test_removes_stale_relations(self):
+        """
+        Automatic relations that don't hold anymore are removed, forbidden ones are kept
+        """
+        nash, john_nash, john_forbes_nash, equilibrium = self.baskets[:4]
+        RelatedBasket.objects.create(source=john_nash, destination=equilibrium,
+                                     relationtype=self.rtypes['containment'])
+        RelatedBasket.objects.create(source=nash, destination=john_nash,
+                                     relationtype=self.rtypes['containment'], forbidden=True)
+
+        filename = os.path.join(tempfile.mkdtemp(), 'changeset.json.gz')
+        write_changeset(compute_changeset(), filename)
+        changeset = read_changeset(filename)
+
+        self.assertEqual(changeset['remove']['containment'], [[john_nash.id, equilibrium.id]])
+        self.assertNotIn([nash.id, john_nash.id], changeset['add']['containment'])
+        self.assertIn([john_nash.id, john_forbes_nash.id], changeset['add']['containment'])
+
+        counts = apply_changeset(changeset)
+
+        self.assertEqual(counts['removed']['containment'], 1)
+        self.assertFalse(RelatedBasket.objects.filter(source=john_nash, destination=equilibrium).exists())
+        self.assertTrue(RelatedBasket.objects.get(source=nash, destination=john_nash).forbidden)
@@ -7,10 +7,11 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from otcore.topic.models import Tokengroup
+from otcore.job.views import enqueued_response
 from .models import RelatedBasket, RelationType
 from .serializers import RelatedBasketSimpleSerializer, RelationTypeSerializer, \
     RelatedBasketSerializer, RelationTypeWithCountsSerializer, RelatedBasketListSerializer
-from .processing import global_containment, alt_global_multiple_tokens
+from .processing import process_dirty_baskets
 
 
 ##########################################
@@ -132,11 +133,33 @@ class ForbiddenRelationsByBasketView(APIView):
 
 
 class RunAutomaticRelationsView(APIView):
+    """
+    Queues global containment and multiple tokens as a background job.
+    Returns the job, which can be polled at /api/job/JOB_ID/
+    """
     def post(self, request, *args, **kwargs):
-        global_containment()
-        alt_global_multiple_tokens()
-        
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        return enqueued_response('otcore.relation.tasks.automatic_relations_task')
+
+
+class ProcessDirtyBasketsView(APIView):
+    """
+    Recomputes automatic relations for the baskets edited since the last run
+    """
+    def post(self, request, *args, **kwargs):
+        limit = request.data.get('limit', None)
+
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except (TypeError, ValueError):
+                limit = -1
+
+            if limit < 0:
+                return Response({'error': 'limit must be a positive integer'}, status.HTTP_400_BAD_REQUEST)
+
+        processed = process_dirty_baskets(limit=limit)
+
+        return Response({'processed': processed})
 
 
 class RelationFilter(django_filters.rest_framework.FilterSet):
@@ -14,6 +14,12 @@ DEFAULTS = {
     'LOCAL_MULTIPLE_TOKENS': False,
     'MULTIPLE_RELATIONS_COUNT': 3,
     'AUTOMATIC_RELATIONTYPES': ['MultipleTokens', 'Containment'],
+    'MULTIPLE_TOKENS_BLOCK_SIZE': 2000,
+    'MULTIPLE_TOKENS_FILTER': None,
+    'RELATION_EXECUTION': 'serial',
+    'RELATION_PROCESSES': None,
+    'TOKENGROUP_COMBINATION_LIMIT': 5000,
+    'TOKENGROUP_BATCH_SIZE': 1000,
 
     # View Data
     'BASKET_TRANSFORMER': 'otcore.hit.processing.BasketTransformer',
@@ -25,10 +31,17 @@ DEFAULTS = {
     'CACHE_RECOGNIZERS': True,
     'INITIAL_FILE_STOPWORDS': os.path.join(settings.BASE_DIR, 'otcore', 'lex', 'initial', 'stopwords.txt'),
     'INITIAL_FILE_RECOGNIZERS': 'otcore.lex.initial.recognizers',
+    'SLUG_CACHE_SIZE': 50000,
+    'SLUG_ENGINE_CHECK_INTERVAL': 5,
+
+    # Re-slugification
+    'RESLUG_BATCH_SIZE': 5000,
+    'RESLUG_PROCESSES': None,
 }
 
 IMPORT_STRINGS = (
     'BASKET_TRANSFORMER',
+    'MULTIPLE_TOKENS_FILTER',
     'WHOLE_NAME_TOKENIZERS',
     'SINGLE_WORD_TOKENIZERS',
 )
@@ -78,6 +91,17 @@ class OTCoreSettings:
         if not hasattr(self, '_user_settings'):
             self._user_settings = getattr(settings, 'OTCORE', {})
         return self._user_settings
+
+    def reload(self):
+        """
+        Clears cached settings, so they are read again from django settings
+        """
+        for attr in self.defaults:
+            if attr in self.__dict__:
+                delattr(self, attr)
+
+        if hasattr(self, '_user_settings'):
+            delattr(self, '_user_settings')
     
     def __getattr__(self, attr):
         if attr not in self.defaults:
@@ -103,10 +127,9 @@ otcore_settings = OTCoreSettings(None, DEFAULTS, IMPORT_STRINGS)
 
 
 def reload_otcore_settings(*args, **kwargs):
-    global octore_settings
-    setting, value = kwargs['setting'], kwargs['value']
+    setting = kwargs['setting']
     if setting == 'OTCORE':
-        otcore_settings = APISettings(value, DEFAULTS, IMPORT_STRINGS)
+        otcore_settings.reload()
 
 
 setting_changed.connect(reload_otcore_settings)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from otcore.topic.models import tokengroup_key
+
+
+def set_keys(apps, schema_editor):
+    Tokengroup = apps.get_model('topic', 'Tokengroup')
+
+    for tokengroup in Tokengroup.objects.all().iterator():
+        tokengroup.key = tokengroup_key(tokengroup.group)
+        tokengroup.save(update_fields=['key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('topic', '0003_auto_20170328_1601'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tokengroup',
+            name='key',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(set_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tokengroup',
+            name='key',
+            field=models.BigIntegerField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='tokengroup',
+            name='group',
+            field=models.CharField(max_length=1500),
+        ),
+    ]
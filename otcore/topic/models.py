@@ -1,7 +1,68 @@
-from django.db import models
+import hashlib
+
+from django.db import connection, models
 from django.core.urlresolvers import reverse
 
 
+def tokengroup_key(group):
+    """
+    Compact, signed 64 bit hash of a tokengroup string
+    """
+    digest = hashlib.blake2b(group.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class TokengroupQuerySet(models.QuerySet):
+    def link(self, basket_groups, batch_size=5000):
+        """
+        Creates the tokengroups in `basket_groups` (a dict of basket_id -> iterable of group
+        strings) and adds them to the baskets, using batched multi-row INSERTs.  Existing
+        groups and links are skipped by the database (ON CONFLICT DO NOTHING).
+        Returns the number of new links.
+        """
+        from otcore.hit.models import Basket
+
+        groups = {}
+        for tokengroups in basket_groups.values():
+            for group in tokengroups:
+                groups.setdefault(tokengroup_key(group), group)
+
+        table = self.model._meta.db_table
+        group_rows = sorted(groups.items())
+
+        ids = {}
+        with connection.cursor() as cursor:
+            for start in range(0, len(group_rows), batch_size):
+                batch = group_rows[start:start + batch_size]
+
+                cursor.execute(
+                    'INSERT INTO {} (key, "group") VALUES {} ON CONFLICT (key) DO NOTHING'.format(
+                        table, ', '.join(['(%s, %s)'] * len(batch))),
+                    [param for row in batch for param in row]
+                )
+
+                keys = [key for key, group in batch]
+                ids.update(self.model.objects.filter(key__in=keys).values_list('key', 'id'))
+
+            through = Basket.tokengroups.through
+            links = sorted({(basket_id, ids[tokengroup_key(group)])
+                            for basket_id, tokengroups in basket_groups.items()
+                            for group in tokengroups})
+            linked = 0
+
+            for start in range(0, len(links), batch_size):
+                batch = links[start:start + batch_size]
+
+                cursor.execute(
+                    'INSERT INTO {} (basket_id, tokengroup_id) VALUES {} ON CONFLICT DO NOTHING'.format(
+                        through._meta.db_table, ', '.join(['(%s, %s)'] * len(batch))),
+                    [param for row in batch for param in row]
+                )
+                linked += cursor.rowcount
+
+        return linked
+
+
 class Tokengroup(models.Model):
 
     """
@@ -11,11 +72,18 @@ class Tokengroup(models.Model):
     in common.
     """
 
-    group = models.CharField(max_length=1500, unique=True)
+    group = models.CharField(max_length=1500)
+    key = models.BigIntegerField(unique=True)
+
+    objects = TokengroupQuerySet.as_manager()
 
     def __str__(self):
         return self.group
 
+    def save(self, *args, **kwargs):
+        self.key = tokengroup_key(self.group)
+        super(Tokengroup, self).save(*args, **kwargs)
+
     class Meta:
         ordering = ('group',)
 
@@ -0,0 +1,156 @@
+import mmap
+import os
+import posixpath
+import zipfile
+
+from lxml import etree
+
+
+class EpubFolder:
+    """
+    File access to a decompressed epub.  Paths are regular file paths.
+    EpubArchive has the same interface, for reading an epub without decompressing it.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def read_text(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def open(self, path):
+        """
+        Opens a file for streaming, in binary mode
+        """
+        return open(path, 'rb')
+
+    def parse(self, path):
+        return etree.parse(path).getroot()
+
+    def close(self):
+        pass
+
+
+class EpubArchive(EpubFolder):
+    """
+    File access to an epub, read straight from its zip file.
+
+    Paths are the paths the files would have if the epub was decompressed into `folder`,
+    so documents extracted from the archive are identical to documents extracted from a
+    decompressed copy.  The zip file is only opened when a file is first read, and members are
+    decompressed one at a time, when they are read.  With `use_mmap`, the zip file is memory
+    mapped rather than read through a file handle.
+    """
+    def __init__(self, source, folder, use_mmap=False):
+        self.source = source
+        self.use_mmap = use_mmap
+        self._file = None
+        self._map = None
+        self._zip = None
+        self._names = None
+        self._dirs = None
+
+        super(EpubArchive, self).__init__(folder)
+
+    @property
+    def zip(self):
+        if self._zip is None:
+            self._file = open(self.source, 'rb')
+
+            if self.use_mmap:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._zip = zipfile.ZipFile(self._map, 'r', allowZip64=True)
+            else:
+                self._zip = zipfile.ZipFile(self._file, 'r', allowZip64=True)
+
+        return self._zip
+
+    def load_names(self):
+        if self._names is None:
+            self._names = set(name.rstrip('/') for name in self.zip.namelist())
+
+            # zip files don't necessarily have entries for directories
+            self._dirs = {''}
+            for name in self._names:
+                parent = posixpath.dirname(name)
+                while parent not in self._dirs:
+                    self._dirs.add(parent)
+                    parent = posixpath.dirname(parent)
+
+        return self._names
+
+    def member(self, path):
+        """
+        Returns the name of the archive member for a path in the (virtual) decompressed folder
+        """
+        relative = os.path.relpath(os.path.normpath(path), self.folder)
+        relative = relative.replace(os.sep, '/')
+
+        return '' if relative == '.' else relative
+
+    def listdir(self, path):
+        names = self.load_names()
+        prefix = self.member(path)
+        prefix = prefix + '/' if prefix else ''
+
+        children = set()
+        for name in names | self._dirs:
+            if name and name.startswith(prefix):
+                children.add(name[len(prefix):].split('/', 1)[0])
+
+        return sorted(children)
+
+    def isdir(self, path):
+        self.load_names()
+        return self.member(path) in self._dirs
+
+    def isfile(self, path):
+        member = self.member(path)
+        return member in self.load_names() and member not in self._dirs
+
+    def read(self, path):
+        try:
+            return self.zip.read(self.member(path))
+        except KeyError:
+            raise FileNotFoundError('{} is not in {}'.format(path, self.source))
+
+    def read_text(self, path):
+        return self.read(path).decode('utf-8')
+
+    def open(self, path):
+        try:
+            return self.zip.open(self.member(path))
+        except KeyError:
+            raise FileNotFoundError('{} is not in {}'.format(path, self.source))
+
+    def parse(self, path):
+        return etree.fromstring(self.read(path))
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+        self._file = self._map = self._zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
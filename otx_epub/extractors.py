@@ -1,10 +1,10 @@
 import os
-from lxml import etree
 
 from otcore.occurrence.loaders import FileLoader
 from otcore.occurrence.extractors import BaseDocumentExtractor
 from .models import Epub
 from .loaders import EpubFileLoader
+from .archive import EpubFolder
 
 
 
@@ -38,42 +38,53 @@ class EpubExtractor(BaseDocumentExtractor):
 
     def import_document(self):
         """
-        Should get the location of the decompressed epub folder from the loader
+        Should get the location of the decompressed epub folder from the loader.
+        Loaders can also return an EpubArchive, to read the epub without decompressing it
         """
-        self.epub_folder = self.loader.load_source(self.source)
+        loaded = self.loader.load_source(self.source)
+
+        self.files = loaded if isinstance(loaded, EpubFolder) else EpubFolder(loaded)
+        self.epub_folder = self.files.folder
 
     def create_document(self):
         """
         Uses the Epub model instead of the Document model, to store
         Epub specific information
         """
-
-        oebps_folder = self.get_oebps_folder()
-        manifest = self.get_manifest()
-
-        manifest_tree = etree.parse(manifest).getroot()
-
-        title = self.extract_title(manifest_tree)
-        author = self.extract_author(manifest_tree)
-        publisher = self.extract_publisher(manifest_tree)
+        fields = self.document_fields()
 
         epub, _ = Epub.objects.get_or_create(
-            author=author, title=title, publisher=publisher,
-            defaults = {
-                'contents': self.epub_folder,
-                'oebps_folder': oebps_folder,
-                'manifest': manifest,
-                'source': self.source
-            }
+            author=fields.pop('author'), title=fields.pop('title'), publisher=fields.pop('publisher'),
+            defaults=fields
         )
 
         return epub
 
+    def document_fields(self):
+        """
+        Reads the Epub fields from the decompressed epub, without touching the database
+        """
+        oebps_folder = self.get_oebps_folder()
+        manifest = self.get_manifest()
+
+        manifest_tree = self.files.parse(manifest)
+
+        return {
+            'title': self.extract_title(manifest_tree),
+            'author': self.extract_author(manifest_tree),
+            'publisher': self.extract_publisher(manifest_tree),
+            'contents': self.epub_folder,
+            'oebps_folder': oebps_folder,
+            'manifest': manifest,
+            'source': self.source,
+            'content_hash': Epub.hash_file(self.source),
+        }
+
     def get_oebps_folder(self):
         oebps_folder = None
-        for item in os.listdir(self.epub_folder):
+        for item in self.files.listdir(self.epub_folder):
             full_path = os.path.join(self.epub_folder, item)
-            if os.path.isdir(full_path) and item.lower() != 'meta-inf':
+            if self.files.isdir(full_path) and item.lower() != 'meta-inf':
                 oebps_folder = full_path
                 break
 
@@ -91,7 +102,7 @@ class EpubExtractor(BaseDocumentExtractor):
         """
         container = os.path.join(self.epub_folder, 'META-INF', 'container.xml')
 
-        container_tree = etree.parse(container).getroot()
+        container_tree = self.files.parse(container)
 
         rootfile = container_tree.xpath(
             '//container:rootfile/@full-path', 
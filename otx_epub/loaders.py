@@ -4,6 +4,7 @@ import os
 from django.conf import settings
 
 from otcore.occurrence.loaders import BaseLoader
+from .archive import EpubArchive
 
 
 class EpubFileLoader(BaseLoader):
@@ -14,6 +15,17 @@ class EpubFileLoader(BaseLoader):
     EpubExtractor.
     """
     def load_source(self, source):
+        destination = self.get_destination(source)
+
+        with zipfile.ZipFile(source, 'r', allowZip64=True) as zf:
+            zf.extractall(destination)
+
+        return destination
+
+    def get_destination(self, source):
+        """
+        Returns the folder the epub is decompressed into
+        """
         epub_path = settings.EPUB_UPLOAD_FOLDER
         if epub_path in source:
             relative_path = source[len(epub_path):]
@@ -26,7 +38,17 @@ class EpubFileLoader(BaseLoader):
         destination = os.path.join(settings.EPUB_DECOMPRESSED_FOLDER, relative_path)
         destination = destination[:len(destination)-5] # remove .epub extensions
 
-        with zipfile.ZipFile(source, 'r', allowZip64=True) as zf:
-            zf.extractall(destination)
-
         return destination
+
+
+class EpubArchiveLoader(EpubFileLoader):
+    """
+    Reads the epub straight from its zip file, without decompressing it.
+    Returns an EpubArchive, whose paths are the ones the files would have in the
+    decompressed folder.  Pass `use_mmap=True` to memory map the zip file
+    """
+    def __init__(self, use_mmap=False):
+        self.use_mmap = use_mmap
+
+    def load_source(self, source):
+        return EpubArchive(source, self.get_destination(source), use_mmap=self.use_mmap)
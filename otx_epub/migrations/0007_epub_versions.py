@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otx_epub', '0006_auto_20170328_1601'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='epub',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='epub',
+            name='lex_version',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='epub',
+            name='pattern_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='epub',
+            name='pattern_version',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import hashlib
+
 from django.db import models
 from django.conf import settings
 
@@ -16,5 +18,24 @@ class Epub(Document):
     oebps_folder = models.CharField(max_length=255, blank=True)
     manifest = models.CharField(max_length=255, blank=True)
 
+    # What the epub was last extracted from: a hash of the source file, and the versions
+    # of the extraction pattern and lexical configuration
+    content_hash = models.CharField(max_length=64, blank=True)
+    pattern_name = models.CharField(max_length=255, blank=True)
+    pattern_version = models.CharField(max_length=40, blank=True)
+    lex_version = models.CharField(max_length=40, blank=True)
+
     def __str__(self):
         return self.title
+
+    @staticmethod
+    def hash_file(path, chunk_size=1 << 20):
+        """
+        sha256 of a file, read in chunks
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
@@ -1,5 +1,6 @@
 import os
 import shutil
+from functools import partial
 
 from django.test import TestCase
 from django.conf import settings
@@ -7,6 +8,7 @@ from django.conf import settings
 from otcore.occurrence.models import Document
 from ..models import Epub
 from ..extractors import EpubExtractor
+from ..loaders import EpubArchiveLoader
 
 
 class EpubExtractorTests(TestCase):
@@ -57,3 +59,29 @@ class EpubExtractorTests(TestCase):
         self.assertEqual(epub.publisher, '')
         self.assertEqual(os.path.basename(epub.manifest), 'content.opf')
         self.assertEqual(os.path.basename(epub.oebps_folder), 'OEBPS')
+
+    def test_archive_epub_extractor(self):
+        """
+        Reading the epub straight from its zip file gives the same Epub as the decompressed
+        copy, without writing anything to the decompressed folder
+        """
+        self.clear_epub_folder()
+
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        filename = os.path.join(dir_path, 'owl_creek.epub')
+
+        decompressed = EpubExtractor(filename)
+        decompressed.import_document()
+        fields = decompressed.document_fields()
+        self.clear_epub_folder()
+
+        for use_mmap in (False, True):
+            extractor = EpubExtractor(filename, loader=partial(EpubArchiveLoader, use_mmap=use_mmap))
+            extractor.import_document()
+
+            self.assertEqual(extractor.document_fields(), fields)
+            self.assertTrue(extractor.files.isfile(os.path.join(fields['oebps_folder'], 'content.opf')))
+            self.assertIn('OEBPS', extractor.files.listdir(fields['contents']))
+            extractor.files.close()
+
+        self.assertEqual(os.listdir(settings.EPUB_DECOMPRESSED_FOLDER), [])
@@ -3,7 +3,7 @@ import os
 from django.db import models
 from django.contrib.auth.models import User
 
-from otcore.hit.models import Basket
+from otcore.hit.models import Basket, baskets_bulk_created
 
 
 class Review(models.Model):
@@ -38,6 +38,18 @@ models.signals.post_save.connect(
 )
 
 
+def create_reviews(sender, baskets, **kwargs):
+    """
+    Create Review Models for baskets created in bulk
+    """
+    Review.objects.bulk_create([Review(basket=basket) for basket in baskets])
+
+
+baskets_bulk_created.connect(
+    create_reviews, weak=False, dispatch_uid='models.create_reviews'
+)
+
+
 class Report(models.Model):
     """
     Class for tracking generated reports of Review
@@ -0,0 +1,10 @@
+from .reports import generate_csv_report
+from .serializers import ReportSerializer
+
+
+def generate_report_task(job, report_type):
+    job.set_stage('generating report')
+
+    report = generate_csv_report(report_type)
+
+    return ReportSerializer(report).data
@@ -8,7 +8,7 @@ from otcore.hit.models import Hit, Basket
 from .serializers import ReviewSerializer, HitListWithReviewSerializer, ReportSerializer, \
     BasketListWithReviewSerializer
 from .models import Review, Report
-from .reports import generate_csv_report
+from otcore.job.views import enqueued_response
 
 
 class SetReviewed(generics.RetrieveUpdateAPIView):
@@ -100,7 +100,8 @@ class DeleteReportView(generics.DestroyAPIView):
 
 class NewReportView(APIView):
     """
-    Generates a Report.  Returns serializer report info
+    Queues the generation of a Report.  Returns the job, whose result is the
+    serialized report info once it's done
 
     must be sent one of Report.TOPIC_SETS, eg:
         { 'report_type': 'R' }
@@ -108,9 +109,7 @@ class NewReportView(APIView):
     def post(self, request, *args, **kwargs):
         report_type = request.data['report_type']
 
-        report = generate_csv_report(report_type)
-
-        return Response(ReportSerializer(report).data)
+        return enqueued_response('otx_review.tasks.generate_report_task', report_type=report_type)
 
 
 class AllReportTypesView(APIView):
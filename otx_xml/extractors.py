@@ -25,11 +25,12 @@ class XMLExtractor(BaseDocumentExtractor):
     default_pattern_name = 'default'
     default_loader = FileLoader
 
-    def __init__(self, source, loader=None, pattern_name=None, pattern_model=None, **kwargs):
+    def __init__(self, source, loader=None, pattern_name=None, pattern_model=None, pattern=None, **kwargs):
         pattern_model = pattern_model or self.default_pattern_model
         pattern_name = pattern_name or self.default_pattern_name
 
-        self.pattern = pattern_model.objects.get(name=pattern_name)
+        # a preloaded pattern can be passed, eg. to an extractor running in a worker process
+        self.pattern = pattern if pattern is not None else pattern_model.objects.get(name=pattern_name)
 
         super(XMLExtractor, self).__init__(source, loader, **kwargs)
 
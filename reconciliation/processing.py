@@ -1,11 +1,12 @@
 from django.db.utils import IntegrityError
 
-from otcore.hit.models import Basket, Hit
+from otcore.hit.models import Basket, Hit, deferred_display_names
+from otcore.lex.lex_utils import lex_slugify_many
 from otcore.topic.models import Ttype
 from otx_weblink.models import Weblink
 
 
-def reconcile(reconciliation_data):
+def reconcile(reconciliation_data, progress=None, chunk_size=100):
     """
     Pass a python dict of reconciliation data of the form:
     {
@@ -20,43 +21,69 @@ def reconcile(reconciliation_data):
             }
         }
     },
+
+    Baskets are reconciled in chunks of `chunk_size`, each in its own transaction, with display
+    names recomputed once per chunk.  If passed, `progress` is called with the number of
+    baskets after each chunk is committed, so that it can be reported while reconciling.
     """
     errors = []
 
-    for basket_data in reconciliation_data:
-        try:
-            basket = Basket.objects.get(id=basket_data['basket'])
-        except Basket.DoesNotExist:
-            errors.append("Topic {0}: No topic matches basket id {0}".format(basket_data['basket']))
-            continue
+    # Slugify all incoming names in one batch, so the Hit saves below reuse the memoized slugs
+    lex_slugify_many(
+        name
+        for basket_data in reconciliation_data
+        for name in ((basket_data.get('external_link') or {}).get('recon_data') or {}).get('topic_hits') or []
+    )
 
-        url = basket_data['external_link'].get('URL', None)
-        label = basket_data['external_link'].get('label', None)
-        link_type = basket_data['external_link'].get('link_type', None)
+    for start in range(0, len(reconciliation_data), chunk_size):
+        chunk = reconciliation_data[start:start + chunk_size]
 
-        if url is not None and label is not None and link_type is not None:
-            weblink, _ = Weblink.objects.get_or_create(
-                url=url, content='{} ({})'.format(label, link_type)
-            )
-            weblink.baskets.add(basket)
+        with deferred_display_names():
+            for basket_data in chunk:
+                reconcile_basket(basket_data, errors)
 
-        recon_data = basket_data['external_link'].get('recon_data', None)
+        if progress is not None:
+            progress(len(chunk))
 
-        if recon_data is not None:
-            topic_hits = recon_data.get('topic_hits', [])
+    return errors
 
-            for name in topic_hits:
-                try: 
-                    Hit.objects.get_or_create(
-                        name=name, basket=basket
-                    )
-                except IntegrityError:
-                    errors.append("Topic {}: Name \"{}\" already exists on a different topic.".format(basket.id, name))
 
-            topic_types = recon_data.get('topic_type', [])
+def reconcile_basket(basket_data, errors):
+    """
+    Adds the weblink, names and types of a single basket's reconciliation data.
+    Problems are appended to `errors`
+    """
+    try:
+        basket = Basket.objects.get(id=basket_data['basket'])
+    except Basket.DoesNotExist:
+        errors.append("Topic {0}: No topic matches basket id {0}".format(basket_data['basket']))
+        return
 
-            for topic_type in topic_types:
-                ttype, _ = Ttype.objects.get_or_create(ttype=topic_type)
-                basket.types.add(ttype)
+    url = basket_data['external_link'].get('URL', None)
+    label = basket_data['external_link'].get('label', None)
+    link_type = basket_data['external_link'].get('link_type', None)
 
-    return errors
+    if url is not None and label is not None and link_type is not None:
+        weblink, _ = Weblink.objects.get_or_create(
+            url=url, content='{} ({})'.format(label, link_type)
+        )
+        weblink.baskets.add(basket)
+
+    recon_data = basket_data['external_link'].get('recon_data', None)
+
+    if recon_data is not None:
+        topic_hits = recon_data.get('topic_hits', [])
+
+        for name in topic_hits:
+            try: 
+                Hit.objects.get_or_create(
+                    name=name, basket=basket
+                )
+            except IntegrityError:
+                errors.append("Topic {}: Name \"{}\" already exists on a different topic.".format(basket.id, name))
+
+        topic_types = recon_data.get('topic_type', [])
+
+        for topic_type in topic_types:
+            ttype, _ = Ttype.objects.get_or_create(ttype=topic_type)
+            basket.types.add(ttype)
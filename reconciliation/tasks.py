@@ -0,0 +1,7 @@
+from .processing import reconcile
+
+
+def reconcile_task(job, reconciliation_data):
+    job.set_stage('reconciling', total=len(reconciliation_data))
+
+    return reconcile(reconciliation_data, progress=job.advance)
@@ -0,0 +1,39 @@
+from django.db import connection
+from django.test import TransactionTestCase
+
+from otcore.hit.models import Basket, Hit
+from otcore.job.models import Job
+from .processing import reconcile
+
+
+class ReconcileTests(TransactionTestCase):
+    def test_progress_is_visible_while_reconciling(self):
+        """
+        Each chunk of baskets is committed before progress is reported, so job progress can be
+        read from another connection while the reconciliation is still running
+        """
+        baskets = [Basket.create_from_string(name) for name in ('Nash', 'Crosby', 'Stills')]
+        reconciliation_data = [
+            {'basket': basket.id, 'external_link': {'recon_data': {'topic_hits': ['{} (band)'.format(basket.display_name)]}}}
+            for basket in baskets
+        ]
+
+        job = Job.objects.create(task='reconciliation.tasks.reconcile_task', status=Job.RUNNING)
+        job.PROGRESS_INTERVAL = 0
+
+        observer = connection.copy()
+        self.addCleanup(observer.close)
+        seen = []
+
+        def progress(count):
+            job.advance(count)
+
+            with observer.cursor() as cursor:
+                cursor.execute('SELECT progress FROM {} WHERE id = %s'.format(Job._meta.db_table), [job.id])
+                seen.append(cursor.fetchone()[0])
+
+        errors = reconcile(reconciliation_data, progress=progress, chunk_size=1)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(seen, [1, 2, 3])
+        self.assertEqual(Hit.objects.get(name='Stills (band)').basket_id, baskets[2].id)
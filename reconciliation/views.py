@@ -4,7 +4,7 @@ from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from .processing import reconcile
+from otcore.job.views import enqueued_response
 
 
 class ProcessReconciliationView(APIView):
@@ -16,6 +16,5 @@ class ProcessReconciliationView(APIView):
         except (json.decoder.JSONDecodeError, UnicodeDecodeError):
             return Response({"non_field_errors": ["Not a valid JSON file."]}, status=status.HTTP_400_BAD_REQUEST)
 
-        errors = reconcile(reconciliation_data)
-
-        return Response(errors)
+        # the list of errors is the job result
+        return enqueued_response('reconciliation.tasks.reconcile_task', reconciliation_data=reconciliation_data)
@@ -1,5 +1,6 @@
 import os
 import shutil
+from functools import partial
 
 from django.conf import settings
 from django.core.management import call_command
@@ -10,14 +11,12 @@ from otcore.management.manage_utils import erase_data
 from otcore.relation.models import RelationType
 from otcore.relation.processing import global_containment
 from otx_epub.models import Epub
-from otx_epub.extractors import EpubExtractor
-from manuscripts.extractors import IndexExtractor
+from otx_epub.loaders import EpubArchiveLoader
 from manuscripts.cleaning import full_clean
+from manuscripts.ingest import ingest_epubs, epub_sources, format_timings
 from manuscripts.models import Index
 from manuscripts.processing import nyu_global_multiple_tokens
 
-OS_FILES = ['.DS_Store',]
-
     
 def clear_epub_folder():
     """
@@ -40,11 +39,22 @@ def clear_epub_folder():
             print(e)
 
 
-def run():
+def run(*args):
     """
     A Script to empty the database and do a full load and processing
     of the epub set
+
+    The number of parsing processes can be passed as a script argument,
+    eg. `runscript full_batch --script-args workers=4`.  Defaults to one per cpu.
+    With `from_zip=1`, the epubs are read straight from their zip files (`from_zip=mmap` to
+    memory map them) instead of being decompressed.
     """
+    options = dict(arg.split('=', 1) for arg in args)
+    workers = int(options['workers']) if 'workers' in options else None
+
+    loader = None
+    if options.get('from_zip'):
+        loader = partial(EpubArchiveLoader, use_mmap=options['from_zip'] == 'mmap')
 
     # Erase existing data
     erase_data()
@@ -71,18 +81,10 @@ def run():
     # Load lex parsing
     read_stopwords()
 
-    # Load the epubs into extractors
-    for root, subdirs, files in os.walk(settings.EPUB_SOURCES_FOLDER):
-        for f in files:
-            if f not in OS_FILES:
-                filepath = os.path.join(root, f)
-
-                extractor = EpubExtractor(filepath)
-                extractor.extract_all()
-
-                epub = extractor.document
-                print("Extracting content and hits: {}".format(epub.title))
-                IndexExtractor.extract_from_source(epub)
+    # Parse the epubs in worker processes, and extract their content and hits
+    sources = epub_sources(settings.EPUB_SOURCES_FOLDER)
+    for epub, staging in ingest_epubs(sources, processes=workers, loader=loader):
+        print("Extracted content and hits: {} ({})".format(epub.title, format_timings(staging.timings)))
 
     # Hit cleaning
     full_clean()